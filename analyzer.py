@@ -0,0 +1,77 @@
+from nltk.stem import PorterStemmer as Stemmer
+from multiprocessing import Pool
+from functools import lru_cache
+from itertools import islice
+
+# Maximum number of distinct words whose stems are remembered
+STEM_CACHE_SIZE = 200000
+# Number of pages sent to a worker process at a time
+PAGES_PER_TASK = 64
+
+ps = Stemmer()
+stopwords = frozenset(open('stopwords.txt', 'r').read().split())
+
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(word: str) -> str:
+    """Stems the word using the Porter Stemmer algorithm, remembering the stems of recent words."""
+    return ps.stem(word)
+
+
+def stem_words(words: list[str]) -> list[str]:
+    """Stems the words using the Porter Stemmer algorithm."""
+    return [stem(word) for word in words]
+
+
+def remove_stop_words(words: list[str]) -> list[str]:
+    """Removes stopwords from the list of words."""
+    return [word for word in words if word not in stopwords]
+
+
+def analyze(text: str) -> list[str]:
+    """Returns the stems of the words of a cleaned text, without the stopwords."""
+    return [stem(word) for word in text.split() if word not in stopwords]
+
+
+def term_positions(text: str) -> dict[str, list[int]]:
+    """Returns the positions of each stem in a cleaned text, counting only the words that are not stopwords."""
+    positions = {}
+    for position, word in enumerate(analyze(text)):
+        positions.setdefault(word, []).append(position)
+    return positions
+
+
+def index_terms(page: tuple[int, str, str]) -> tuple[int, dict, dict]:
+    """Returns the ID of the page and the word positions of its body and title.
+
+    Args:
+        page (tuple[int, str, str]): The ID, clean body and clean title of the page.
+    """
+    page_id, body, title = page
+    return page_id, term_positions(body), term_positions(title)
+
+
+def analyze_pages(pages, processes: int = 1):
+    """Yields the ID and the body and title word positions of each page, in the order of the pages.
+    With several processes, the pages are sharded across worker processes, and the next shard is analyzed while
+    the results of the previous one are consumed.
+
+    Args:
+        pages: Iterable of (page ID, clean body, clean title) tuples.
+        processes (int, optional): The number of worker processes. Defaults to 1.
+    """
+    if processes <= 1:
+        yield from map(index_terms, pages)
+        return
+    pages = iter(pages)
+    # Pages are read in the calling thread, since SQLite cursors cannot be shared with the pool's feeder thread
+    with Pool(processes) as pool:
+        pending = None
+        while True:
+            shard = list(islice(pages, PAGES_PER_TASK * processes))
+            submitted = pool.map_async(index_terms, shard, PAGES_PER_TASK) if shard else None
+            if pending is not None:
+                yield from pending.get()
+            if submitted is None:
+                break
+            pending = submitted
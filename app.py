@@ -1,154 +1,314 @@
-from flask import Flask, render_template, request, jsonify
-import datetime, retrieval, timeit
-import sqlite3
+from flask import Flask, Response, render_template, request, jsonify
+import datetime, retrieval, timeit, json, os, metrics, argparse, shards, base64, hashlib
 from pathlib import Path
+from contextlib import nullcontext
 from collections import defaultdict
 from flask_cors import CORS, cross_origin
+from cache import QueryCache
+from storage import ReadConnections, chunked
+from autocomplete import KeywordIndex, encode_cursor, decode_cursor
 
-# Create a connection to the database
-connection = sqlite3.connect('database.db', check_same_thread=False)
+# Read-only connections to the database, one per thread and process
+readers = ReadConnections('database.db')
+# Cache of the shown results and the hydrated result pages of recent queries, keyed by the query key of retrieval, the ranking depth and the page
+result_cache = QueryCache()
+# Default and maximum number of results per page of the search API
+SEARCH_PAGE_SIZE = retrieval.MAX_RESULTS
+# Maximum number of worker processes of a batch search
+BATCH_PROCESSES = os.cpu_count() or 1
+# Default number of similar pages returned by the similar pages API
+SIMILAR_LIMIT = 10
+# Default and maximum number of keywords per page of the keyword API
+KEYWORD_LIMIT = 50
+MAX_KEYWORD_LIMIT = 1000
+# Client addresses allowed to use the profiler, which reveals the code of the app and slows every request down
+PROFILE_ADDRESSES = ("127.0.0.1", "::1")
+# Keywords sorted for prefix searches, rebuilt once a new index generation is loaded
+keyword_index, keyword_index_generation = None, None
+# Metrics of the search requests, exported together with those of retrieval and storage by /metrics
+request_stages = metrics.Histogram("search_request_stage_seconds", "Seconds spent in each stage of a /search request.", ["stage"])
+search_requests = metrics.Counter("search_requests_total", "Requests to /search by whether their results were cached.", ["cached"])
 
 # Flask
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "http://localhost:5173"}})
+# The metrics and the profiler are for operators, so browsers on other origins cannot use them
+CORS(app, resources={r"^(?!/metrics).*": {"origins": "http://localhost:5173"}})
 app.config['CORS_HEADERS'] = 'Content-Type'
 
-# Get title, last modification date, size by page ID
-def page_id_to_page_info(id: int) -> tuple[str, int, int]:
-    cursor = connection.cursor()
-    page_info = cursor.execute("SELECT title, last_modification_date, size FROM pages WHERE page_id = ?", (id,)).fetchone()
-    cursor.close()
-    if page_info is None:
-        raise ValueError("No page with the given ID is found.")
-    return page_info
-
-# Get URL by page ID
-def page_id_to_url(id: int) -> str:
-    cursor = connection.cursor()
-    url = cursor.execute("SELECT url FROM pages WHERE page_id = ?", (id,)).fetchone()
-    cursor.close()
-    if url is None:
-        raise ValueError("No page with the given ID is found.")
-    return url[0]
-
-# Get top stems by page ID
-def page_id_to_stems(id: int, num_stems: int = 5, include_title: bool = True) -> list[tuple[str, int]]:
-    cursor = connection.cursor()
-    stems_freqs = list(cursor.execute("SELECT keyword_id, keyword_count FROM inverted_index WHERE page_id = ?", (id,)).fetchall())
-    if include_title:
-        stems_freqs += list(cursor.execute("SELECT keyword_id, keyword_count FROM title_inverted_index WHERE page_id = ?", (id,)).fetchall())
-    
-    if not stems_freqs:
-        cursor.close()
-        raise ValueError("No page with the given ID is found.")
-    
-    stems_ids = [stem[0] for stem in stems_freqs]
-    freqs = [stem[1] for stem in stems_freqs]
-    
-    stems = []
-    for stem_id in stems_ids:
-        result = cursor.execute("SELECT keyword FROM keywords WHERE keyword_id = ?", (stem_id,)).fetchone()
-        if result:
-            stems.append(result[0])
-    
-    cursor.close()
-    stems_counts = list(zip(stems, freqs))
-    d = defaultdict(int)
-    for k, v in stems_counts:
-        d[k] += v
-    return sorted(d.items(), key=lambda x: x[1], reverse=True)[0:num_stems]
-
-# Obtain parent or child links by page ID
-def page_id_to_links(id: int, parent: bool = True) -> list[str]:
-    cursor = connection.cursor()
-    if parent:
-        link_ids = cursor.execute("SELECT parent_id FROM parent_child WHERE child_id = ?", (id,)).fetchall()
-    else:
-        link_ids = cursor.execute("SELECT child_id FROM parent_child WHERE parent_id = ?", (id,)).fetchall()
-    cursor.close()
-    
-    links = []
-    for link_id in link_ids:
-        try:
-            links.append(page_id_to_url(link_id[0]))
-        except ValueError:
-            pass
-    return links
+# Get the keyword index of the current index generation
+def current_keyword_index() -> KeywordIndex:
+    global keyword_index, keyword_index_generation
+    generation = retrieval.currentIndex().generation
+    if keyword_index is None or keyword_index_generation != generation:
+        with readers.cursor() as cursor:
+            keyword_index, keyword_index_generation = KeywordIndex.from_database(cursor), generation
+    return keyword_index
 
 # Convert a timestamp to a datetime string
 def timestamp_to_datetime(timestamp: int):
     return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
 
+# Get the rows of a query for many page IDs, the query has a {placeholders} field for the IDs
+def select_for_pages(query: str, ids: list[int]) -> list[tuple]:
+    cursor = readers.get().cursor()
+    rows = []
+    for chunk in chunked(ids):
+        rows += cursor.execute(query.format(placeholders=",".join("?" for _ in chunk)), chunk).fetchall()
+    cursor.close()
+    return rows
+
 # Class to represent a search result
 class SearchResult:
-    def __init__(self, id: int, score: float, num_keywords: int = 5):
+    def __init__(self, id: int, score: float, page_info: tuple[str, int, int, str], keywords: list[tuple[str, int]], parent_links: list[str], child_links: list[str]):
         self.id = id
         self.score = score
-        self.title, self.time, self.size = page_id_to_page_info(id)
+        self.title, self.time, self.size, self.url = page_info
         self.time_formatted = timestamp_to_datetime(self.time)
-        self.url = page_id_to_url(id)
-        self.keywords = page_id_to_stems(id, num_keywords)
-        self.parent_links = page_id_to_links(id, parent=True)
-        self.child_links = page_id_to_links(id, parent=False)
+        self.keywords = keywords
+        self.parent_links = parent_links
+        self.child_links = child_links
+
+    # Convert the result to its JSON representation in responses
+    def to_json(self, score_digits: int = 1) -> dict:
+        return {
+            "id": self.id,
+            "title": self.title,
+            "url": self.url,
+            "time": self.time_formatted,
+            "size": self.size,
+            "keywords": self.keywords,
+            "parent_links": self.parent_links,
+            "child_links": self.child_links,
+            "score": round(self.score, score_digits),
+        }
+
+    # Build the search results of a result page with one query each for the pages, keywords, parents and children
+    @classmethod
+    def hydrate(cls, results: list[tuple[int, float]], num_keywords: int = 5) -> list["SearchResult"]:
+        ids = [id for id, _ in results]
+        page_infos = {id: info for id, *info in select_for_pages("SELECT page_id, title, last_modification_date, size, url FROM pages WHERE page_id IN ({placeholders})", ids)}
+        keywords, parent_links, child_links = defaultdict(list), defaultdict(list), defaultdict(list)
+        # The keywords of each page are stored from the most to the least frequent
+        for id, keyword, count in select_for_pages("SELECT page_id, keyword, keyword_count FROM page_keywords WHERE page_id IN ({placeholders}) ORDER BY page_id, keyword_count DESC, keyword", ids):
+            if len(keywords[id]) < num_keywords:
+                keywords[id].append((keyword, count))
+        # Links to pages that were not crawled have no URL and are skipped
+        for id, url in select_for_pages("SELECT parent_child.child_id, pages.url FROM parent_child JOIN pages ON pages.page_id = parent_child.parent_id WHERE parent_child.child_id IN ({placeholders}) ORDER BY parent_child.rowid", ids):
+            parent_links[id].append(url)
+        for id, url in select_for_pages("SELECT parent_child.parent_id, pages.url FROM parent_child JOIN pages ON pages.page_id = parent_child.child_id WHERE parent_child.parent_id IN ({placeholders}) ORDER BY parent_child.rowid", ids):
+            child_links[id].append(url)
+        return [cls(id, score, page_infos[id], keywords[id], parent_links[id], child_links[id]) for id, score in results if id in page_infos]
 
 # Search page
 @app.route("/")
 def searchbar():
     return render_template("index.html")
 
+# Encode the position of the next result page of a query as an opaque cursor
+# The cursor is bound to the index generation and the query, so it cannot continue a different ranking
+def encode_search_cursor(generation: int, offset: int, key: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps([generation, offset, query_digest(key)]).encode()).decode()
+
+# Decode a cursor made by encode_search_cursor, raising a ValueError if it is malformed
+def decode_search_cursor(cursor: str) -> tuple[int, int, str]:
+    try:
+        generation, offset, digest = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, UnicodeError) as error:
+        raise ValueError("The cursor is malformed.") from error
+    if not isinstance(generation, int) or not isinstance(offset, int) or offset < 0 or not isinstance(digest, str):
+        raise ValueError("The cursor is malformed.")
+    return generation, offset, digest
+
+def query_digest(key: tuple) -> str:
+    return hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()
+
+# Return the ranked results of a query with a nonzero score, which are the ones shown, from the best
+# They are filtered once per ranking and cached next to its pages, so every page of a query is sliced from them
+def shown_results(query: str, related_doc: int, index: retrieval.SearchIndex, key: tuple, depth: int) -> tuple[tuple[int, float], ...]:
+    results = result_cache.get((key, depth), index.generation) if query else None
+    if results is None:
+        results = tuple((ID, score) for ID, score in retrieval.rankedResults(query, related_doc, index, depth) if score != 0)
+        if query:
+            result_cache.put((key, depth), results, index.generation)
+    return results
+
 # Handle search requests
 @app.route("/search", methods=['POST'])
 @cross_origin()
 def submit_search():
+    """Searches the query of the searchbar field, optionally improved by the related_doc page.
+    The page_size field sets the number of results per page, and the cursor field continues after the page that returned it.
+    Paged requests rank up to retrieval.MAX_RANKED_RESULTS results, others the retrieval.MAX_RESULTS best ones as before.
+    The ranking of a query is kept by retrieval, so the next pages of a query are sliced from it without ranking again and only their results are hydrated.
+    With a true debug field, the response also holds the time of each stage and the counters of the request in debug_timings.
+    """
     data = request.get_json()
     query = data.get('searchbar', "") if data else ""
     related_doc = data.get('related_doc', -1) if data else -1
-    start_time = timeit.default_timer()
-    search_results_raw = retrieval.search_engine(query, related_doc)
-    search_time_taken = timeit.default_timer() - start_time
-
-    filtered_results = [(ID, score) for ID, score in search_results_raw.items() if score != 0]
-    
-    # If no results, return early with an empty results array
-    if not filtered_results:
-        return jsonify({
-            "query": query,
-            "results": [],
-            "time_taken": round(search_time_taken * 1000)
-        })
-
-    search_results = [SearchResult(ID, score) for ID, score in sorted(search_results_raw.items(), key = lambda x: x[1], reverse = True) if score != 0]
-    
-    response = jsonify({
+    debug = bool(data.get('debug', False)) if data else False
+    try:
+        page_size = max(1, min(int(data.get('page_size', SEARCH_PAGE_SIZE)) if data else SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return jsonify({"error": "The page_size must be an integer."}), 400
+    try:
+        generation, offset, digest = decode_search_cursor(data['cursor']) if data and data.get('cursor') else (None, 0, None)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    depth = retrieval.MAX_RANKED_RESULTS if data and ('page_size' in data or 'cursor' in data) else retrieval.MAX_RESULTS
+    with metrics.trace() if debug else nullcontext() as breakdown:
+        start_time = timeit.default_timer()
+        with request_stages.time("search"):
+            index = retrieval.currentIndex()
+            key = retrieval.queryKey(query, related_doc, index)
+            if digest is not None and digest != query_digest(key):
+                return jsonify({"error": "The cursor belongs to another query."}), 400
+            if generation is not None and generation != index.generation:
+                return jsonify({"error": "The index changed since the cursor was returned, search again."}), 410
+            # Reuse the hydrated results of the same page of an identical query of the current index generation
+            page = result_cache.get((key, depth, offset, page_size), index.generation) if query else None
+            cached = page is not None
+            if not cached:
+                ranked = shown_results(query, related_doc, index, key, depth)
+                total = len(ranked)
+        search_time_taken = timeit.default_timer() - start_time
+        search_requests.inc(1, "true" if cached else "false")
+
+        if cached:
+            results, total = page
+        else:
+            with request_stages.time("hydrate"):
+                results = [result.to_json() for result in SearchResult.hydrate(list(ranked[offset:offset + page_size]))]
+            if query:
+                result_cache.put((key, depth, offset, page_size), (results, total), index.generation)
+
+    payload = {
         "query": query,
-        "results": [
-            {
-                "id": result.id,
-                "title": result.title,
-                "url": result.url,
-                "time": result.time_formatted,
-                "size": result.size,
-                "keywords": result.keywords,
-                "parent_links": result.parent_links,
-                "child_links": result.child_links,
-                "score": round(result.score, 1),
-            } for result in search_results
-        ],
-        "time_taken": round(search_time_taken * 1000)
-    })
-    return response
+        "results": results,
+        "total": total,
+        "next_cursor": encode_search_cursor(index.generation, offset + page_size, key) if offset + page_size < total else None,
+        "time_taken": round(search_time_taken * 1000),
+        "cached": cached
+    }
+    if debug:
+        payload["debug_timings"] = breakdown
+    # Serialization is timed after the trace, since the breakdown is part of the response
+    with request_stages.time("serialize"):
+        return jsonify(payload)
+
+
+@app.route("/search/batch", methods=['POST'])
+@cross_origin()
+def submit_batch_search():
+    """Runs many searches and streams their ranked page IDs and scores back as JSON lines, in the order they complete.
+    The body holds a "queries" list whose items are query strings or objects with "searchbar" and optional "related_doc" fields,
+    and an optional "processes" count of worker processes.
+    """
+    data = request.get_json(silent=True) or {}
+    queries = data.get("queries")
+    if not isinstance(queries, list):
+        return jsonify({"error": "The body must contain a list of queries."}), 400
+    try:
+        queries = [(query, -1) if isinstance(query, str) else (str(query.get("searchbar", "")), int(query.get("related_doc", -1))) for query in queries]
+        processes = max(1, min(int(data.get("processes", BATCH_PROCESSES)), BATCH_PROCESSES))
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({"error": "Queries must be strings or objects with a searchbar and an integer related_doc."}), 400
+
+    def lines():
+        for position, results in retrieval.batch_search(queries, processes):
+            yield json.dumps({
+                "position": position,
+                "query": queries[position][0],
+                "results": [{"id": ID, "score": score} for ID, score in sorted(results.items(), key = lambda x: x[1], reverse = True) if score != 0]
+            }) + "\n"
+    return Response(lines(), mimetype="application/x-ndjson")
+
+
+@app.route("/similar", methods=['GET'])
+@cross_origin()
+def get_similar_pages():
+    """Returns the pages most similar to the page of the id parameter, from the most similar, with their cosine similarity as score.
+    The similar pages are precomputed by the indexer, and the limit parameter sets how many are returned.
+    """
+    page_id = request.args.get("id", None, type=int)
+    if page_id is None:
+        return jsonify({"error": "The id parameter must be a page ID."}), 400
+    limit = max(1, min(request.args.get("limit", SIMILAR_LIMIT, type=int), retrieval.MAX_RESULTS))
+    similar = retrieval.similarPages(page_id, limit)
+    return jsonify({"id": page_id, "results": [result.to_json(3) for result in SearchResult.hydrate(list(similar.items()))]})
+
+
+@app.route("/cache", methods=['GET'])
+@cross_origin()
+def get_cache_stats():
+    return jsonify({"results": result_cache.stats(), "search": retrieval.resultCache.stats()})
+
+
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    """Returns the metrics of this process in the Prometheus text exposition format."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/metrics/profile", methods=['GET', 'POST'])
+def profile():
+    """Starts or stops the sampling profiler with a POST whose body holds a "running" flag and an optional "interval" in seconds.
+    A GET returns the stacks sampled so far in the folded format of flame graph tools, limited to the limit parameter if given.
+    Only clients on the local machine may use the profiler.
+    """
+    if request.remote_addr not in PROFILE_ADDRESSES:
+        return jsonify({"error": "The profiler is only available from the local machine."}), 403
+    if request.method == 'GET':
+        return Response(metrics.profiler.folded(request.args.get("limit", None, type=int)), mimetype="text/plain")
+    data = request.get_json(silent=True) or {}
+    try:
+        interval = float(data.get("interval", metrics.PROFILE_INTERVAL))
+    except (TypeError, ValueError):
+        return jsonify({"error": "The interval must be a number of seconds."}), 400
+    if interval < metrics.MIN_PROFILE_INTERVAL:
+        return jsonify({"error": f"The interval must be at least {metrics.MIN_PROFILE_INTERVAL} seconds."}), 400
+    if data.get("running"):
+        metrics.profiler.start(interval)
+    else:
+        metrics.profiler.stop()
+    return jsonify(metrics.profiler.stats())
 
 
 @app.route("/keywords", methods=['GET'])
 @cross_origin()
 def get_keywords():
-    cursor = connection.cursor()
-    keywords = cursor.execute("SELECT keyword FROM keywords").fetchall()
-    cursor.close()
-    keywords = [keyword[0] for keyword in keywords]
-    return jsonify(keywords)
+    """Returns the keywords starting with the prefix parameter, from the most to the least frequent.
+    The limit parameter sets the page size, and the cursor parameter continues after the page that returned it.
+    With format=jsonl, all matching keywords are streamed as JSON lines instead.
+    """
+    prefix = request.args.get("prefix", "").strip().lower()
+    limit = max(1, min(request.args.get("limit", KEYWORD_LIMIT, type=int), MAX_KEYWORD_LIMIT))
+    try:
+        after = decode_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    index = current_keyword_index()
+    if request.args.get("format") == "jsonl":
+        lines = (json.dumps({"keyword": keyword, "frequency": frequency}) + "\n" for keyword, frequency in index.iterate(prefix, after))
+        return Response(lines, mimetype="application/x-ndjson")
+    matches, total, has_more = index.search(prefix, limit, after)
+    return jsonify({
+        "keywords": [keyword for keyword, _ in matches],
+        "frequencies": [frequency for _, frequency in matches],
+        "total": total,
+        "next_cursor": encode_cursor(*matches[-1]) if has_more else None
+    })
 
 
 # Flask
 if __name__ == "__main__":
-    app.run(debug = True)
+    arg_parser = argparse.ArgumentParser(description="Serves the search engine.")
+    arg_parser.add_argument("--shards", type=int, default=0, help="Number of local shard worker processes ranking the shard snapshots written by indexer.py --shards.")
+    arg_parser.add_argument("--shard-addresses", default=None, help="Comma-separated host:port addresses of running shard workers, in shard order.")
+    arg_parser.add_argument("--shard-authkey", default=None, help="Key of the shard workers at --shard-addresses.")
+    args = arg_parser.parse_args()
+    if args.shard_addresses:
+        shards.connect([shards.parse_address(address) for address in args.shard_addresses.split(",")], (args.shard_authkey or "").encode())
+    elif args.shards > 1:
+        shards.start_local(args.shards)
+    # The reloader would run this block again in a second process, which would start its own shard workers
+    app.run(debug = True, use_reloader = args.shard_addresses is not None or args.shards <= 1)
@@ -0,0 +1,88 @@
+import json
+import base64
+import numpy as np
+from bisect import bisect_left, bisect_right
+
+
+def encode_cursor(keyword: str, frequency: int) -> str:
+    """Encodes the last keyword of a result page as an opaque cursor for the next page."""
+    return base64.urlsafe_b64encode(json.dumps([frequency, keyword]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[int, str]:
+    """Decodes a cursor made by encode_cursor, raising a ValueError if it is malformed."""
+    try:
+        frequency, keyword = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, UnicodeError) as error:
+        raise ValueError("The cursor is malformed.") from error
+    if not isinstance(frequency, int) or not isinstance(keyword, str):
+        raise ValueError("The cursor is malformed.")
+    return frequency, keyword
+
+
+class KeywordIndex:
+    """Keywords sorted alphabetically for prefix searches, together with their frequencies for ranking the matches.
+    Matches are ranked from the most to the least frequent keyword, and alphabetically among keywords with the same frequency.
+    """
+
+    def __init__(self, keywords: list[str], frequencies: list[int]):
+        order = sorted(range(len(keywords)), key=keywords.__getitem__)
+        self.keywords = [keywords[index] for index in order]
+        self.frequencies = np.array([frequencies[index] for index in order], dtype=np.int64).reshape(-1)
+
+    @classmethod
+    def from_database(cls, connection) -> "KeywordIndex":
+        """Loads the keywords with their total number of occurrences in the bodies and titles of all pages."""
+        rows = connection.execute('''
+            SELECT keywords.keyword, COALESCE(forward_index.keyword_count, 0) + COALESCE(title_forward_index.keyword_count, 0)
+            FROM keywords
+            LEFT JOIN forward_index ON forward_index.keyword_id = keywords.keyword_id
+            LEFT JOIN title_forward_index ON title_forward_index.keyword_id = keywords.keyword_id;
+        ''').fetchall()
+        return cls([keyword for keyword, _ in rows], [frequency for _, frequency in rows])
+
+    def __len__(self) -> int:
+        return len(self.keywords)
+
+    def _matches(self, prefix: str, after: tuple[int, str] = None) -> tuple[np.ndarray, int]:
+        """Returns the positions of the keywords starting with the prefix that rank after the cursor, and the number of keywords starting with the prefix."""
+        start = bisect_left(self.keywords, prefix)
+        end = bisect_left(self.keywords, prefix[:-1] + chr(ord(prefix[-1]) + 1)) if prefix else len(self.keywords)
+        positions = np.arange(start, end)
+        if after is not None:
+            frequency, keyword = after
+            frequencies = self.frequencies[start:end]
+            positions = positions[(frequencies < frequency) | ((frequencies == frequency) & (positions >= bisect_right(self.keywords, keyword)))]
+        return positions, end - start
+
+    def _rank(self, positions: np.ndarray, limit: int = None) -> np.ndarray:
+        """Sorts the positions by rank, keeping only the first limit positions if a limit is given."""
+        # Positions are alphabetical, so a single key orders by decreasing frequency and then alphabetically
+        keys = (self.frequencies.max(initial=0) - self.frequencies[positions]) * (len(self.keywords) + 1) + positions
+        if limit is not None and limit < len(positions):
+            selected = np.argpartition(keys, limit)[:limit]
+            positions, keys = positions[selected], keys[selected]
+        return positions[np.argsort(keys)]
+
+    def search(self, prefix: str, limit: int, after: tuple[int, str] = None) -> tuple[list[tuple[str, int]], int, bool]:
+        """Returns a page of the keywords starting with the prefix.
+
+        Args:
+            prefix (str): The start of the keywords.
+            limit (int): The maximum number of keywords returned.
+            after (tuple[int, str], optional): The frequency and keyword of the last keyword of the previous page. Defaults to the first page.
+
+        Returns:
+            matches (list[tuple[str, int]]): The keywords of the page with their frequencies.
+            total (int): The number of keywords starting with the prefix.
+            has_more (bool): Whether more keywords follow the page.
+        """
+        positions, total = self._matches(prefix, after)
+        page = self._rank(positions, limit)
+        return [(self.keywords[position], int(self.frequencies[position])) for position in page.tolist()], total, len(positions) > len(page)
+
+    def iterate(self, prefix: str = "", after: tuple[int, str] = None):
+        """Yields all keywords starting with the prefix that rank after the cursor, with their frequencies."""
+        positions, _ = self._matches(prefix, after)
+        for position in self._rank(positions).tolist():
+            yield self.keywords[position], int(self.frequencies[position])
@@ -0,0 +1,385 @@
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+import numpy as np
+from zlib import crc32
+from contextlib import redirect_stdout
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from storage import bulk_load
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+# Defaults of the synthetic corpus
+PAGES = 1000
+VOCABULARY = 5000
+WORDS_PER_PAGE = 300
+LINKS_PER_PAGE = 8
+# Fraction of the pages that are mirrors or near-duplicates of another page
+DUPLICATE_FRACTION = 0.0
+# Word frequencies follow Zipf's law, the frequency of the word of rank r is proportional to 1 / r ** ZIPF_EXPONENT
+ZIPF_EXPONENT = 1.1
+# Syllables the words of the vocabulary are made of
+SYLLABLES = ["ba", "ko", "ti", "ru", "me", "na", "lo", "pi", "su", "de", "ga", "fe", "mor", "tal", "ven", "dus"]
+# Defaults of the workload
+QUERIES = 200
+CHANGED_FRACTION = 0.1
+SEED = 4321
+# Number of results per page of the paged search workloads
+PAGE_SIZE = 10
+# Latency percentiles reported for every query workload
+PERCENTILES = (50, 95, 99)
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_vocabulary(size: int, rng: np.random.Generator) -> list[str]:
+    """Returns distinct lowercase words made of random syllables, leaving out the stopwords."""
+    with open(os.path.join(REPOSITORY, 'stopwords.txt'), 'r') as file:
+        stopwords = set(file.read().split())
+    words = {}
+    while len(words) < size:
+        word = "".join(rng.choice(SYLLABLES, rng.integers(2, 5)))
+        if word not in stopwords:
+            words.setdefault(word, None)
+    return list(words)
+
+
+def generate_corpus(pages: int = PAGES, vocabulary: int = VOCABULARY, words_per_page: int = WORDS_PER_PAGE, links_per_page: int = LINKS_PER_PAGE, seed: int = SEED, duplicate_fraction: float = DUPLICATE_FRACTION) -> tuple[list[str], list[dict]]:
+    """Generates a synthetic linked corpus. Every page links to the next page, so all pages are reachable from the first one.
+
+    Args:
+        pages (int, optional): The number of pages. Defaults to PAGES.
+        vocabulary (int, optional): The number of distinct words. Defaults to VOCABULARY.
+        words_per_page (int, optional): The mean number of words of a page body. Defaults to WORDS_PER_PAGE.
+        links_per_page (int, optional): The mean number of links of a page, including the link to the next page. Defaults to LINKS_PER_PAGE.
+        seed (int, optional): The seed of the random generator. Defaults to SEED.
+        duplicate_fraction (float, optional): The fraction of pages copying the title, body and links of an earlier page, half of them with one word changed. Defaults to DUPLICATE_FRACTION.
+
+    Returns:
+        words (list[str]): The vocabulary, from the most to the least frequent word.
+        corpus (list[dict]): The title, body words and linked page numbers of each page.
+    """
+    rng = np.random.default_rng(seed)
+    words = make_vocabulary(vocabulary, rng)
+    probabilities = 1 / np.arange(1, len(words) + 1) ** ZIPF_EXPONENT
+    probabilities /= probabilities.sum()
+    corpus = []
+    for number in range(pages):
+        links = [(number + 1) % pages] + rng.integers(0, pages, max(0, rng.poisson(links_per_page) - 1)).tolist()
+        if number > 0 and rng.random() < duplicate_fraction:
+            original = corpus[rng.integers(number)]
+            body = list(original["body"])
+            if rng.random() < 0.5:
+                body[rng.integers(len(body))] = words[rng.integers(len(words))]
+            # Mirrors link to the same pages, apart from the link that keeps the next page reachable
+            corpus.append({"title": original["title"], "body": body, "links": links[:1] + original["links"][1:]})
+            continue
+        body = rng.choice(len(words), max(1, rng.poisson(words_per_page)), p=probabilities)
+        title = rng.choice(len(words), rng.integers(1, 6), p=probabilities)
+        corpus.append({"title": [words[word] for word in title], "body": [words[word] for word in body], "links": links})
+    return words, corpus
+
+
+def render_page(page: dict) -> bytes:
+    """Returns the HTML document of a synthetic page, with its body split into paragraphs between the links."""
+    paragraphs = [" ".join(page["body"][start:start + 50]) for start in range(0, len(page["body"]), 50)]
+    anchors = [f'<a href="{link}.htm">page {link}</a>' for link in page["links"]]
+    content = "\n".join(f"<p>{paragraph}</p>" for paragraph in paragraphs) + "\n" + "\n".join(f"<li>{anchor}</li>" for anchor in anchors)
+    return f"<html><head><title>{' '.join(page['title'])}</title></head><body>\n{content}\n</body></html>".encode()
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    """Serves the documents of a SyntheticSite and answers conditional requests with 304 Not Modified."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.respond(with_body=True)
+
+    def do_HEAD(self):
+        self.respond(with_body=False)
+
+    def respond(self, with_body: bool) -> None:
+        site = self.server.site
+        document = site.documents.get(self.path)
+        if document is None:
+            site.count(404)
+            self.send_error(404)
+            return
+        body, etag, last_modified, timestamp = document
+        if self.headers.get("If-None-Match"):
+            unmodified = self.headers["If-None-Match"] == etag
+        else:
+            try:
+                unmodified = parsedate_to_datetime(self.headers["If-Modified-Since"]).timestamp() >= timestamp
+            except (TypeError, ValueError):
+                unmodified = False
+        site.count(304 if unmodified else 200)
+        self.send_response(304 if unmodified else 200)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        if not unmodified:
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if with_body and not unmodified:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SyntheticSite:
+    """Serves a synthetic corpus from a local HTTP server with ETag and Last-Modified headers, and counts the responses by status."""
+
+    def __init__(self, corpus: list[dict]):
+        self.documents = {} # {path: (body, ETag, Last-Modified header, last modification timestamp)}
+        self.responses = {} # {status: count}
+        self._lock = threading.Lock()
+        modified = int(time.time()) - 3600
+        for number, page in enumerate(corpus):
+            self.update(number, page, modified)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), SiteHandler)
+        self.server.daemon_threads = True
+        self.server.site = self
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self) -> "SyntheticSite":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, number: int) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/pages/{number}.htm"
+
+    def update(self, number: int, page: dict, modified: int) -> None:
+        """Publishes a new version of a page, last modified at the given timestamp."""
+        body = render_page(page)
+        self.documents[f"/pages/{number}.htm"] = (body, f'"{crc32(body):08x}"', formatdate(modified, usegmt=True), modified)
+
+    def count(self, status: int) -> None:
+        with self._lock:
+            self.responses[status] = self.responses.get(status, 0) + 1
+
+    def take_responses(self) -> dict[int, int]:
+        """Returns the response counts since the last call and resets them."""
+        with self._lock:
+            responses, self.responses = self.responses, {}
+        return responses
+
+
+def peak_rss_mb() -> float | None:
+    """Returns the peak resident set size of the process so far in megabytes, or None if it cannot be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def file_size(path: str) -> int:
+    """Returns the size of a file in bytes, including its write-ahead log, or 0 if it does not exist."""
+    return sum(os.path.getsize(name) for name in (path, f"{path}-wal") if os.path.exists(name))
+
+
+def make_queries(words: list[str], corpus: list[dict], count: int = QUERIES, seed: int = SEED) -> list[str]:
+    """Generates a query workload: single words, word combinations and quoted phrases taken from the page bodies.
+    Words are drawn uniformly from the more frequent half of the vocabulary, so that most queries have results.
+    """
+    rng = np.random.default_rng(seed + 1)
+    common = words[:max(1, len(words) // 2)]
+    queries = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.4:
+            queries.append(str(rng.choice(common)))
+        elif kind < 0.8:
+            queries.append(" ".join(rng.choice(common, rng.integers(2, 5))))
+        else:
+            body = corpus[rng.integers(len(corpus))]["body"]
+            start = rng.integers(max(1, len(body) - 1))
+            queries.append('"' + " ".join(body[start:start + 2]) + '"')
+    return queries
+
+
+def latencies(run, queries: list[str], before=None) -> dict:
+    """Runs every query once and returns latency statistics in milliseconds.
+
+    Args:
+        run: Called with each query, the call is timed.
+        queries (list[str]): The workload.
+        before (optional): Called before each query without being timed, such as to clear caches. Defaults to None.
+    """
+    times = []
+    for query in queries:
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        run(query)
+        times.append((time.perf_counter() - start) * 1000)
+    times = np.array(times)
+    statistics = {f"p{percentile}_ms": round(float(np.percentile(times, percentile)), 3) for percentile in PERCENTILES}
+    statistics.update({"mean_ms": round(float(times.mean()), 3), "max_ms": round(float(times.max()), 3), "queries": len(times), "qps": round(len(times) / (times.sum() / 1000), 1)})
+    return statistics
+
+
+def measure_crawl(spider, site: SyntheticSite, workers: int, host_delay: float, parse_processes: int) -> dict:
+    """Crawls the site from its first page and returns the crawl throughput."""
+    site.take_responses()
+    start = time.perf_counter()
+    # The spider prints its progress, which must not end up in the JSON report
+    with redirect_stdout(sys.stderr):
+        spider.recursively_crawl(site.url(0), workers, spider.HostLimiter(workers, host_delay), parse_processes=parse_processes)
+    elapsed = time.perf_counter() - start
+    responses = site.take_responses()
+    fetched = responses.get(200, 0) + responses.get(304, 0)
+    return {
+        "aliases": spider.cursor.execute('SELECT COUNT(*) FROM page_aliases').fetchone()[0],
+        "seconds": round(elapsed, 3),
+        "pages": fetched,
+        "downloaded": responses.get(200, 0),
+        "unmodified": responses.get(304, 0),
+        "pages_per_sec": round(fetched / elapsed, 1) if elapsed else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def measure_index(indexer, connection, full: bool, processes: int, shards: int = 1) -> dict:
+    """Builds or updates the indexes and returns the time spent in each stage."""
+    timings = {}
+    start = time.perf_counter()
+    with redirect_stdout(sys.stderr):
+        with bulk_load(connection, defer_indexes=full):
+            indexer.index_pages(connection.cursor(), full, processes=processes, timings=timings, shards=shards)
+    return {
+        "seconds": round(time.perf_counter() - start, 3),
+        "stages": {stage: round(seconds, 3) for stage, seconds in timings.items()},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run(args) -> dict:
+    """Runs the benchmark in the current directory and returns the report."""
+    words, corpus = generate_corpus(args.pages, args.vocabulary, args.words_per_page, args.links_per_page, args.seed, args.duplicate_fraction)
+    queries = make_queries(words, corpus, args.queries, args.seed)
+    # The modules open database.db, stopwords.txt and index.snapshot in the current directory when they are imported
+    import spider, indexer
+    for name in ('database.db', 'index.snapshot'):
+        if os.path.exists(name):
+            os.remove(name)
+    report = {
+        "config": {name: value for name, value in vars(args).items() if name not in ("output", "workdir", "keep")},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "corpus": {"pages": len(corpus), "vocabulary": len(words), "words": sum(len(page["body"]) for page in corpus), "links": sum(len(page["links"]) for page in corpus)},
+    }
+    connection = sqlite3.connect('database.db')
+    spider.connection, spider.cursor = connection, connection.cursor()
+    spider.init_db()
+    with SyntheticSite(corpus) as site:
+        with bulk_load(connection, defer_indexes=False):
+            report["crawl"] = measure_crawl(spider, site, args.workers, args.host_delay, args.parse_processes)
+        report["index"] = measure_index(indexer, connection, True, args.processes, args.shards)
+
+        # Publish new versions of some pages, and recrawl and reindex incrementally
+        rng = np.random.default_rng(args.seed + 2)
+        changed = rng.choice(len(corpus), int(len(corpus) * args.changed_fraction), replace=False).tolist()
+        for number in changed:
+            corpus[number]["body"] = corpus[number]["body"][::-1]
+            site.update(number, corpus[number], int(time.time()))
+        with bulk_load(connection, defer_indexes=False):
+            report["recrawl"] = measure_crawl(spider, site, args.workers, args.host_delay, args.parse_processes)
+        report["reindex"] = measure_index(indexer, connection, False, args.processes, args.shards)
+    connection.close()
+    report["sizes"] = {"database_bytes": file_size('database.db'), "snapshot_bytes": file_size('index.snapshot')}
+
+    # The search engine loads the snapshot written by the last indexer run
+    import retrieval, app
+    client = app.app.test_client()
+
+    def clear_caches():
+        retrieval.resultCache.clear()
+        app.result_cache.clear()
+
+    def search(query, **fields):
+        response = client.post("/search", json={"searchbar": query, **fields})
+        if response.status_code != 200:
+            raise RuntimeError(f"/search returned {response.status_code} for {query!r}")
+        return response.get_json()
+
+    # Related document queries pair each query with a random indexed page
+    page_ids = retrieval.currentIndex().docIds.tolist()
+    rng = np.random.default_rng(args.seed + 3)
+    related = [(query, page_ids[rng.integers(len(page_ids))]) for query in queries] if page_ids else []
+    report["queries"] = {
+        "search_engine": latencies(retrieval.search_engine, queries, clear_caches),
+        "search_engine_related": latencies(lambda pair: retrieval.search_engine(*pair), related, clear_caches),
+        "similar_pages": latencies(lambda pair: retrieval.similarPages(pair[1]), related),
+        "search_endpoint": latencies(search, queries, clear_caches),
+        "search_endpoint_cached": latencies(search, queries),
+        "search_endpoint_first_page": latencies(lambda query: search(query, page_size=PAGE_SIZE), queries, clear_caches),
+    }
+    # The second pages are fetched with the rankings of the first pages kept, but without their hydrated results
+    clear_caches()
+    cursors = [(query, search(query, page_size=PAGE_SIZE)["next_cursor"]) for query in queries]
+    report["queries"]["search_endpoint_next_page"] = latencies(lambda pair: search(pair[0], page_size=PAGE_SIZE, cursor=pair[1]), [pair for pair in cursors if pair[1]], app.result_cache.clear)
+    if args.shards > 1:
+        import shards
+        clients = shards.start_local(args.shards)
+        try:
+            report["queries"]["search_engine_sharded"] = latencies(retrieval.search_engine, queries, clear_caches)
+        finally:
+            clients.close()
+            retrieval.shardClients = None
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Crawls, indexes and searches a synthetic website served locally, and prints the measurements as JSON.")
+    arg_parser.add_argument("--pages", type=int, default=PAGES, help="Number of pages of the synthetic website.")
+    arg_parser.add_argument("--vocabulary", type=int, default=VOCABULARY, help="Number of distinct words.")
+    arg_parser.add_argument("--words-per-page", type=int, default=WORDS_PER_PAGE, help="Mean number of words of a page body.")
+    arg_parser.add_argument("--links-per-page", type=int, default=LINKS_PER_PAGE, help="Mean number of links of a page.")
+    arg_parser.add_argument("--duplicate-fraction", type=float, default=DUPLICATE_FRACTION, help="Fraction of the pages that are mirrors or near-duplicates of another page.")
+    arg_parser.add_argument("--queries", type=int, default=QUERIES, help="Number of queries of the query workload.")
+    arg_parser.add_argument("--changed-fraction", type=float, default=CHANGED_FRACTION, help="Fraction of the pages changed before the recrawl.")
+    arg_parser.add_argument("--seed", type=int, default=SEED, help="Seed of the corpus and the query workload.")
+    arg_parser.add_argument("--workers", type=int, default=8, help="Number of pages fetched concurrently.")
+    arg_parser.add_argument("--host-delay", type=float, default=0.0, help="Minimum seconds between requests to the synthetic website.")
+    arg_parser.add_argument("--parse-processes", type=int, default=os.cpu_count() or 1, help="Number of processes extracting the fetched pages in the spider, 0 to extract them in the fetching threads.")
+    arg_parser.add_argument("--processes", type=int, default=1, help="Number of processes analyzing the pages in the indexer.")
+    arg_parser.add_argument("--shards", type=int, default=1, help="Number of index shards, searched by local shard workers in an extra query phase if more than 1.")
+    arg_parser.add_argument("--workdir", default=None, help="Directory of the database and snapshot. Defaults to a temporary directory.")
+    arg_parser.add_argument("--keep", action="store_true", help="Keep the temporary directory after the run.")
+    arg_parser.add_argument("--output", default=None, help="File the JSON report is written to. Defaults to standard output.")
+    args = arg_parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="comp4321-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    shutil.copy(os.path.join(REPOSITORY, 'stopwords.txt'), workdir)
+    os.chdir(workdir)
+    try:
+        report = run(args)
+    finally:
+        os.chdir(REPOSITORY)
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,77 @@
+import time
+import threading
+from collections import OrderedDict
+
+# Default maximum number of cached queries
+CACHE_SIZE = 1024
+# Default number of seconds after which a cached query expires
+CACHE_TTL = 300.0
+
+
+class QueryCache:
+    """Bounded least-recently-used cache whose entries expire after a time to live.
+    Every entry belongs to an index generation, and all entries are dropped once another generation is seen.
+    """
+
+    def __init__(self, max_entries: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict() # {key: (expiry time, value)}, least recently used first
+        self.generation = None
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def _use_generation(self, generation: int) -> None:
+        if generation != self.generation:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.generation = generation
+
+    def get(self, key, generation: int, default=None):
+        """Returns the value cached for the key in the index generation, or default if there is none."""
+        with self.lock:
+            self._use_generation(generation)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, generation: int) -> None:
+        """Caches the value of the key for the index generation, evicting the least recently used entries beyond the size limit."""
+        with self.lock:
+            self._use_generation(generation)
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Drops all entries."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        """Returns the size, generation and hit, miss, eviction, expiration and invalidation counts of the cache."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "generation": self.generation,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,121 @@
+import hashlib
+import numpy as np
+from functools import lru_cache
+
+# Number of consecutive words hashed together into one feature of a SimHash
+SHINGLE_SIZE = 3
+# Maximum number of differing SimHash bits of two near-duplicate pages
+# Changing one word of a page of a few hundred words changes up to about 5 bits, unrelated pages differ in about 32 bits
+MAX_DISTANCE = 5
+# Number of bands of about equal width the 64-bit SimHashes are split into for lookups
+# SimHashes differing in at most MAX_DISTANCE bits have at least one equal band, since the differing bits fall into at most MAX_DISTANCE bands
+BANDS = MAX_DISTANCE + 1
+BAND_STARTS = [64 * band // BANDS for band in range(BANDS + 1)]
+# Minimum number of words of a page body for a SimHash, shorter pages are only matched by their exact hash
+MIN_WORDS = 20
+# Multipliers of the splitmix64 finalizer mixing the shingle hashes
+MIX_MULTIPLIERS = (np.uint64(0xBF58476D1CE4E5B9), np.uint64(0x94D049BB133111EB))
+
+
+def content_hash(clean_title: str, clean_body: str) -> int:
+    """Returns a signed 64-bit hash of the cleaned title and body of a page, equal for exact duplicates."""
+    digest = hashlib.blake2b(f"{clean_title}\n{clean_body}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+@lru_cache(maxsize=65536)
+def word_hash(word: str) -> int:
+    return int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "little")
+
+
+def mix(hashes: np.ndarray) -> np.ndarray:
+    """Scrambles 64-bit hashes with the splitmix64 finalizer, so that every input bit affects every output bit."""
+    hashes = hashes ^ (hashes >> np.uint64(30))
+    hashes = hashes * MIX_MULTIPLIERS[0]
+    hashes = hashes ^ (hashes >> np.uint64(27))
+    hashes = hashes * MIX_MULTIPLIERS[1]
+    return hashes ^ (hashes >> np.uint64(31))
+
+
+def simhash(clean_body: str) -> int | None:
+    """Returns the signed 64-bit SimHash of the word shingles of a cleaned page body, or None if the body is shorter than MIN_WORDS words.
+    Each bit is set if it is set in the hashes of more than half of the shingles, so similar bodies have SimHashes differing in few bits.
+    """
+    words = clean_body.split()
+    if len(words) < MIN_WORDS:
+        return None
+    hashes = np.array([word_hash(word) for word in words], dtype=np.uint64)
+    # The hash of a shingle mixes in the hashes of its words one after the other, so that the word order matters
+    shingles = np.zeros(len(words) - SHINGLE_SIZE + 1, dtype=np.uint64)
+    for offset in range(SHINGLE_SIZE):
+        shingles = mix(shingles ^ hashes[offset:offset + len(shingles)])
+    bits = np.unpackbits(shingles.view(np.uint8)).reshape(-1, 64)
+    majority = bits.sum(axis=0, dtype=np.int64) * 2 > len(shingles)
+    return int(np.packbits(majority).view(np.int64)[0])
+
+
+def distance(first: int, second: int) -> int:
+    """Returns the number of differing bits of two 64-bit SimHashes."""
+    return ((first ^ second) & 0xFFFFFFFFFFFFFFFF).bit_count()
+
+
+def band_values(page_simhash: int) -> list[int]:
+    """Splits a SimHash into its BANDS bands."""
+    return [(page_simhash >> start) & ((1 << (end - start)) - 1) for start, end in zip(BAND_STARTS, BAND_STARTS[1:])]
+
+
+class FingerprintIndex:
+    """Finds the canonical page of a duplicate page by its content hash, or of a near-duplicate page by its SimHash.
+    The SimHashes are indexed by their bands, so a lookup only compares the SimHashes sharing a band with the page.
+    """
+
+    def __init__(self, rows=()):
+        """
+        Args:
+            rows (optional): The (page ID, content hash, SimHash or None) rows of the canonical pages. Defaults to none.
+        """
+        self.exact = {} # {content hash: page ID}
+        self.bands = [{} for _ in range(BANDS)] # {band value: set of page IDs} for each band
+        self.fingerprints = {} # {page ID: (content hash, SimHash)}
+        for page_id, page_hash, page_simhash in rows:
+            self.add(page_id, page_hash, page_simhash)
+
+    def __len__(self) -> int:
+        return len(self.fingerprints)
+
+    def add(self, page_id: int, page_hash: int, page_simhash: int | None) -> None:
+        """Indexes the fingerprints of a canonical page, replacing its previous fingerprints."""
+        self.remove(page_id)
+        self.fingerprints[page_id] = (page_hash, page_simhash)
+        self.exact.setdefault(page_hash, page_id)
+        if page_simhash is not None:
+            for buckets, value in zip(self.bands, band_values(page_simhash)):
+                buckets.setdefault(value, set()).add(page_id)
+
+    def remove(self, page_id: int) -> None:
+        """Removes the fingerprints of a page if it is indexed."""
+        fingerprints = self.fingerprints.pop(page_id, None)
+        if fingerprints is None:
+            return
+        page_hash, page_simhash = fingerprints
+        if self.exact.get(page_hash) == page_id:
+            del self.exact[page_hash]
+        if page_simhash is not None:
+            for buckets, value in zip(self.bands, band_values(page_simhash)):
+                buckets[value].discard(page_id)
+                if not buckets[value]:
+                    del buckets[value]
+
+    def find(self, page_hash: int, page_simhash: int | None) -> int | None:
+        """Returns the ID of a canonical page with the same content or a SimHash within MAX_DISTANCE bits, or None if there is none.
+        Among several near-duplicates, the closest one is returned.
+        """
+        if page_hash in self.exact:
+            return self.exact[page_hash]
+        if page_simhash is None:
+            return None
+        candidates = set()
+        for buckets, value in zip(self.bands, band_values(page_simhash)):
+            candidates |= buckets.get(value, set())
+        closest = min(((distance(page_simhash, self.fingerprints[page_id][1]), page_id) for page_id in candidates), default=None)
+        return closest[1] if closest is not None and closest[0] <= MAX_DISTANCE else None
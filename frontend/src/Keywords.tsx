@@ -2,10 +2,28 @@ import Layout from "./Layout"
 import { useEffect, useState } from "react"
 import KeywordSection from "./KeywordSection"
 import KeywordButton from "./KeywordButton"
-import { Button } from "@mantine/core"
+import { Button, TextInput } from "@mantine/core"
 import { useNavigate } from "react-router-dom"
 
 const alphabet = "abcdefghijklmnopqrstuvwxyz"
+const pageSize = 200
+
+type KeywordPage = {
+  keywords: string[]
+  total: number
+  next_cursor: string | null
+}
+
+const fetchKeywords = async (
+  prefix: string,
+  cursor: string | null,
+  signal?: AbortSignal
+): Promise<KeywordPage> => {
+  const params = new URLSearchParams({ prefix, limit: String(pageSize) })
+  if (cursor) params.set("cursor", cursor)
+  const res = await fetch(`http://localhost:5000/keywords?${params}`, { signal })
+  return res.json()
+}
 
 const groupByFirstLetter = (keywords: string[]): Record<string, string[]> => {
   return keywords.reduce((acc, keyword) => {
@@ -19,23 +37,38 @@ const groupByFirstLetter = (keywords: string[]): Record<string, string[]> => {
 }
 
 const Keywords = () => {
-  const [keywords, setKeywords] = useState<Record<string, string[]>>({}) // Grouped by starting letter
+  const [prefix, setPrefix] = useState<string>("")
+  const [loadedKeywords, setLoadedKeywords] = useState<string[]>([]) // Most frequent first
   const [keywordCount, setKeywordCount] = useState<number>(0)
+  const [nextCursor, setNextCursor] = useState<string | null>(null)
   const [selectedKeywords, setSelectedKeywords] = useState<string[]>([])
   const navigate = useNavigate()
+  const keywords = groupByFirstLetter(loadedKeywords) // Grouped by starting letter
 
+  // Load the first page of keywords whenever the prefix changes
   useEffect(() => {
-    try {
-      fetch("http://localhost:5000/keywords")
-        .then((res) => res.json())
-        .then((data) => {
-          setKeywordCount(data.length)
-          setKeywords(groupByFirstLetter(data))
-        })
-    } catch (error) {
-      console.error("Error fetching keywords:", error)
-    }
-  }, [])
+    const controller = new AbortController()
+    fetchKeywords(prefix.trim().toLowerCase(), null, controller.signal)
+      .then((data) => {
+        setLoadedKeywords(data.keywords)
+        setKeywordCount(data.total)
+        setNextCursor(data.next_cursor)
+      })
+      .catch((error) => {
+        if (error.name !== "AbortError") console.error("Error fetching keywords:", error)
+      })
+    return () => controller.abort()
+  }, [prefix])
+
+  const handleLoadMore = () => {
+    if (!nextCursor) return
+    fetchKeywords(prefix.trim().toLowerCase(), nextCursor)
+      .then((data) => {
+        setLoadedKeywords([...loadedKeywords, ...data.keywords])
+        setNextCursor(data.next_cursor)
+      })
+      .catch((error) => console.error("Error fetching keywords:", error))
+  }
 
   const handleKeywordClick = (keyword: string) => {
     if (selectedKeywords.includes(keyword)) {
@@ -57,7 +90,17 @@ const Keywords = () => {
         <span className="text-[20px]">
           Select keywords below to search for documents
         </span>
-        <span className="text-[14px]">Indexed {keywordCount} keywords</span>
+        <span className="text-[14px]">
+          {prefix.trim()
+            ? `${keywordCount} keywords start with "${prefix.trim()}"`
+            : `Indexed ${keywordCount} keywords`}
+        </span>
+        <TextInput
+          className="w-[400px]"
+          placeholder="Type the start of a keyword"
+          value={prefix}
+          onChange={(event) => setPrefix(event.currentTarget.value)}
+        />
       </div>
 
       {selectedKeywords.length > 0 ? (
@@ -96,6 +139,12 @@ const Keywords = () => {
           />
         )
       })}
+
+      {nextCursor && (
+        <Button variant="light" onClick={handleLoadMore}>
+          Load more keywords
+        </Button>
+      )}
     </Layout>
   )
 }
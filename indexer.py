@@ -1,220 +1,547 @@
-from nltk.stem import PorterStemmer as Stemmer
 import numpy as np
 import sqlite3
-from utils import encode_string
+import argparse
+import time
+from utils import encode_string, encode_positions, tfidf_weights, top_per_group, expand_ranges
+from analyzer import stem_words, analyze_pages
+from storage import BatchWriter, BATCH_SIZE, bulk_load, chunked
+from snapshot import SNAPSHOT_PATH, VECTOR_TERMS, build_snapshot, write_snapshot, next_generation, shard_path
 from collections import Counter
+from itertools import groupby
+from contextlib import contextmanager
+import metrics
 import spacy
 
-ps = Stemmer()
-stopwords = open('stopwords.txt', 'r').read().split()
+# (inverted index, forward index) table pairs for the bodies and the titles
+INDEX_TABLES = (("inverted_index", "forward_index"), ("title_inverted_index", "title_forward_index"))
+# Number of most frequent keywords stored per page for the search results
+PAGE_KEYWORDS = 10
+# Number of most similar pages stored per page
+PAGE_NEIGHBORS = 20
+# Keywords in the truncated vectors of more pages than this are too common to tell pages apart, and are ignored when comparing pages
+NEIGHBOR_KEYWORD_LIMIT = 500
+# Number of pages whose similar pages are computed at a time
+NEIGHBOR_BATCH_PAGES = 256
+# Probability of following a link in PageRank
+DAMPING = 0.85
+# Average change of a page's rank below which PageRank stops
+PAGE_RANK_TOLERANCE = 1e-6
+# spaCy components that named entity recognition does not need
+PHRASE_EXCLUDED_COMPONENTS = ["tagger", "parser", "attribute_ruler", "lemmatizer", "senter"]
+# Number of texts spaCy processes at a time
+PHRASE_BATCH_SIZE = 64
+# Maximum number of words of a text given to spaCy
+PHRASE_CHUNK_WORDS = 10000
+# Metrics of the indexer, written to a file with --metrics-file
+index_stages = metrics.Histogram("index_stage_seconds", "Seconds spent in each stage of an indexer run.", ["stage"])
+pages_indexed = metrics.Counter("index_pages_analyzed_total", "Pages tokenized and stemmed by the indexer.")
+postings_written = metrics.Counter("index_postings_written_total", "Postings written to the inverted indexes.", ["field"])
 
 
-def stem_words(words: list[str]) -> list[str]:
-    """Stems the words using the Porter Stemmer algorithm."""
-    return [ps.stem(word) for word in words]
+def load_link_graph(cursor) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Loads the links between crawled pages as sparse edge arrays in coordinate format.
+    Links from and to an alias count as links of its canonical page, but the links between an alias and its canonical page are dropped.
+    Duplicate links and links to pages that were not crawled are dropped.
 
+    Returns:
+        page_ids (np.ndarray): The sorted IDs of all pages.
+        sources (np.ndarray): The index in page_ids of the parent of each link.
+        targets (np.ndarray): The index in page_ids of the child of each link.
+    """
+    page_ids = np.array(sorted(page_id for page_id, in cursor.execute('SELECT page_id FROM pages').fetchall()), dtype=np.int64)
+    edges = np.array(cursor.execute('SELECT parent_id, child_id FROM parent_child').fetchall(), dtype=np.int64).reshape(-1, 2)
+    if len(page_ids) == 0 or len(edges) == 0:
+        return page_ids, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    aliases = np.array(cursor.execute('SELECT page_id, canonical_id FROM page_aliases ORDER BY page_id').fetchall(), dtype=np.int64).reshape(-1, 2)
+    pages = edges
+    if len(aliases) > 0:
+        rows = np.minimum(np.searchsorted(aliases[:, 0], edges), len(aliases) - 1)
+        pages = np.where(aliases[rows, 0] == edges, aliases[rows, 1], edges)
+    sources = np.minimum(np.searchsorted(page_ids, pages[:, 0]), len(page_ids) - 1)
+    targets = np.minimum(np.searchsorted(page_ids, pages[:, 1]), len(page_ids) - 1)
+    known = (page_ids[sources] == pages[:, 0]) & (page_ids[targets] == pages[:, 1])
+    # Links of a page to itself are kept, links between different URLs of the same page are not
+    known &= (sources != targets) | (edges[:, 0] == edges[:, 1])
+    unique_edges = np.unique(sources[known] * len(page_ids) + targets[known])
+    return page_ids, unique_edges // len(page_ids), unique_edges % len(page_ids)
+
+
+def select_pages(cursor, page_ids: list[int] = None):
+    """Yields the ID, body and title of the pages, or of all pages if no IDs are given."""
+    if page_ids is None:
+        yield from cursor.connection.execute('SELECT page_id, clean_body, clean_title FROM pages')
+        return
+    for chunk in chunked(page_ids):
+        yield from cursor.execute(f'SELECT page_id, clean_body, clean_title FROM pages WHERE page_id IN ({",".join("?" for _ in chunk)})', chunk).fetchall()
 
-def remove_stop_words(words: list[str]) -> list[str]:
-    """Removes stopwords from the list of words."""
-    return [word for word in words if word not in stopwords]
 
+def update_forward_index(cursor, table: str, deltas: Counter, batch_size: int = BATCH_SIZE) -> None:
+    """Adds the keyword count deltas to a forward index.
+    Keywords missing from the index are inserted, and keywords whose count drops to zero are removed.
 
-def generate_adjacency_matrix(all_pages: list[int]) -> np.ndarray:
-    """Generates an adjacency matrix from the list of all pages.
-    
     Args:
-        all_pages (list[int]): List of all page IDs.
+        table (str): The forward index table.
+        deltas (Counter): Keyword ID -> Change of the keyword count.
     """
-    matrixMap = {key: {val: 0 for val in all_pages} for key in all_pages}
-    for page in all_pages:
-        children = cursor.execute(f'SELECT child_id FROM parent_child WHERE parent_id = {page}').fetchall()
-        for child in children:
-            matrixMap[page][child[0]] = 1
-    return np.array([[val for val in matrixMap[key].values()] for key in matrixMap.keys()]).T
-
-
-def insert_single_keywords(cursor) -> None:
-    """Inserts single keywords into the database."""
-    all_pages = cursor.execute('SELECT page_id FROM pages').fetchall()
-    body_keywords = {} # Word ID -> Frequency
-    title_keywords = {} # Word ID -> Frequency
-    for page in all_pages:
-        body, title = cursor.execute(f'SELECT clean_body, clean_title FROM pages WHERE page_id = {page[0]}').fetchone()
-        body = stem_words(remove_stop_words(body.split()))
-        title = stem_words(remove_stop_words(title.split()))
-        for word in body:
-            word_id = encode_string(word)
-            if word_id not in body_keywords:
-                body_keywords[word_id] = 1
-            else:
-                body_keywords[word_id] += 1
-        for word in title:
-            word_id = encode_string(word)
-            if word_id not in title_keywords:
-                title_keywords[word_id] = 1
-            else:
-                title_keywords[word_id] += 1
-        all_words = set(body + title)
-        for word in all_words:
-            cursor.execute(f'''
-                INSERT OR IGNORE INTO keywords (keyword_id, keyword)
-                VALUES ({encode_string(word)}, '{word}');
-            ''')
-        for word, count in Counter(body).items():
-            cursor.execute(f'''
-                INSERT INTO inverted_index (page_id, keyword_id, keyword_count)
-                VALUES ({page[0]}, {encode_string(word)}, {count});
-            ''')
-        for word, count in Counter(title).items():
-            cursor.execute(f'''
-                INSERT INTO title_inverted_index (page_id, keyword_id, keyword_count)
-                VALUES ({page[0]}, {encode_string(word)}, {count});
-            ''')
-    for word_id, count in body_keywords.items():
-        cursor.execute(f'''
-            INSERT INTO forward_index (keyword_id, keyword_count)
-            VALUES ({word_id}, {count});
-        ''')
-    for word_id, count in title_keywords.items():
+    existing = set()
+    for chunk in chunked(list(deltas)):
+        existing.update(keyword_id for keyword_id, in cursor.execute(f'SELECT keyword_id FROM {table} WHERE keyword_id IN ({",".join("?" for _ in chunk)})', chunk).fetchall())
+    with BatchWriter(cursor.connection, batch_size) as writer:
+        writer.executemany(f'''
+            UPDATE {table} SET keyword_count = keyword_count + ? WHERE keyword_id = ?;
+        ''', [(delta, keyword_id) for keyword_id, delta in deltas.items() if keyword_id in existing and delta])
+        writer.executemany(f'''
+            INSERT INTO {table} (keyword_id, keyword_count)
+            VALUES (?, ?);
+        ''', [(keyword_id, delta) for keyword_id, delta in deltas.items() if keyword_id not in existing and delta > 0])
+        writer.executemany(f'''
+            DELETE FROM {table} WHERE keyword_id = ? AND keyword_count <= 0;
+        ''', [(keyword_id,) for keyword_id, delta in deltas.items() if keyword_id in existing and delta < 0])
+
+
+def retract_pages(cursor, page_ids: list[int], batch_size: int = BATCH_SIZE) -> set[int]:
+    """Removes the postings of the pages and subtracts their keyword counts from the forward indexes.
+    Returns the IDs of the keywords whose counts decreased.
+    """
+    retracted = set()
+    for inverted_table, forward_table in INDEX_TABLES:
+        deltas = Counter() # Word ID -> Change of the frequency
+        for chunk in chunked(page_ids):
+            placeholders = ",".join("?" for _ in chunk)
+            for keyword_id, count in cursor.execute(f'SELECT keyword_id, keyword_count FROM {inverted_table} WHERE page_id IN ({placeholders})', chunk).fetchall():
+                deltas[keyword_id] -= count
+            cursor.execute(f'DELETE FROM {inverted_table} WHERE page_id IN ({placeholders})', chunk)
+        update_forward_index(cursor, forward_table, deltas, batch_size)
+        retracted.update(deltas)
+    return retracted
+
+
+def collect_garbage_keywords(cursor, keyword_ids: set[int]) -> None:
+    """Removes the keywords that are no longer used by any page."""
+    for chunk in chunked(list(keyword_ids)):
         cursor.execute(f'''
-            INSERT INTO title_forward_index (keyword_id, keyword_count)
-            VALUES ({word_id}, {count});
-        ''')
-    
-    connection.commit()
+            DELETE FROM keywords WHERE keyword_id IN ({",".join("?" for _ in chunk)})
+            AND NOT EXISTS (SELECT 1 FROM forward_index WHERE forward_index.keyword_id = keywords.keyword_id)
+            AND NOT EXISTS (SELECT 1 FROM title_forward_index WHERE title_forward_index.keyword_id = keywords.keyword_id);
+        ''', chunk)
+    cursor.connection.commit()
+
+
+def insert_single_keywords(cursor, page_ids: list[int] = None, batch_size: int = BATCH_SIZE, processes: int = 1) -> None:
+    """Inserts single keywords into the database, together with the positions of each keyword in the page.
+
+    Args:
+        page_ids (list[int], optional): The pages to index. Defaults to all pages.
+        batch_size (int, optional): The number of rows written per transaction. Defaults to BATCH_SIZE.
+        processes (int, optional): The number of processes tokenizing and stemming the pages. Defaults to 1.
+    """
+    body_keywords = Counter() # Word ID -> Frequency
+    title_keywords = Counter() # Word ID -> Frequency
+    with BatchWriter(cursor.connection, batch_size) as writer:
+        for page_id, body_positions, title_positions in analyze_pages(select_pages(cursor, page_ids), processes):
+            writer.executemany('''
+                INSERT OR IGNORE INTO keywords (keyword_id, keyword)
+                VALUES (?, ?);
+            ''', [(encode_string(word), word) for word in body_positions.keys() | title_positions.keys()])
+            writer.executemany('''
+                INSERT INTO inverted_index (page_id, keyword_id, keyword_count, positions)
+                VALUES (?, ?, ?, ?);
+            ''', [(page_id, encode_string(word), len(positions), encode_positions(positions)) for word, positions in body_positions.items()])
+            writer.executemany('''
+                INSERT INTO title_inverted_index (page_id, keyword_id, keyword_count, positions)
+                VALUES (?, ?, ?, ?);
+            ''', [(page_id, encode_string(word), len(positions), encode_positions(positions)) for word, positions in title_positions.items()])
+            pages_indexed.inc()
+            postings_written.inc(len(body_positions), "body")
+            postings_written.inc(len(title_positions), "title")
+            for word, positions in body_positions.items():
+                body_keywords[encode_string(word)] += len(positions)
+            for word, positions in title_positions.items():
+                title_keywords[encode_string(word)] += len(positions)
+    update_forward_index(cursor, "forward_index", body_keywords, batch_size)
+    update_forward_index(cursor, "title_forward_index", title_keywords, batch_size)
 
 
-def insert_phrase_keywords(cursor) -> None:
-    """Inserts phrase keywords into the database using spaCy."""
-    all_pages = cursor.execute('SELECT page_id FROM pages').fetchall()
+def phrase_texts(pages):
+    """Yields the texts of the pages for spaCy, with the page ID and whether the text is the title as context.
+    Long bodies are split into chunks of at most PHRASE_CHUNK_WORDS words to stay below spaCy's maximum text length.
+    """
+    for page_id, body, title in pages:
+        words = body.split()
+        for start in range(0, len(words), PHRASE_CHUNK_WORDS):
+            yield ' '.join(words[start:start + PHRASE_CHUNK_WORDS]), (page_id, False)
+        yield title, (page_id, True)
+
+
+def extract_phrases(doc) -> list[str]:
+    """Returns the stemmed named entities of two to three words found in a spaCy document."""
+    return [' '.join(stem_words(ent.text.split())) for ent in doc.ents if len(ent.text.split()) > 1 and len(ent.text.split()) <= 3]
+
+
+def insert_phrase_keywords(cursor, page_ids: list[int] = None, batch_size: int = BATCH_SIZE, processes: int = 1) -> None:
+    """Inserts phrase keywords into the database using spaCy.
+    The pages are streamed through spaCy in batches, and the per-page and global phrase counts are collected in the same pass.
+
+    Args:
+        page_ids (list[int], optional): The pages to index. Defaults to all pages.
+        batch_size (int, optional): The number of rows written per transaction. Defaults to BATCH_SIZE.
+        processes (int, optional): The number of processes running spaCy. Defaults to 1.
+    """
+    if page_ids is not None and not page_ids:
+        return
     # Dictionaries to track phrase occurrences across all documents
-    body_phrases = {}  # Word ID -> Frequency
-    title_phrases = {}  # Word ID -> Frequency
-    
-    # Get all words from the documents including the bodies and titles
-    text = ''
-    for page in all_pages:
-        body, title = cursor.execute('SELECT clean_body, clean_title FROM pages WHERE page_id = ?', (page[0],)).fetchone()
-        text += ' '.join(remove_stop_words((body + ' ' + title + ' ').split()))
-    
-    nlp = spacy.load("en_core_web_sm")
-    doc = nlp(text)
-    all_phrases = [' '.join(stem_words(ent.text.split())) for ent in doc.ents if len(ent.text.split()) > 1 and len(ent.text.split()) <= 3]
-    
-    # Insert all phrases into keywords table
-    for phrase in all_phrases:
-        word_id = encode_string(phrase)
-        cursor.execute('''
-            INSERT OR IGNORE INTO keywords (keyword_id, keyword)
-            VALUES (?, ?);
-        ''', (word_id, phrase))
-    
-    # Process each page for inverted indices
-    for page in all_pages:
-        page_id = page[0]
-        body, title = cursor.execute('SELECT clean_body, clean_title FROM pages WHERE page_id = ?', (page_id,)).fetchone()
-        
-        # Process body text for phrases
-        body_doc = nlp(body)
-        body_phrases_in_page = [' '.join(stem_words(ent.text.split())) for ent in body_doc.ents if len(ent.text.split()) > 1 and len(ent.text.split()) <= 3]
-        body_phrase_counts = Counter(body_phrases_in_page)
-        
-        # Process title text for phrases
-        title_doc = nlp(title)
-        title_phrases_in_page = [' '.join(stem_words(ent.text.split())) for ent in title_doc.ents if len(ent.text.split()) > 1 and len(ent.text.split()) <= 3]
-        title_phrase_counts = Counter(title_phrases_in_page)
-        
-        # Update global phrase counts and insert into inverted indices
-        for phrase, count in body_phrase_counts.items():
-            word_id = encode_string(phrase)
-            
-            # First ensure the keyword exists in the keywords table
-            cursor.execute('''
+    body_phrases = Counter()  # Word ID -> Frequency
+    title_phrases = Counter()  # Word ID -> Frequency
+
+    nlp = spacy.load("en_core_web_sm", exclude=PHRASE_EXCLUDED_COMPONENTS)
+    docs = nlp.pipe(phrase_texts(select_pages(cursor, page_ids)), as_tuples=True, batch_size=PHRASE_BATCH_SIZE, n_process=processes)
+
+    with BatchWriter(cursor.connection, batch_size) as writer:
+        # The texts of a page are consecutive, so the documents can be grouped by page
+        for page_id, page_docs in groupby(docs, key=lambda item: item[1][0]):
+            body_phrase_counts, title_phrase_counts = Counter(), Counter()
+            for doc, (_, is_title) in page_docs:
+                (title_phrase_counts if is_title else body_phrase_counts).update(extract_phrases(doc))
+
+            # Ensure the keywords exist in the keywords table
+            writer.executemany('''
                 INSERT OR IGNORE INTO keywords (keyword_id, keyword)
                 VALUES (?, ?);
-            ''', (word_id, phrase))
-            
-            # Update phrase counts
-            if word_id not in body_phrases:
-                body_phrases[word_id] = count
-            else:
-                body_phrases[word_id] += count
-            
-            # Insert into inverted index using the same word_id
-            cursor.execute('''
+            ''', [(encode_string(phrase), phrase) for phrase in body_phrase_counts.keys() | title_phrase_counts.keys()])
+
+            # Update global phrase counts and insert into inverted indices using the same word_id
+            for phrase, count in body_phrase_counts.items():
+                body_phrases[encode_string(phrase)] += count
+            writer.executemany('''
                 INSERT OR IGNORE INTO inverted_index (page_id, keyword_id, keyword_count)
                 VALUES (?, ?, ?);
-            ''', (page_id, word_id, count))
-        
-        for phrase, count in title_phrase_counts.items():
-            word_id = encode_string(phrase)
-            
-            # First ensure the keyword exists in the keywords table
-            cursor.execute('''
-                INSERT OR IGNORE INTO keywords (keyword_id, keyword)
-                VALUES (?, ?);
-            ''', (word_id, phrase))
-            
-            # Update phrase counts
-            if word_id not in title_phrases:
-                title_phrases[word_id] = count
-            else:
-                title_phrases[word_id] += count
-            
-            # Insert into title inverted index using the same word_id
-            cursor.execute('''
+            ''', [(page_id, encode_string(phrase), count) for phrase, count in body_phrase_counts.items()])
+
+            for phrase, count in title_phrase_counts.items():
+                title_phrases[encode_string(phrase)] += count
+            writer.executemany('''
                 INSERT OR IGNORE INTO title_inverted_index (page_id, keyword_id, keyword_count)
                 VALUES (?, ?, ?);
-            ''', (page_id, word_id, count))
-    
+            ''', [(page_id, encode_string(phrase), count) for phrase, count in title_phrase_counts.items()])
+
     # Insert into forward indices
-    for word_id, count in body_phrases.items():
-        cursor.execute('''
-            INSERT OR IGNORE INTO forward_index (keyword_id, keyword_count)
-            VALUES (?, ?);
-        ''', (word_id, count))
-    
-    for word_id, count in title_phrases.items():
-        cursor.execute('''
-            INSERT OR IGNORE INTO title_forward_index (keyword_id, keyword_count)
-            VALUES (?, ?);
-        ''', (word_id, count))
-    
-    connection.commit()
+    update_forward_index(cursor, "forward_index", body_phrases, batch_size)
+    update_forward_index(cursor, "title_forward_index", title_phrases, batch_size)
+
+
+def insert_page_keywords(cursor, page_ids: list[int] = None, batch_size: int = BATCH_SIZE, keyword_count: int = PAGE_KEYWORDS) -> None:
+    """Stores the most frequent keywords of the pages, counting their occurrences in both the body and the title.
+    Keywords with the same count are ordered alphabetically.
+
+    Args:
+        page_ids (list[int], optional): The pages whose keywords changed. Defaults to all pages.
+        batch_size (int, optional): The number of rows written per transaction. Defaults to BATCH_SIZE.
+        keyword_count (int, optional): The number of keywords stored per page. Defaults to PAGE_KEYWORDS.
+    """
+    query = '''
+        SELECT postings.page_id, keywords.keyword, SUM(postings.keyword_count) AS total FROM (
+            SELECT page_id, keyword_id, keyword_count FROM inverted_index {condition}
+            UNION ALL
+            SELECT page_id, keyword_id, keyword_count FROM title_inverted_index {condition}
+        ) AS postings JOIN keywords ON keywords.keyword_id = postings.keyword_id
+        GROUP BY postings.page_id, keywords.keyword
+        ORDER BY postings.page_id, total DESC, keywords.keyword;
+    '''
+    if page_ids is None:
+        cursor.execute('DELETE FROM page_keywords')
+        chunks = [None]
+    else:
+        chunks = list(chunked(page_ids))
+        for chunk in chunks:
+            cursor.execute(f'DELETE FROM page_keywords WHERE page_id IN ({",".join("?" for _ in chunk)})', chunk)
+    with BatchWriter(cursor.connection, batch_size) as writer:
+        for chunk in chunks:
+            condition = "" if chunk is None else f'WHERE page_id IN ({",".join("?" for _ in chunk)})'
+            rows = cursor.execute(query.format(condition=condition), [] if chunk is None else chunk * 2)
+            for _, page_rows in groupby(rows, key=lambda row: row[0]):
+                writer.executemany('''
+                    INSERT INTO page_keywords (page_id, keyword, keyword_count)
+                    VALUES (?, ?, ?);
+                ''', list(page_rows)[:keyword_count])
 
 
-def ranks (current_ranking_score: np.ndarray, adjacency_matrix: np.ndarray, teleportation_probability: float, max_iterations: int = 100) -> np.ndarray:
-    """Calculates the PageRank scores for each page."""
-    ranking_scores = current_ranking_score
-    # Update ranking scores based on the adjacency matrix
+def ranks(page_count: int, sources: np.ndarray, targets: np.ndarray, damping: float = DAMPING, tolerance: float = PAGE_RANK_TOLERANCE, max_iterations: int = 100, initial_scores: np.ndarray = None) -> np.ndarray:
+    """Calculates the PageRank scores for each page by power iteration over the sparse link graph.
+    The rank of a page is split evenly between its children, and the rank of pages without links is spread over all pages.
+    The scores sum up to the number of pages.
+
+    Args:
+        page_count (int): The number of pages.
+        sources (np.ndarray): The parent index of each link.
+        targets (np.ndarray): The child index of each link.
+        damping (float, optional): The probability of following a link instead of jumping to a random page. Defaults to DAMPING.
+        tolerance (float, optional): The L1 change of the scores per page below which the iteration stops. Defaults to PAGE_RANK_TOLERANCE.
+        max_iterations (int, optional): The maximum number of iterations. Defaults to 100.
+        initial_scores (np.ndarray, optional): The scores to start from, such as the previous ranking. Defaults to all ones.
+    """
+    if page_count == 0:
+        return np.empty(0)
+    ranking_scores = np.ones(page_count) if initial_scores is None else initial_scores * (page_count / initial_scores.sum())
+    out_degrees = np.bincount(sources, minlength=page_count)
+    dangling = out_degrees == 0
+    link_weights = 1 / out_degrees[sources]
     for _ in range(max_iterations):
-        new_ranking_scores = adjacency_matrix.dot(ranking_scores)
-        # Apply teleportation probability to the new scores
-        new_ranking_scores = teleportation_probability + (1 - teleportation_probability) * new_ranking_scores
+        # Sparse matrix-vector product: every page passes its rank on to its children
+        new_ranking_scores = np.bincount(targets, weights=ranking_scores[sources] * link_weights, minlength=page_count)
+        new_ranking_scores += ranking_scores[dangling].sum() / page_count
+        new_ranking_scores = (1 - damping) + damping * new_ranking_scores
         # Stop iteration after the scores converge
-        if np.allclose(ranking_scores, new_ranking_scores):
-            break
+        converged = np.abs(new_ranking_scores - ranking_scores).sum() < tolerance * page_count
         ranking_scores = new_ranking_scores
+        if converged:
+            break
     return ranking_scores
 
-def insert_page_ranks(cursor) -> None:
-    """Inserts page ranks into the database."""
-    all_pages = cursor.execute('SELECT page_id FROM pages').fetchall()
-    adjacency_matrix = generate_adjacency_matrix([page[0] for page in all_pages])
-    ranking_scores = ranks(np.ones(len(all_pages)), adjacency_matrix, 0.85)
-    for page_id, score in zip([page[0] for page in all_pages], ranking_scores):
-        cursor.execute('''
+
+def insert_page_ranks(cursor, batch_size: int = BATCH_SIZE, warm_start: bool = True) -> None:
+    """Inserts page ranks into the database.
+
+    Args:
+        batch_size (int, optional): The number of rows written per transaction. Defaults to BATCH_SIZE.
+        warm_start (bool, optional): Whether to start the iteration from the stored page ranks. Defaults to True.
+    """
+    page_ids, sources, targets = load_link_graph(cursor)
+    initial_scores = None
+    if warm_start and len(page_ids) > 0:
+        previous_scores = dict(cursor.execute('SELECT page_id, score FROM page_ranks').fetchall())
+        if previous_scores:
+            initial_scores = np.array([previous_scores.get(page_id, 1.0) for page_id in page_ids.tolist()], dtype=np.float64)
+    ranking_scores = ranks(len(page_ids), sources, targets, initial_scores=initial_scores)
+    cursor.execute('DELETE FROM page_ranks')
+    with BatchWriter(cursor.connection, batch_size) as writer:
+        writer.executemany('''
             INSERT OR IGNORE INTO page_ranks (page_id, score)
             VALUES (?, ?);
-        ''', (page_id, score))
-    connection.commit()
+        ''', zip(page_ids.tolist(), ranking_scores.tolist()))
+
+
+def insert_document_norms(cursor, batch_size: int = BATCH_SIZE) -> None:
+    """Inserts the L2 norms of the title and body TF-IDF vectors of every page into the database.
+    The document frequencies are global, so the norms of all pages are recomputed.
+    """
+    document_count = cursor.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+    norms = {page_id: [0.0, 0.0] for page_id, in cursor.execute('SELECT page_id FROM pages').fetchall()}
+    for field, (inverted_table, forward_table) in enumerate(INDEX_TABLES):
+        page_ids, _, weights = tfidf_weights(cursor, inverted_table, forward_table, document_count)
+        pages, page_rows = np.unique(page_ids, return_inverse=True)
+        for page_id, norm in zip(pages.tolist(), np.sqrt(np.bincount(page_rows, weights=weights ** 2)).tolist()):
+            if page_id in norms:
+                norms[page_id][field] = norm
+    cursor.execute('DELETE FROM document_norms')
+    with BatchWriter(cursor.connection, batch_size) as writer:
+        # INDEX_TABLES lists the bodies first
+        writer.executemany('''
+            INSERT INTO document_norms (page_id, title_norm, body_norm)
+            VALUES (?, ?, ?);
+        ''', [(page_id, title_norm, body_norm) for page_id, (body_norm, title_norm) in norms.items()])
+
+
+def truncated_vectors(cursor, terms: int = VECTOR_TERMS) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Computes the body TF-IDF vector of every page truncated to its largest weights, like the vectors of the index snapshot, scaled to unit length.
+
+    Returns:
+        page_ids (np.ndarray): The sorted IDs of all pages.
+        rows (np.ndarray): The index in page_ids of the page of each vector entry, in ascending order.
+        keyword_ids (np.ndarray): The keyword of each vector entry.
+        weights (np.ndarray): The scaled weight of each vector entry.
+    """
+    page_ids = np.array(sorted(page_id for page_id, in cursor.execute('SELECT page_id FROM pages').fetchall()), dtype=np.int64)
+    posting_pages, keyword_ids, weights = tfidf_weights(cursor, *INDEX_TABLES[0], len(page_ids))
+    # Sorted by keyword, equal weights keep the smaller keyword IDs like in the snapshot
+    order = np.argsort(keyword_ids, kind="stable")
+    known = order[np.isin(posting_pages[order], page_ids) & (weights[order] > 0)]
+    rows, keyword_ids, weights = np.searchsorted(page_ids, posting_pages[known]), keyword_ids[known], weights[known]
+    top = top_per_group(rows, weights, terms)
+    rows, keyword_ids, weights = rows[top], keyword_ids[top], weights[top]
+    lengths = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=len(page_ids)))
+    return page_ids, rows, keyword_ids, weights / lengths[rows]
+
+
+def similar_pages(rows: np.ndarray, keyword_ids: np.ndarray, weights: np.ndarray, targets: np.ndarray, page_count: int, neighbors: int = PAGE_NEIGHBORS, batch_pages: int = NEIGHBOR_BATCH_PAGES):
+    """Finds the most similar pages of the target pages by the dot product of their vectors.
+    The vectors are inverted by keyword, so a page is only compared with the pages sharing a keyword with it.
+
+    Args:
+        rows, keyword_ids, weights (np.ndarray): The page row, keyword and weight of each vector entry, sorted by page row.
+        targets (np.ndarray): The rows of the pages whose similar pages are found.
+        page_count (int): The number of page rows.
+        neighbors (int, optional): The number of similar pages found per page. Defaults to PAGE_NEIGHBORS.
+        batch_pages (int, optional): The number of target pages compared at a time. Defaults to NEIGHBOR_BATCH_PAGES.
+
+    Yields:
+        (np.ndarray, np.ndarray, np.ndarray): The page rows, the rows of their similar pages and the similarities, for a batch of target pages.
+    """
+    keywords, keyword_rows = np.unique(keyword_ids, return_inverse=True)
+    by_keyword = np.argsort(keyword_rows, kind="stable")
+    keyword_lengths = np.bincount(keyword_rows, minlength=len(keywords))
+    keyword_starts = np.cumsum(keyword_lengths) - keyword_lengths
+    page_lengths = np.bincount(rows, minlength=page_count)
+    page_starts = np.cumsum(page_lengths) - page_lengths
+    for start in range(0, len(targets), batch_pages):
+        batch = targets[start:start + batch_pages]
+        entries = expand_ranges(page_starts[batch], page_lengths[batch])
+        # Sparse matrix product of the vectors of the batch with the vectors of all pages
+        lengths = keyword_lengths[keyword_rows[entries]]
+        matches = by_keyword[expand_ranges(keyword_starts[keyword_rows[entries]], lengths)]
+        sources, others = np.repeat(rows[entries], lengths), rows[matches]
+        products = np.repeat(weights[entries], lengths) * weights[matches]
+        different = sources != others
+        pairs, positions = np.unique(sources[different] * page_count + others[different], return_inverse=True)
+        similarities = np.bincount(positions, weights=products[different], minlength=len(pairs))
+        sources, others = pairs // page_count, pairs % page_count
+        # The pairs are sorted by page, so equal similarities keep the smaller row
+        top = top_per_group(sources, similarities, neighbors)
+        yield sources[top], others[top], similarities[top]
+
+
+def insert_page_neighbors(cursor, page_ids: list[int] = None, batch_size: int = BATCH_SIZE, neighbors: int = PAGE_NEIGHBORS) -> None:
+    """Stores the most similar pages of each page by the cosine similarity of their truncated body TF-IDF vectors.
+    Keywords in the vectors of more than NEIGHBOR_KEYWORD_LIMIT pages are left out of the comparison, so the similar pages are approximate.
+    Given the changed pages, only the changed pages are compared with all pages. The similar pages of another page are updated in place
+    while its changed similar pages stay similar enough, and are compared again once a changed page enters or leaves them.
+    The weights of unchanged pages are not updated for the new document frequencies until the next full build.
+
+    Args:
+        page_ids (list[int], optional): The new, changed and deleted pages. Defaults to all pages.
+        batch_size (int, optional): The number of rows written per transaction. Defaults to BATCH_SIZE.
+        neighbors (int, optional): The number of similar pages stored per page. Defaults to PAGE_NEIGHBORS.
+    """
+    all_page_ids, rows, keyword_ids, weights = truncated_vectors(cursor)
+    _, keyword_rows, keyword_lengths = np.unique(keyword_ids, return_inverse=True, return_counts=True)
+    usable = keyword_lengths[keyword_rows] <= NEIGHBOR_KEYWORD_LIMIT
+    rows, keyword_ids, weights = rows[usable], keyword_ids[usable], weights[usable]
+    updates = []
+    if page_ids is None:
+        cursor.execute('DELETE FROM page_neighbors')
+        targets = np.arange(len(all_page_ids))
+    else:
+        # Page IDs are 32-bit, so a (page, similar page) pair is one 64-bit key
+        listed = np.array([page_id << 32 | neighbor_id for chunk in chunked(page_ids) for page_id, neighbor_id in cursor.execute(f'SELECT page_id, neighbor_id FROM page_neighbors WHERE neighbor_id IN ({",".join("?" for _ in chunk)})', chunk).fetchall()], dtype=np.uint64)
+        page_keys = all_page_ids.astype(np.uint64)
+        minimums, counts = np.zeros(len(all_page_ids)), np.zeros(len(all_page_ids), dtype=np.int64)
+        stored = np.array(cursor.execute('SELECT page_id, MIN(score), COUNT(*) FROM page_neighbors GROUP BY page_id').fetchall(), dtype=np.float64).reshape(-1, 3)
+        stored_pages = stored[:, 0].astype(np.int64)
+        in_pages = np.isin(stored_pages, all_page_ids)
+        stored_rows = np.searchsorted(all_page_ids, stored_pages[in_pages])
+        minimums[stored_rows], counts[stored_rows] = stored[in_pages, 1], stored[in_pages, 2]
+        affected, kept = set(page_ids), []
+        for sources, others, similarities in similar_pages(rows, keyword_ids, weights, np.flatnonzero(np.isin(all_page_ids, page_ids)), len(all_page_ids), len(all_page_ids)):
+            keys = page_keys[others] << np.uint64(32) | page_keys[sources]
+            is_listed = np.isin(keys, listed)
+            similar_enough = similarities >= minimums[others]
+            # A changed page stays among the similar pages as long as it is at least as similar as the least similar one was
+            kept.append(keys[is_listed & similar_enough])
+            updates += zip(similarities[is_listed & similar_enough].tolist(), all_page_ids[others[is_listed & similar_enough]].tolist(), all_page_ids[sources[is_listed & similar_enough]].tolist())
+            # A changed page enters the similar pages of a page if it is more similar to it than the least similar one
+            affected.update(all_page_ids[others[~is_listed & (similar_enough | (counts[others] < neighbors))]].tolist())
+        # Pages losing a changed or deleted page from their similar pages need their next most similar page
+        affected.update((listed[~np.isin(listed, np.concatenate(kept or [np.empty(0, dtype=np.uint64)]))] >> np.uint64(32)).tolist())
+        updates = [update for update in updates if update[1] not in affected]
+        affected = sorted(affected)
+        for chunk in chunked(affected):
+            cursor.execute(f'DELETE FROM page_neighbors WHERE page_id IN ({",".join("?" for _ in chunk)})', chunk)
+        targets = np.flatnonzero(np.isin(all_page_ids, affected))
+    with BatchWriter(cursor.connection, batch_size) as writer:
+        writer.executemany('UPDATE page_neighbors SET score = ? WHERE page_id = ? AND neighbor_id = ?;', updates)
+        for sources, others, similarities in similar_pages(rows, keyword_ids, weights, targets, len(all_page_ids), neighbors):
+            writer.executemany('''
+                INSERT INTO page_neighbors (page_id, neighbor_id, score)
+                VALUES (?, ?, ?);
+            ''', zip(all_page_ids[sources].tolist(), all_page_ids[others].tolist(), similarities.tolist()))
+
+
+@contextmanager
+def stage_timer(timings: dict, stage: str):
+    """Records the seconds spent in the block in the index_stage_seconds histogram, and adds them to timings[stage] unless timings is None."""
+    start = time.perf_counter()
+    try:
+        with index_stages.time(stage):
+            yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def index_pages(cursor, full: bool = False, batch_size: int = BATCH_SIZE, processes: int = 1, snapshot_path: str = SNAPSHOT_PATH, timings: dict = None, shards: int = 1) -> None:
+    """Builds the indexes from scratch, or updates them for the pages the spider marked as new, changed or deleted.
+    Afterwards, the structures retrieval needs at query time are written to a new index snapshot, and to one snapshot per shard if there are several.
+
+    Args:
+        full (bool, optional): Whether to rebuild the indexes of all pages. Defaults to False.
+        batch_size (int, optional): The number of rows written per transaction. Defaults to BATCH_SIZE.
+        processes (int, optional): The number of processes analyzing the pages. Defaults to 1.
+        snapshot_path (str, optional): The path of the index snapshot. Defaults to SNAPSHOT_PATH.
+        timings (dict, optional): If given, the seconds spent in each stage are added to it by stage name. Defaults to None.
+        shards (int, optional): The number of shards the pages are partitioned into for the shard workers of retrieval. Defaults to 1, no shards.
+    """
+    changes = cursor.execute('SELECT page_id, change FROM page_changes').fetchall()
+    with stage_timer(timings, "retract_pages"):
+        if full:
+            for table in ("keywords", "inverted_index", "forward_index", "title_inverted_index", "title_forward_index", "page_keywords"):
+                cursor.execute(f'DELETE FROM {table}')
+            cursor.connection.commit()
+            page_ids = None
+        else:
+            # Retract the postings of changed and deleted pages before indexing the new versions
+            retracted = retract_pages(cursor, [page_id for page_id, _ in changes], batch_size)
+            page_ids = [page_id for page_id, change in changes if change != 'deleted']
+    with stage_timer(timings, "single_keywords"):
+        insert_single_keywords(cursor, page_ids, batch_size, processes)
+    with stage_timer(timings, "phrase_keywords"):
+        insert_phrase_keywords(cursor, page_ids, batch_size, processes)
+    if not full:
+        with stage_timer(timings, "collect_garbage_keywords"):
+            collect_garbage_keywords(cursor, retracted)
+    with stage_timer(timings, "page_keywords"):
+        # Databases indexed before the page keywords were stored get the keywords of all pages
+        if full or cursor.execute('SELECT COUNT(*) FROM page_keywords').fetchone()[0] == 0:
+            insert_page_keywords(cursor, batch_size=batch_size)
+        else:
+            insert_page_keywords(cursor, [page_id for page_id, _ in changes], batch_size)
+    with stage_timer(timings, "page_ranks"):
+        insert_page_ranks(cursor, batch_size)
+    with stage_timer(timings, "document_norms"):
+        insert_document_norms(cursor, batch_size)
+    with stage_timer(timings, "page_neighbors"):
+        # Databases indexed before the similar pages were stored get the similar pages of all pages
+        if full or cursor.execute('SELECT COUNT(*) FROM page_neighbors').fetchone()[0] == 0:
+            insert_page_neighbors(cursor, batch_size=batch_size)
+        else:
+            insert_page_neighbors(cursor, [page_id for page_id, _ in changes], batch_size)
+    for chunk in chunked(changes):
+        cursor.executemany('DELETE FROM page_changes WHERE page_id = ? AND change = ?', chunk)
+    cursor.connection.commit()
+    with stage_timer(timings, "snapshot"):
+        # The shards are written first with the generation of the new snapshot, so a search engine loading it finds shards at least as new
+        generation = next_generation(snapshot_path)
+        for shard in range(shards if shards > 1 else 0):
+            write_snapshot(build_snapshot(cursor, shard, shards), shard_path(snapshot_path, shard, shards), generation)
+        write_snapshot(build_snapshot(cursor), snapshot_path, generation)
 
 
 if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Builds the indexes of the crawled pages.")
+    arg_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Number of rows written per transaction.")
+    arg_parser.add_argument("--processes", type=int, default=1, help="Number of processes analyzing the pages.")
+    arg_parser.add_argument("--full", action="store_true", help="Rebuild the indexes of all pages instead of only the changed pages.")
+    arg_parser.add_argument("--snapshot", default=SNAPSHOT_PATH, help="Path of the index snapshot loaded by the search engine.")
+    arg_parser.add_argument("--shards", type=int, default=1, help="Number of shard snapshots the pages are partitioned into for shard workers.")
+    arg_parser.add_argument("--metrics-file", default=None, help="File the indexing metrics are written to in the Prometheus text format.")
+    args = arg_parser.parse_args()
+
     DATABASE_PATH = 'database.db'
     connection = sqlite3.connect(DATABASE_PATH)
     cursor = connection.cursor()
-    insert_single_keywords(cursor)
-    insert_phrase_keywords(cursor)
-    insert_page_ranks(cursor)
-    connection.close()
\ No newline at end of file
+    # Build everything when nothing has been indexed yet
+    full = args.full or cursor.execute('SELECT COUNT(*) FROM forward_index').fetchone()[0] == 0
+    # Secondary indexes are dropped while loading and built once at the end of a full build
+    with bulk_load(connection, defer_indexes=full):
+        index_pages(cursor, full, args.batch_size, args.processes, args.snapshot, shards=args.shards)
+    connection.close()
+    if args.metrics_file:
+        metrics.write(args.metrics_file)
\ No newline at end of file
@@ -0,0 +1,212 @@
+import os
+import sys
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Default number of seconds between two samples of the profiler
+PROFILE_INTERVAL = 0.005
+# Minimum number of seconds between two samples, shorter intervals would keep a core busy walking the stacks
+MIN_PROFILE_INTERVAL = 0.001
+# Maximum number of frames kept of a sampled stack
+PROFILE_DEPTH = 64
+
+# Every metric created, in the order in which they are exported
+registry = []
+# The breakdown collected by trace in the current thread, if any
+_local = threading.local()
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    """Formats label names and values as a Prometheus label set, such as {stage="parse"}."""
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)] + ([extra] if extra else [])
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def current_breakdown() -> dict | None:
+    return getattr(_local, "breakdown", None)
+
+
+@contextmanager
+def trace():
+    """Collects the stage timings and counter increments of the current thread within the block.
+    The breakdown holds "timings", the milliseconds spent in each timed stage by stage name,
+    and "counters", the increments of each counter by metric name without the _total suffix.
+    """
+    previous = current_breakdown()
+    breakdown = {"timings": {}, "counters": {}}
+    _local.breakdown = breakdown
+    try:
+        yield breakdown
+    finally:
+        _local.breakdown = previous
+        for stage, milliseconds in breakdown["timings"].items():
+            breakdown["timings"][stage] = round(milliseconds, 3)
+
+
+class Counter:
+    """Monotonically increasing count, with one value per combination of label values.
+    Values are kept per process, so every worker process of a server exports its own counts.
+    """
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {} # {label values: count}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount: float = 1, *labels) -> None:
+        """Adds the amount to the value of the label values."""
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+        breakdown = current_breakdown()
+        if breakdown is not None:
+            key = self.name.removesuffix("_total") + format_labels(self.labels, labels)
+            breakdown["counters"][key] = breakdown["counters"].get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f"{self.name}{format_labels(self.labels, labels)} {value}" for labels, value in values]
+
+
+class Histogram:
+    """Distribution of observed values in buckets, with one distribution per combination of label values."""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {} # {label values: [count of each bucket and of the values above the last bound, sum]}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value: float, *labels) -> None:
+        """Records a value of the label values."""
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Records the seconds spent in the block, and adds them to the breakdown of the current trace under the label values."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(elapsed, *labels)
+            breakdown = current_breakdown()
+            if breakdown is not None:
+                stage = ".".join(str(label) for label in labels) or self.name
+                breakdown["timings"][stage] = breakdown["timings"].get(stage, 0.0) + elapsed * 1000
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self.values.items())
+        lines = []
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, labels, bucket)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {'counter' if isinstance(metric, Counter) else 'histogram'}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def write(path: str) -> None:
+    """Writes all metrics to a file in the Prometheus text exposition format, for example for the textfile collector of node_exporter.
+    The file is written next to the old one and renamed over it, so the collector never reads a partial file.
+    """
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as file:
+        file.write(render())
+    os.replace(temporary_path, path)
+
+
+class SamplingProfiler:
+    """Samples the call stacks of all other threads at a fixed interval while it runs.
+    Stacks are counted in the folded format of flame graph tools, one "outer;...;inner count" line per stack.
+    """
+
+    def __init__(self):
+        self.stacks = {} # {folded stack: number of samples}
+        self.samples = 0
+        self.interval = None
+        self.lock = threading.Lock()
+        self._stop = None
+
+    @property
+    def running(self) -> bool:
+        return self._stop is not None
+
+    def start(self, interval: float = PROFILE_INTERVAL) -> None:
+        """Discards the previous samples and starts sampling in a background thread, unless the profiler is already running.
+        Intervals shorter than MIN_PROFILE_INTERVAL are raised to it.
+        """
+        interval = max(interval, MIN_PROFILE_INTERVAL)
+        with self.lock:
+            if self._stop is not None:
+                return
+            self.stacks, self.samples, self.interval = {}, 0, interval
+            self._stop = threading.Event()
+            threading.Thread(target=self._run, args=(self._stop, interval), name="sampling-profiler", daemon=True).start()
+
+    def stop(self) -> None:
+        """Stops sampling and keeps the samples taken so far."""
+        with self.lock:
+            if self._stop is not None:
+                self._stop.set()
+                self._stop = None
+
+    def _run(self, stop: threading.Event, interval: float) -> None:
+        own_thread = threading.get_ident()
+        while not stop.wait(interval):
+            frames = sys._current_frames()
+            with self.lock:
+                for thread, frame in frames.items():
+                    if thread == own_thread:
+                        continue
+                    stack = []
+                    while frame is not None and len(stack) < PROFILE_DEPTH:
+                        stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                        frame = frame.f_back
+                    folded = ";".join(reversed(stack))
+                    self.stacks[folded] = self.stacks.get(folded, 0) + 1
+                self.samples += 1
+
+    def folded(self, limit: int = None) -> str:
+        """Returns the sampled stacks in the folded format, from the most to the least sampled."""
+        with self.lock:
+            stacks = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def stats(self) -> dict:
+        """Returns whether the profiler runs, its interval and the number of samples and distinct stacks taken."""
+        with self.lock:
+            return {"running": self._stop is not None, "interval": self.interval, "samples": self.samples, "stacks": len(self.stacks)}
+
+
+# Profiler of the current process, started and stopped at runtime
+profiler = SamplingProfiler()
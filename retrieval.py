@@ -1,127 +1,380 @@
-import math, sqlite3, re
-from nltk.stem import PorterStemmer as Stemmer
-from collections import Counter
-from indexer import stem_words, remove_stop_words
-from utils import encode_string
-
-# Stemming
-ps = Stemmer()
-# Convert stopwords.txt to a list
-stopwords = open('stopwords.txt', 'r').read().split()
-connection = sqlite3.connect('database.db', check_same_thread=False)
-cursor = connection.cursor()
+import math, re, heapq, os, time, threading
+import numpy as np
+from bisect import bisect_left
+from contextlib import nullcontext
+import multiprocessing
+from collections import Counter, namedtuple
+from analyzer import stem, stopwords, stem_words, remove_stop_words
+from utils import encode_string, decode_varints
+from snapshot import SNAPSHOT_PATH, build_snapshot, load_snapshot, shard_path
+from storage import ReadConnections
+from cache import QueryCache
+import metrics
+
+# Read-only database connections, one per thread and process
+readers = ReadConnections('database.db')
 
 # Maximum number of search results
 MAX_RESULTS = 50
-# Global dictionaries to store processed data
-Title_globalPageDict, Text_globalPageDict = {}, {} # {page_id: {word_id: TF-IDF score}}
-globalWordtoID = {} # {word: word_id}
-Title_globalPageStemText, Text_globalPageStemText = {}, {} # {page_id: stemmed text}
-DOCUMENT_COUNT = cursor.execute("SELECT COUNT(page_id) FROM pages").fetchone()[0]
-
-# Parse the query into single words and phrases
-def parser(query: str) -> list[list[int]]:
+# Maximum number of ranked results kept of a query for paging through them
+MAX_RANKED_RESULTS = 1000
+# Minimum number of seconds between two checks for a new index snapshot
+SNAPSHOT_CHECK_INTERVAL = 1.0
+# Number of distinct queries of a batch ranked together, the posting lists they share are decoded once
+BATCH_CHUNK_SIZE = 64
+# Compressed posting lists of a field with one record per word, see snapshot.posting_lists
+# offsets/postings: document row gaps and term frequencies, position_offsets/positions: word positions of each posting
+# idf: inverse document frequency of each word, max_counts: maximum term frequency of each document, norms: L2 norm of each document
+PostingLists = namedtuple("PostingLists", ["offsets", "postings", "position_offsets", "positions", "idf", "max_counts", "norms"])
+# Truncated body TF-IDF vectors of the documents, see snapshot.posting_lists
+# offsets: start of the vector of each document row, keywords/weights: keyword IDs and weights of the vectors, from the largest weight
+TermVectors = namedtuple("TermVectors", ["offsets", "keywords", "weights"])
+# Most similar pages of each document precomputed by the indexer, see snapshot.neighbor_lists
+# offsets: start of the similar pages of each document row, pages/scores: IDs and cosine similarities of the similar pages, from the most similar
+NeighborLists = namedtuple("NeighborLists", ["offsets", "pages", "scores"])
+# Processed data loaded from the index snapshot written by the indexer, never modified after loading
+# generation: generation of the snapshot, 0 if it was built from the database, file: (inode, modification time) of the snapshot file
+# docIds: sorted page IDs, the position of a page is its document row, wordIds: sorted keyword IDs, the position of a word is its row in the posting lists
+# pageRanks: PageRank score of each document row, positions: position of each document row in the pages table, by which equal scores are ranked like the pages were crawled
+# title/text: posting lists of the titles and bodies
+# vectors: truncated body vectors of the documents, neighbors: similar pages of the documents
+# decoded: {(id of the posting lists, row, kind): decoded list} of the lists decoded by a batch of queries, None outside of batches
+SearchIndex = namedtuple("SearchIndex", ["generation", "file", "docIds", "wordIds", "pageRanks", "positions", "title", "text", "vectors", "neighbors", "decoded"], defaults=[None])
+globalIndex = None # The loaded index, None until the first search, replaced as a whole when a new snapshot is loaded so a search never sees a partly loaded index
+indexLock = threading.Lock() # Held while checking for a new snapshot
+lastSnapshotCheck = 0.0 # Time of the last check for a new snapshot
+snapshotPath = SNAPSHOT_PATH # Path of the snapshot of all pages, the snapshots of the shards are next to it
+shard = (0, 1) # (shard, number of shards) of the pages this process loads, (0, 1) for all pages
+shardClients = None # Connections to the shard workers ranking the pages of each shard, None to rank all pages in this process, see shards.py
+resultCache = QueryCache() # {(query key, number of results): ranked (page ID, score) pairs}
+# Metrics of the query path, exported by the /metrics endpoint of the app
+searchStages = metrics.Histogram("search_stage_seconds", "Seconds spent in each stage of a search.", ["stage"])
+searchCalls = metrics.Counter("search_engine_calls_total", "Searches by whether their results were cached.", ["cached"])
+candidatesScored = metrics.Counter("search_candidates_scored_total", "Documents whose cosine similarity to a query was computed.")
+postingsTouched = metrics.Counter("search_postings_touched_total", "Postings read from the posting lists by searches.")
+shardMismatches = metrics.Counter("search_shard_generation_mismatches_total", "Replies of shard workers that ranked another index generation than the query was parsed with.")
+
+# Path of the snapshot of the pages this process loads
+def indexPath() -> str:
+    return snapshotPath if shard[1] == 1 else shard_path(snapshotPath, *shard)
+
+# Load the index from the memory-mapped snapshot, or build it from the database if there is none
+def loadIndex() -> SearchIndex:
+    try:
+        status = os.stat(indexPath())
+        generation, snapshot = load_snapshot(indexPath())
+        file = (status.st_ino, status.st_mtime_ns)
+    except (OSError, ValueError):
+        with readers.cursor() as cursor:
+            generation, snapshot, file = 0, build_snapshot(cursor, *shard), None
+    title = PostingLists(*(snapshot[f"title_{name}"] for name in PostingLists._fields))
+    text = PostingLists(*(snapshot[f"body_{name}"] for name in PostingLists._fields))
+    vectors = TermVectors(*(snapshot[f"body_vector_{name}"] for name in TermVectors._fields))
+    neighbors = NeighborLists(*(snapshot[f"neighbor_{name}"] for name in NeighborLists._fields))
+    return SearchIndex(generation, file, snapshot["page_ids"], snapshot["keyword_ids"], snapshot["page_ranks"], snapshot["page_positions"], title, text, vectors, neighbors)
+
+# Return the current index, after loading a new snapshot if the indexer published one
+# The index is loaded by the first caller, so importing this module loads nothing and a worker process only loads the shard it sets with useShard
+# The snapshot file is checked by one thread at a time, at most once every SNAPSHOT_CHECK_INTERVAL seconds
+# A caller that needs at least the given generation waits for a check instead, such as a shard worker behind the query
+def currentIndex(generation: int = None) -> SearchIndex:
+    global globalIndex, lastSnapshotCheck
+    if globalIndex is None:
+        with indexLock:
+            if globalIndex is None:
+                lastSnapshotCheck = time.monotonic()
+                globalIndex = loadIndex()
+    behind = generation is not None and generation > globalIndex.generation
+    if (behind or time.monotonic() - lastSnapshotCheck >= SNAPSHOT_CHECK_INTERVAL) and indexLock.acquire(blocking=behind):
+        try:
+            lastSnapshotCheck = time.monotonic()
+            status = os.stat(indexPath())
+            if (status.st_ino, status.st_mtime_ns) != globalIndex.file: globalIndex = loadIndex()
+        except OSError:
+            pass
+        finally:
+            indexLock.release()
+    return globalIndex
+
+# Find the row of a word in the posting lists, or None if the word is not indexed
+def wordRow(index: SearchIndex, word_id: int) -> int | None:
+    row = int(np.searchsorted(index.wordIds, word_id))
+    return row if row < len(index.wordIds) and index.wordIds[row] == word_id else None
+
+# Parse the query into single words and phrases, a phrase followed by ~n also matches when its words are up to n words apart
+def parser(query: str, index: SearchIndex = None) -> list[list]:
+    index = currentIndex() if index is None else index
     # Extract and stem single word
-    keywords = [globalWordtoID[ps.stem(re.sub("[^a-zA-Z-]+", "", word.lower()))] for word in query.split()[:10000] if word.lower() not in stopwords and ps.stem(re.sub("[^a-zA-Z-]+", "", word.lower())) in globalWordtoID]
+    keywords = [word_id for word in query.split()[:10000] if word.lower() not in stopwords and wordRow(index, word_id := encode_string(stem(re.sub("[^a-zA-Z-]+", "", word.lower())))) is not None]
     # Extract and stem phrases
-    phrases_no_stopword = [r"(?<!\S){}(?!\S)".format(" ".join(ps.stem(word) for word in phrase.lower().split() if word not in stopwords)) for phrase in re.findall('"([^"]*)"', query) if phrase]
-    keywords += [encode_string(' '.join(stem_words(remove_stop_words(phrase.split())))) for phrase in re.findall('"([^"]*)"', query) if phrase]
+    quoted = re.findall(r'"([^"]*)"(?:~(\d+))?', query)
+    phrases_no_stopword = [([stem(word) for word in phrase.lower().split() if word not in stopwords], int(slop or 0)) for phrase, slop in quoted if phrase]
+    keywords += [encode_string(' '.join(stem_words(remove_stop_words(phrase.split())))) for phrase, _ in quoted if phrase]
     return [keywords, phrases_no_stopword]
 
+# Normalize a query into a cache key, queries with the same known words, phrases and related document share a key
+def queryKey(query: str, related_doc: int = -1, index: SearchIndex = None) -> tuple:
+    keywords, phrases = parser(query, index)
+    return tuple(sorted(keywords)), tuple(sorted((tuple(stems), slop) for stems, slop in phrases)), related_doc
+
 # Convert a query in a vector
 def queryToVec(queryEncoding: list[int]) -> dict[int, int]: return Counter(queryEncoding) if queryEncoding else {}
 
-# Convert a document to a TF-IDF vector
-def documentToVec(page_id: int, fromTitle: bool = False) -> dict[int, int]:
-    table = "title_inverted_index" if fromTitle else "inverted_index"
-    # Use title_inverted_index or inverted_index based on the flag
-    wordList = cursor.execute(f"SELECT keyword_id, keyword_count FROM {table} WHERE page_id = ?", (page_id,)).fetchall()
-    # Calculate max term frequency (TF)
-    maxTF = cursor.execute(f"SELECT MAX(keyword_count) FROM {table} WHERE page_id = ?", (page_id,)).fetchone()[0]
-    forwardIdx = "title_forward_index" if fromTitle else "forward_index"
-    # Use title_forward_index or forward_index based on the flag
-    word_counts = {word_id: count for word_id, count in cursor.execute(f"SELECT keyword_id, keyword_count FROM {forwardIdx} WHERE keyword_id IN ({','.join('?' for _ in wordList)})", [word for word, _ in wordList]).fetchall()}
-    # Calculate TF-IDF scores for each word
-    return {word: tf * math.log2(DOCUMENT_COUNT / word_counts[word]) / maxTF for word, tf in wordList} if wordList else {}
-
-# Calculate cosine similarity between two vectors
-# vector 1: query vector
-# vector 2: document vector
-def cosinesimilarity(vector1: dict[int, int, int], vector2: dict[int, int, int]) -> float:
-    commonwords = set(vector1.keys()) & set(vector2.keys())
-    if not commonwords: return 0.0
-    # Normalize vectors
-    def normalize(vector):
-        magnitude = math.sqrt(sum(value**2 for value in vector.values()))
-        return {word: value / magnitude for word, value in vector.items()} if magnitude != 0 else vector
-    # Dot product of two normalized vectors
-    vector1n = normalize(vector1)
-    vector2n = normalize(vector2)
-    dot_product = sum(vector1n[word] * vector2n[word] for word in commonwords)
-    score = dot_product * 50
-    return score
-
-# Filter documents based on phrases
-def phraseFilter(document_id: int, phrases: list[str]) -> bool:
-    return all(re.search(phrase, Title_globalPageStemText[document_id]) or re.search(phrase, Text_globalPageStemText[document_id]) for phrase in phrases) if phrases else True
-
-# Filter documents based on query words
-def queryFilter(document_id: int, query: list[int]) -> bool:
-    return any(word in Title_globalPageDict[document_id] or word in Text_globalPageDict[document_id] for word in query) if query else True
+# Find the row of a document, or None if the page is not indexed
+def documentRow(index: SearchIndex, page_id: int) -> int | None:
+    document = int(np.searchsorted(index.docIds, page_id))
+    return document if document < len(index.docIds) and index.docIds[document] == page_id else None
+
+# Look up the TF-IDF weights of the given words in the truncated body vector of a document, or None if the page is not indexed
+# Words outside the VECTOR_TERMS largest weights of the document have no weight
+def relatedVector(index: SearchIndex, page_id: int, words) -> dict[int, float] | None:
+    document = documentRow(index, page_id)
+    if document is None: return None
+    start, end = index.vectors.offsets[document], index.vectors.offsets[document + 1]
+    weights = dict(zip(index.vectors.keywords[start:end].tolist(), index.vectors.weights[start:end].tolist()))
+    return {word: weights[word] for word in words if word in weights}
+
+# Look up the most similar pages of a page and their cosine similarities, from the most similar
+def similarPages(page_id: int, limit: int = None, index: SearchIndex = None) -> dict[int, float]:
+    index = currentIndex() if index is None else index
+    document = documentRow(index, page_id)
+    if document is None: return {}
+    start, end = index.neighbors.offsets[document], index.neighbors.offsets[document + 1]
+    end = end if limit is None else min(end, start + limit)
+    return dict(zip(index.neighbors.pages[start:end].tolist(), index.neighbors.scores[start:end].tolist()))
+
+# Decode the posting list of a word into its sorted document rows and term frequencies
+# Decoded lists are remembered in decoded if it is given
+def postingList(lists: PostingLists, row: int, decoded: dict = None) -> tuple[np.ndarray, np.ndarray]:
+    key = (id(lists), row, "postings")
+    if decoded is not None and key in decoded: return decoded[key]
+    values = decode_varints(lists.postings[lists.offsets[row]:lists.offsets[row + 1]])
+    half = len(values) // 2
+    result = np.cumsum(values[:half]), values[half:]
+    if decoded is not None: decoded[key] = result
+    return result
+
+# Decode the word positions of a posting list, returns the start of the positions of each posting and the position gaps
+# Decoded lists are remembered in decoded if it is given
+def positionList(lists: PostingLists, row: int, postingCount: int, decoded: dict = None) -> tuple[np.ndarray, np.ndarray]:
+    key = (id(lists), row, "positions")
+    if decoded is not None and key in decoded: return decoded[key]
+    values = decode_varints(lists.positions[lists.position_offsets[row]:lists.position_offsets[row + 1]])
+    result = np.concatenate(([0], np.cumsum(values[:postingCount]))), values[postingCount:]
+    if decoded is not None: decoded[key] = result
+    return result
+
+# Find the pages whose field contains the stems in order, with at most slop other words between consecutive stems
+# The posting lists of the stems are intersected first, so only the positions of pages containing every stem are decoded
+def phraseMatches(index: SearchIndex, stems: list[str], slop: int, lists: PostingLists) -> set[int]:
+    rows = [wordRow(index, encode_string(word)) for word in stems]
+    if None in rows: return set()
+    postings = [postingList(lists, row, index.decoded)[0] for row in rows]
+    postingsTouched.inc(sum(len(documents) for documents in postings))
+    positions = [positionList(lists, row, len(documents), index.decoded) for row, documents in zip(rows, postings)]
+    candidates = postings[0]
+    for documents in postings[1:]:
+        candidates = np.intersect1d(candidates, documents, assume_unique=True)
+    matches = set()
+    for document in candidates.tolist():
+        reachable = None
+        for documents, (starts, gaps) in zip(postings, positions):
+            posting = np.searchsorted(documents, document)
+            wordPositions = np.cumsum(gaps[starts[posting]:starts[posting + 1]]).tolist()
+            # Keep the positions that follow a reachable position of the previous stem closely enough
+            reachable = wordPositions if reachable is None else [position for position in wordPositions if (previous := bisect_left(reachable, position)) and reachable[previous - 1] >= position - 1 - slop]
+            if not reachable: break
+        if reachable: matches.add(int(index.docIds[document]))
+    return matches
+
+# Filter documents based on phrases, a document must contain every phrase in its title or body
+# Returns None if there is no phrase to filter by
+def phraseFilter(index: SearchIndex, phrases: list[tuple[list[str], int]]) -> set[int] | None:
+    allowed = None
+    for stems, slop in phrases:
+        # A phrase made of stopwords only does not restrict the results
+        if not stems: continue
+        matches = phraseMatches(index, stems, slop, index.title) | phraseMatches(index, stems, slop, index.text)
+        allowed = matches if allowed is None else allowed & matches
+    return allowed
+
+# Calculate the dot products of the query vector with the field of every document containing a query word in the field
+# This is one sparse matrix-vector product over the posting lists of the query words, returns the document rows and their dot products
+def dotProducts(index: SearchIndex, vector1: dict[int, float], lists: PostingLists) -> tuple[np.ndarray, np.ndarray]:
+    magnitude = math.sqrt(sum(value**2 for value in vector1.values())) or 1
+    documents, contributions = [], []
+    for word, value in vector1.items():
+        row = wordRow(index, word)
+        if row is None: continue
+        rowDocuments, counts = postingList(lists, row, index.decoded)
+        documents.append(rowDocuments)
+        contributions.append(counts * lists.idf[row] / lists.max_counts[rowDocuments] * (value / magnitude * 50))
+    candidates, positions = np.unique(np.concatenate(documents or [np.empty(0, dtype=np.int64)]), return_inverse=True)
+    postingsTouched.inc(len(positions))
+    return candidates, np.bincount(positions, weights=np.concatenate(contributions or [np.empty(0)]), minlength=len(candidates))
+
+# Find the rows of the documents containing a query word in their title or body and every phrase
+def candidateRows(index: SearchIndex, fields: list[tuple[np.ndarray, np.ndarray]], allowed: set[int] | None) -> np.ndarray:
+    rows = np.union1d(fields[0][0], fields[1][0])
+    if allowed is not None: rows = rows[np.isin(index.docIds[rows], np.fromiter(allowed, dtype=np.int64, count=len(allowed)))]
+    return rows
+
+# Calculate the cosine similarity (scaled by 50) between the query vector and the field of each candidate document
+# Every candidate is scored in both fields, with 0 if the field contains no query word, since the scores are normalized by their maximum
+def cosineScores(lists: PostingLists, rows: np.ndarray, field: tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+    documents, dot_products = field
+    scores = np.zeros(len(rows))
+    if len(documents):
+        positions = np.minimum(np.searchsorted(documents, rows), len(documents) - 1)
+        found = documents[positions] == rows
+        scores[found] = dot_products[positions[found]]
+    norms = lists.norms[rows]
+    return np.divide(scores, norms, out=scores, where=norms != 0)
+
+# Keep the k highest and the k lowest scores of a field, equal scores are ranked by the position of their pages
+# The scores are normalized by their maximum later, which reverses their order if it is negative, so the best normalized scores are among either
+def extremeScores(documents: np.ndarray, positions: np.ndarray, scores: np.ndarray, k: int) -> dict[int, float]:
+    kept = np.union1d(np.lexsort((positions, -scores))[:k], np.lexsort((positions, scores))[:k])
+    return dict(zip(documents[kept].tolist(), scores[kept].tolist()))
+
+# Select the top results with a bounded heap
+def topResults(scores: dict[int, float], k: int = MAX_RESULTS) -> dict[int, float]:
+    return dict(heapq.nlargest(k, scores.items(), key=lambda item: item[1]))
 
 # Start searching
-def search_engine(query: str, related_doc: int = -1) -> dict[int, float]:
+def search_engine(query: str, related_doc: int = -1, index: SearchIndex = None, limit: int = MAX_RESULTS) -> dict[int, float]:
     """ Returns a dictionary containing the search results. A related document can be optinally specified to improve the search results.
+    Only the posting lists of the query words are traversed, so the cost depends on their lengths rather than on the number of documents.
+    Results are cached by query key until they expire or a new index snapshot is loaded.
 
     Args:
         query (str): The search query.
         related_doc (int, optional): The ID of a related document to improve the search results. Defaults to -1.
+        index (SearchIndex, optional): The index to search. Defaults to the current index.
+        limit (int, optional): The maximum number of results, at most MAX_RANKED_RESULTS. Defaults to MAX_RESULTS.
+    """
+    return dict(rankedResults(query, related_doc, index, limit))
+
+def rankedResults(query: str, related_doc: int = -1, index: SearchIndex = None, limit: int = MAX_RESULTS) -> tuple[tuple[int, float], ...]:
+    """ Returns the search results as (page ID, score) pairs from the best, like search_engine.
+    The returned pairs are the cached ones rather than a copy, so a page of the results is a slice of them.
     """
-    if not query: return {}
-    splitted_query = parser(query)
+    if not query: return ()
+    index = currentIndex() if index is None else index
+    with searchStages.time("parse"):
+        key = queryKey(query, related_doc, index)
+    results = resultCache.get((key, limit), index.generation)
+    searchCalls.inc(1, "false" if results is None else "true")
+    if results is None:
+        results = tuple(rankDocuments(index, [list(key[0]), list(key[1])], related_doc, limit).items())
+        resultCache.put((key, limit), results, index.generation)
+    return results
+
+# Rank the documents for a chunk of distinct query keys of an index generation, with the posting lists shared by the queries decoded once
+# Returns the generation that was ranked, which is newer than the requested one if a newer snapshot was already loaded
+def rankChunk(chunk: tuple[int, list[tuple]]) -> tuple[int, list[tuple[tuple, dict[int, float]]]]:
+    generation, keys = chunk
+    index = currentIndex(generation)._replace(decoded={})
+    return index.generation, [(key, rankDocuments(index, [list(key[0]), list(key[1])], key[2])) for key in keys]
+
+def batch_search(queries, processes: int = 1):
+    """ Yields the search results of many queries, in the order in which they are computed rather than the order of the queries.
+    Identical queries are ranked once, and queries sharing words are ranked together so their posting lists are decoded once.
+    The results are cached like those of search_engine.
+
+    Args:
+        queries: Iterable of queries, each a query string or a (query string, related document ID) pair.
+        processes (int, optional): The number of worker processes ranking the queries. The workers map the same index snapshot. Defaults to 1.
+
+    Yields:
+        (int, dict[int, float]): The position of a query in queries and its search results.
+    """
+    index = currentIndex()
+    pending = {} # {query key: [positions of the queries with the key]}
+    for position, query in enumerate(queries):
+        query, related_doc = (query, -1) if isinstance(query, str) else query
+        if not query:
+            yield position, {}
+            continue
+        key = queryKey(query, related_doc, index)
+        results = resultCache.get((key, MAX_RESULTS), index.generation)
+        if results is not None: yield position, dict(results)
+        else: pending.setdefault(key, []).append(position)
+    # Sorted keys put queries starting with the same words into the same chunk
+    keys = sorted(pending)
+    chunks = [(index.generation, keys[start:start + BATCH_CHUNK_SIZE]) for start in range(0, len(keys), BATCH_CHUNK_SIZE)]
+    # Workers are spawned rather than forked, since other threads may hold the locks of the index and the metrics at the time of the fork
+    pool = multiprocessing.get_context("spawn").Pool(processes, useShard, (*shard, snapshotPath)) if processes > 1 else None
+    with pool or nullcontext():
+        for generation, ranked in pool.imap_unordered(rankChunk, chunks) if pool else map(rankChunk, chunks):
+            for key, results in ranked:
+                if generation == index.generation:
+                    resultCache.put((key, MAX_RESULTS), tuple(results.items()), index.generation)
+                for position in pending[key]:
+                    yield position, dict(results)
+
+# Rank the documents for a parsed query, in the shard workers if there are any
+def rankDocuments(index: SearchIndex, splitted_query: list[list], related_doc: int = -1, limit: int = MAX_RESULTS) -> dict[int, float]:
     vector1 = queryToVec(splitted_query[0])
 
     # Query modification
     if related_doc != -1:
-        related_doc = cursor.execute("SELECT page_id FROM pages WHERE page_id = ?", (related_doc,)).fetchone()
-        if not related_doc: return {}
-        related_doc = related_doc[0]
-        document_vec = documentToVec(related_doc)
-        document_vec = {word: score / 2 for word, score in document_vec.items()}
-        vector1 = {word: score + document_vec.get(word, 0) for word, score in vector1.items()}
+        with searchStages.time("related_doc"):
+            document_vec = relatedVector(index, related_doc, vector1)
+            if document_vec is None: return {}
+            document_vec = {word: score / 2 for word, score in document_vec.items()}
+            vector1 = {word: score + document_vec.get(word, 0) for word, score in vector1.items()}
         
     if not splitted_query[0]: return {}
-    title_cosinescores, text_cosinescores = {}, {}
-    for document in allDocs:
-        document = document[0]
-        if splitted_query[1] and not phraseFilter(document, splitted_query[1]): continue
-        if not queryFilter(document, splitted_query[0]): continue
-        title_vector2, text_vector2 = Title_globalPageDict[document], Text_globalPageDict[document]
-        title_cosinescores[document] = cosinesimilarity(vector1, title_vector2)
-        text_cosinescores[document] = cosinesimilarity(vector1, text_vector2)
-    # Normalize scores
-    def normalize_scores(scores: dict[int, float]) -> dict[int, float]:
-        max_score = max(scores.values(), default=1)
-        return {key: (value / max_score) * 50 for key, value in scores.items()} if max_score != 0 else scores
-    title_cosinescores = normalize_scores(title_cosinescores)
-    text_cosinescores = normalize_scores(text_cosinescores)
-    # Sort and limit results
-    title_cosinescores = dict(sorted(title_cosinescores.items(), key=lambda item: item[1], reverse=True)[:MAX_RESULTS])
-    text_cosinescores = dict(sorted(text_cosinescores.items(), key=lambda item: item[1], reverse=True)[:MAX_RESULTS])
-    # Combine title and text scores with weights
-    combined_Scores = {key: 0.3 * title_cosinescores.get(key, 0) + 0.7 * text_cosinescores.get(key, 0) for key in set(title_cosinescores) | set(text_cosinescores)}
-    # Calculate ranking scores
-    RankingScore = {page_id: score for page_id, score in cursor.execute(f"SELECT page_id, score FROM page_ranks WHERE page_id IN ({','.join('?' for _ in combined_Scores)})", tuple(combined_Scores.keys())).fetchall()}
-    combined_Scores = {page_id: score * RankingScore.get(page_id, 0) for page_id, score in combined_Scores.items()}
-    scores = normalize_scores(combined_Scores)
-    return dict(sorted(scores.items(), key=lambda item: item[1], reverse=True)[:MAX_RESULTS])
-
-# Populate global dictionaries
-allDocs = cursor.execute("SELECT page_id FROM pages").fetchall()
-for doc in allDocs:
-    doc = doc[0]
-    Title_globalPageDict[doc] = documentToVec(doc, True)
-    Text_globalPageDict[doc] = documentToVec(doc)
-    Title_globalPageStemText[doc] = ' '.join(stem_words(remove_stop_words(cursor.execute("SELECT clean_title FROM pages WHERE page_id = ?", (doc,)).fetchone()[0].split())))
-    Text_globalPageStemText[doc] = ' '.join(stem_words(remove_stop_words(cursor.execute("SELECT clean_body FROM pages WHERE page_id = ?", (doc,)).fetchone()[0].split())))
-globalWordtoID = {word: word_id for word_id, word in cursor.execute("SELECT keyword_id, keyword FROM keywords").fetchall()}
\ No newline at end of file
+    if shardClients is None: return mergeScores([partialScores(index, vector1, splitted_query[1], limit)], limit)
+    with searchStages.time("shard_fan_out"):
+        return mergeScores(shardClients.partial_scores(index.generation, vector1, splitted_query[1], limit), limit)
+
+# Score the documents of an index, which may be a shard, for a query vector
+# Returns the k highest and k lowest title and body cosine scores, and the PageRank scores and positions of their documents, which is all mergeScores needs
+# Every shard holds the document frequencies of all documents, so the cosine scores of a shard equal those of the whole index
+def partialScores(index: SearchIndex, vector1: dict[int, float], phrases: list[tuple[list[str], int]], k: int = MAX_RESULTS) -> tuple[dict[int, float], dict[int, float], dict[int, float], dict[int, int]]:
+    with searchStages.time("phrase_filter"):
+        allowed = phraseFilter(index, phrases)
+    with searchStages.time("cosine_scoring"):
+        fields = [dotProducts(index, vector1, lists) for lists in (index.title, index.text)]
+        rows = candidateRows(index, fields, allowed)
+        candidatesScored.inc(len(rows))
+        title_cosinescores = extremeScores(index.docIds[rows], index.positions[rows], cosineScores(index.title, rows, fields[0]), k)
+        text_cosinescores = extremeScores(index.docIds[rows], index.positions[rows], cosineScores(index.text, rows, fields[1]), k)
+    documents = sorted(set(title_cosinescores) | set(text_cosinescores))
+    documentRows = np.searchsorted(index.docIds, documents)
+    RankingScore = index.pageRanks[documentRows].tolist() if documents else []
+    Positions = index.positions[documentRows].tolist() if documents else []
+    return title_cosinescores, text_cosinescores, dict(zip(documents, RankingScore)), dict(zip(documents, Positions))
+
+# Normalize scores so that the best one is 50
+def normalizeScores(scores: dict[int, float]) -> dict[int, float]:
+    max_score = max(scores.values(), default=1)
+    return {key: (value / max_score) * 50 for key, value in scores.items()} if max_score != 0 else scores
+
+# Combine the partial scores of the shards into the ranked search results
+# The best normalized scores of the whole index are among the highest or lowest scores of their shards, and each field is normalized by its highest score of all shards
+def mergeScores(partials, limit: int = MAX_RESULTS) -> dict[int, float]:
+    with searchStages.time("page_rank"):
+        title_cosinescores, text_cosinescores, RankingScore, Positions = {}, {}, {}, {}
+        for title_partial, text_partial, ranks_partial, positions_partial in partials:
+            title_cosinescores.update(title_partial)
+            text_cosinescores.update(text_partial)
+            RankingScore.update(ranks_partial)
+            Positions.update(positions_partial)
+        # Documents are ordered by their position in the pages table, so ties are broken like the pages were crawled for any number of shards
+        title_cosinescores = topResults(normalizeScores(dict(sorted(title_cosinescores.items(), key=lambda item: Positions[item[0]]))), limit)
+        text_cosinescores = topResults(normalizeScores(dict(sorted(text_cosinescores.items(), key=lambda item: Positions[item[0]]))), limit)
+        # Combine title and text scores with weights
+        combined_Scores = {key: 0.3 * title_cosinescores.get(key, 0) + 0.7 * text_cosinescores.get(key, 0) for key in sorted(set(title_cosinescores) | set(text_cosinescores), key=Positions.get)}
+        # Calculate ranking scores
+        combined_Scores = {page_id: score * RankingScore[page_id] for page_id, score in combined_Scores.items()}
+        scores = normalizeScores(combined_Scores)
+        return dict(sorted(topResults(scores, limit).items(), key=lambda item: item[1], reverse=True))
+
+# Load one shard of the pages instead of all pages, in a shard worker
+def useShard(number: int, count: int, path: str = SNAPSHOT_PATH) -> None:
+    global globalIndex, snapshotPath, shard
+    snapshotPath, shard = path, (number, count)
+    globalIndex = loadIndex()
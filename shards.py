@@ -0,0 +1,186 @@
+import os
+import secrets
+import argparse
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener, Client, Connection
+from multiprocessing import AuthenticationError
+from snapshot import SNAPSHOT_PATH
+import retrieval
+
+# Address local shard workers listen on, port 0 picks a free port
+LOCAL_ADDRESS = ("localhost", 0)
+
+
+class ShardError(RuntimeError):
+    """Raised when a shard worker fails to answer a request."""
+
+
+def handle(connection: Connection) -> None:
+    """Answers the requests of one client of a shard worker until it disconnects.
+    A request is a (kind, generation, arguments) tuple, and the reply an ("ok", generation, result) or ("error", message) tuple.
+    The shard is ranked in the index generation of the request if the worker has loaded it, and the reply holds the generation that was used.
+    """
+    with connection:
+        while True:
+            try:
+                kind, generation, arguments = connection.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                index = retrieval.currentIndex(generation)
+                if kind == "partial_scores":
+                    result = retrieval.partialScores(index, *arguments)
+                else:
+                    raise ValueError(f"Unknown request {kind!r}.")
+                reply = ("ok", index.generation, result)
+            except Exception as error:
+                reply = ("error", f"{type(error).__name__}: {error}")
+            connection.send(reply)
+
+
+def serve(listener: Listener, shard: int, shards: int, snapshot_path: str = SNAPSHOT_PATH) -> None:
+    """Loads a shard of the index and answers the requests of every client connecting to the listener, each in its own thread."""
+    retrieval.useShard(shard, shards, snapshot_path)
+    while True:
+        try:
+            connection = listener.accept()
+        except (AuthenticationError, EOFError, ConnectionError):
+            continue
+        threading.Thread(target=handle, args=(connection,), name="shard-client", daemon=True).start()
+
+
+def run_worker(shard: int, shards: int, snapshot_path: str, address, authkey: bytes, ready: Connection) -> None:
+    """Entry point of a local shard worker process, which sends the address it listens on through ready."""
+    with Listener(address, authkey=authkey) as listener:
+        ready.send(listener.address)
+        ready.close()
+        serve(listener, shard, shards, snapshot_path)
+
+
+class ShardClients:
+    """Connections to one shard worker per shard, opened lazily by each thread and process that searches.
+    A request is sent to every shard before any reply is read, so the shards rank a query in parallel.
+    """
+
+    def __init__(self, addresses: list, authkey: bytes, processes: list = ()):
+        """
+        Args:
+            addresses (list): The address of the worker of each shard, the position of an address is its shard.
+            authkey (bytes): The key the workers authenticate their clients with.
+            processes (list, optional): The local worker processes, terminated by close. Defaults to none.
+        """
+        self.addresses = list(addresses)
+        self.authkey = authkey
+        self.processes = list(processes)
+        self.local = threading.local()
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def connections(self) -> list:
+        # A forked process must not share the connections of its parent
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.pid, self.local.connections = os.getpid(), [None] * len(self.addresses)
+        return self.local.connections
+
+    def disconnect(self) -> None:
+        """Closes the connections of the current thread."""
+        connections = self.connections()
+        for shard, connection in enumerate(connections):
+            if connection is not None:
+                connection.close()
+                connections[shard] = None
+
+    def request(self, requests: dict) -> dict:
+        """Sends a (kind, generation, arguments) request to each of the given shards and waits for all their replies.
+
+        Args:
+            requests (dict): {shard: request}.
+
+        Returns:
+            dict: {shard: (generation, result)} of the generation each shard ranked and its result.
+        """
+        connections = self.connections()
+        replies = {}
+        try:
+            for shard, request in requests.items():
+                if connections[shard] is None:
+                    connections[shard] = Client(self.addresses[shard], authkey=self.authkey)
+                connections[shard].send(request)
+            for shard in requests:
+                replies[shard] = connections[shard].recv()
+        except (EOFError, OSError) as error:
+            # Replies still in flight would be read by the next request, so every connection is opened again
+            self.disconnect()
+            raise ShardError(f"A shard worker is unreachable: {error}") from error
+        results = {}
+        for shard, reply in replies.items():
+            if reply[0] != "ok":
+                raise ShardError(f"Shard {shard} failed: {reply[1]}")
+            results[shard] = reply[1:]
+        return results
+
+    def partial_scores(self, generation: int, *arguments) -> list:
+        """Returns the partial scores of every shard for retrieval.mergeScores."""
+        results = self.request({shard: ("partial_scores", generation, arguments) for shard in range(len(self))})
+        return [self.check(generation, *results[shard]) for shard in range(len(self))]
+
+    def check(self, expected: int, generation: int, result):
+        # A worker may already have loaded a newer snapshot than the query was parsed with, which is counted but not an error
+        if generation != expected:
+            retrieval.shardMismatches.inc()
+        return result
+
+    def close(self) -> None:
+        """Closes the connections of the current thread and terminates the local worker processes."""
+        self.disconnect()
+        for process in self.processes:
+            process.terminate()
+            process.join()
+
+
+def start_local(shards: int, snapshot_path: str = SNAPSHOT_PATH) -> ShardClients:
+    """Starts one worker process per shard on this machine, listening on local ports with a random key, and routes the searches of retrieval to them."""
+    context = multiprocessing.get_context("spawn")
+    authkey = secrets.token_bytes(32)
+    processes, addresses = [], []
+    for shard in range(shards):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=run_worker, args=(shard, shards, snapshot_path, LOCAL_ADDRESS, authkey, sender), name=f"shard-{shard}", daemon=True)
+        process.start()
+        sender.close()
+        processes.append(process)
+        try:
+            addresses.append(receiver.recv())
+        except EOFError:
+            for process in processes:
+                process.terminate()
+            raise ShardError(f"The worker of shard {shard} exited before listening.") from None
+    return connect(addresses, authkey, processes)
+
+
+def connect(addresses: list, authkey: bytes, processes: list = ()) -> ShardClients:
+    """Routes the searches of retrieval to the shard workers at the addresses, the position of an address is its shard."""
+    retrieval.shardClients = ShardClients(addresses, authkey, processes)
+    return retrieval.shardClients
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    """Parses a host:port address."""
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Serves one shard of the index to the search engine.")
+    arg_parser.add_argument("--shard", type=int, required=True, help="Shard served by this worker, from 0 to the number of shards minus 1.")
+    arg_parser.add_argument("--shards", type=int, required=True, help="Number of shards the indexer partitioned the pages into.")
+    arg_parser.add_argument("--address", default="localhost:7100", help="host:port the worker listens on.")
+    arg_parser.add_argument("--authkey", required=True, help="Key the clients authenticate with, the same for every worker.")
+    arg_parser.add_argument("--snapshot", default=SNAPSHOT_PATH, help="Path of the index snapshot, the shard snapshots are next to it.")
+    args = arg_parser.parse_args()
+
+    with Listener(parse_address(args.address), authkey=args.authkey.encode()) as listener:
+        print(f"Serving shard {args.shard} of {args.shards} on {args.address}")
+        serve(listener, args.shard, args.shards, args.snapshot)
@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import numpy as np
+from utils import varint_lengths, encode_varints, top_per_group
+
+# Default location of the index snapshot, next to the database
+SNAPSHOT_PATH = 'index.snapshot'
+# Version of the file format, snapshots of other versions are not loaded
+SNAPSHOT_VERSION = 4
+# Bytes at the start of every snapshot file
+MAGIC = b'COMP4321'
+# Byte boundary at which every array starts
+ALIGNMENT = 64
+# Number of keywords with the largest TF-IDF weights kept in the body vector of each page
+VECTOR_TERMS = 64
+
+# (field, inverted index, forward index, norm column) of the posting lists
+FIELDS = (("title", "title_inverted_index", "title_forward_index", "title_norm"), ("body", "inverted_index", "forward_index", "body_norm"))
+
+
+def interleave_rows(parts: list[tuple[np.ndarray, np.ndarray]]) -> tuple[np.ndarray, np.ndarray]:
+    """Concatenates byte arrays split into the same rows row by row.
+    Each part is a (data, indptr) pair in which row r spans data[indptr[r]:indptr[r + 1]].
+
+    Returns:
+        data (np.ndarray): The bytes of every part for the first row, then for the second row, and so on.
+        indptr (np.ndarray): The start of each row in data.
+    """
+    lengths = [np.diff(part_indptr) for _, part_indptr in parts]
+    indptr = np.zeros(len(lengths[0]) + 1, dtype=np.int64)
+    np.cumsum(sum(lengths), out=indptr[1:])
+    data = np.empty(indptr[-1], dtype=np.uint8)
+    row_offsets = indptr[:-1].copy()
+    for (part, part_indptr), part_lengths in zip(parts, lengths):
+        rows = np.repeat(np.arange(len(part_lengths)), part_lengths)
+        data[np.arange(len(part)) - part_indptr[rows] + row_offsets[rows]] = part
+        row_offsets += part_lengths
+    return data, indptr
+
+
+def encode_rows(values: np.ndarray, indptr: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Encodes values split into rows as varints, and returns the bytes with the start of each row in them."""
+    byte_starts = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(varint_lengths(values), out=byte_starts[1:])
+    return encode_varints(values), byte_starts[indptr]
+
+
+def shard_path(path: str, shard: int, shards: int) -> str:
+    """Returns the path of the snapshot of a shard, next to the snapshot of all pages."""
+    return f"{path}.shard-{shard}-of-{shards}"
+
+
+def posting_lists(cursor, page_ids: np.ndarray, keyword_ids: np.ndarray, inverted_table: str, forward_table: str, norm_column: str, document_count: int = None, shard: int = 0, shards: int = 1, vector_terms: int = 0) -> dict[str, np.ndarray]:
+    """Encodes the postings of a field as one compressed record per keyword.
+    The postings record of a keyword holds the varint-encoded gaps between its sorted page rows, followed by its term frequencies.
+    The positions record holds the varint-encoded number of positions of each posting, followed by their position gaps.
+
+    Args:
+        page_ids (np.ndarray): The sorted page IDs, the position of a page is its page row.
+        keyword_ids (np.ndarray): The sorted keyword IDs, the position of a keyword is its record.
+        inverted_table (str): The inverted index of the field.
+        forward_table (str): The forward index of the field.
+        norm_column (str): The column of the document_norms table holding the norms of the field.
+        document_count (int, optional): The number of pages of the whole index the inverse document frequencies are computed from. Defaults to the number of page IDs.
+        shard (int, optional): The shard of the page IDs, only its postings are read. Defaults to 0.
+        shards (int, optional): The number of shards the pages are partitioned into. Defaults to 1.
+        vector_terms (int, optional): The number of keywords kept in the truncated TF-IDF vector of each page. Defaults to 0, no vectors.
+
+    Returns:
+        offsets, postings (np.ndarray): The start of each postings record and the records.
+        position_offsets, positions (np.ndarray): The start of each positions record and the records.
+        idf (np.ndarray): The inverse document frequency of each keyword.
+        max_counts (np.ndarray): The maximum term frequency of each page.
+        norms (np.ndarray): The L2 norm of the TF-IDF vector of each page.
+        vector_offsets, vector_keywords, vector_weights (np.ndarray): With vector_terms, the start of the truncated vector of each page,
+            and the keyword IDs and TF-IDF weights of the vectors, from the largest weight.
+    """
+    condition = f"WHERE page_id % {shards} = {shard}" if shards > 1 else ""
+    rows = cursor.execute(f"SELECT page_id, keyword_id, keyword_count, positions FROM {inverted_table} {condition}").fetchall()
+    posting_pages, posting_keywords, counts = (np.array(column, dtype=np.int64).reshape(-1) for column in list(zip(*rows))[:3] or ([], [], []))
+    known = np.isin(posting_pages, page_ids) & np.isin(posting_keywords, keyword_ids)
+    columns = np.searchsorted(page_ids, posting_pages[known])
+    records = np.searchsorted(keyword_ids, posting_keywords[known])
+    order = np.lexsort((columns, records))
+    columns, records, counts = columns[order], records[order], counts[known][order]
+    blobs = [rows[index][3] or b"" for index in np.flatnonzero(known)[order].tolist()]
+    indptr = np.zeros(len(keyword_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(records, minlength=len(keyword_ids)), out=indptr[1:])
+
+    # Page rows are stored as gaps from the previous page row of the keyword
+    gaps = np.diff(columns, prepend=0)
+    first_postings = indptr[:-1][indptr[:-1] < indptr[1:]]
+    gaps[first_postings] = columns[first_postings]
+    postings, offsets = interleave_rows([encode_rows(gaps, indptr), encode_rows(counts, indptr)])
+
+    # The stored positions are already varint-encoded gaps, so only the number of positions of each posting is counted
+    position_bytes = np.frombuffer(b"".join(blobs), dtype=np.uint8)
+    position_indptr = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum([len(blob) for blob in blobs], out=position_indptr[1:])
+    position_ends = np.concatenate(([0], np.cumsum(position_bytes < 0x80)))
+    position_counts = position_ends[position_indptr[1:]] - position_ends[position_indptr[:-1]]
+    positions, position_offsets = interleave_rows([encode_rows(position_counts, indptr), (position_bytes, position_indptr[indptr])])
+
+    forward_counts = np.array(cursor.execute(f"SELECT keyword_id, keyword_count FROM {forward_table}").fetchall(), dtype=np.int64).reshape(-1, 2)
+    forward_counts = forward_counts[np.isin(forward_counts[:, 0], keyword_ids) & (forward_counts[:, 1] > 0)]
+    idf = np.zeros(len(keyword_ids))
+    idf[np.searchsorted(keyword_ids, forward_counts[:, 0])] = np.log2((document_count or len(page_ids)) / forward_counts[:, 1])
+    max_counts = np.zeros(len(page_ids))
+    np.maximum.at(max_counts, columns, counts)
+    weights = counts * idf[records] / max_counts[columns]
+
+    norms = np.zeros(len(page_ids))
+    stored = np.array(cursor.execute(f"SELECT page_id, {norm_column} FROM document_norms").fetchall(), dtype=np.float64).reshape(-1, 2)
+    stored_pages = stored[:, 0].astype(np.int64)
+    in_pages = np.isin(stored_pages, page_ids)
+    norms[np.searchsorted(page_ids, stored_pages[in_pages])] = stored[in_pages, 1]
+    # Pages indexed before the norms were stored get their norms computed from the weights
+    missing = norms == 0
+    if missing.any():
+        norms[missing] = np.sqrt(np.bincount(columns, weights=weights ** 2, minlength=len(page_ids)))[missing]
+    lists = {"offsets": offsets, "postings": postings, "position_offsets": position_offsets, "positions": positions, "idf": idf, "max_counts": max_counts, "norms": norms}
+    if vector_terms:
+        # The postings are sorted by keyword, so equal weights keep the smaller keyword IDs like in the indexer
+        top = top_per_group(columns, weights, vector_terms)
+        lists["vector_offsets"] = np.zeros(len(page_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(columns[top], minlength=len(page_ids)), out=lists["vector_offsets"][1:])
+        lists["vector_keywords"], lists["vector_weights"] = keyword_ids[records[top]], weights[top]
+    return lists
+
+
+def build_snapshot(cursor, shard: int = 0, shards: int = 1) -> dict[str, np.ndarray]:
+    """Builds the arrays retrieval needs at query time from the database.
+    A snapshot of a shard holds the pages whose ID modulo shards is shard, with every keyword and the document frequencies of all pages,
+    so that the scores of its pages equal their scores in a snapshot of all pages.
+
+    Args:
+        shard (int, optional): The shard of the pages. Defaults to 0.
+        shards (int, optional): The number of shards the pages are partitioned into. Defaults to 1, a snapshot of all pages.
+
+    Returns:
+        page_ids, keyword_ids and page_ranks, and the arrays of the posting lists of each field,
+        prefixed with the field name, such as "title_postings", with the truncated vectors of the bodies in "body_vector_*".
+        page_positions: the position of each page in the pages table, by which pages with equal scores are ranked.
+        neighbor_offsets, neighbor_pages and neighbor_scores: the start of the similar pages of each page, and the IDs and similarities of the similar pages.
+    """
+    stored_pages = np.array([page_id for page_id, in cursor.execute("SELECT page_id FROM pages").fetchall()], dtype=np.int64)
+    page_ids = np.sort(stored_pages)
+    arrays = {
+        "page_ids": page_ids[page_ids % shards == shard],
+        "keyword_ids": np.array(sorted(keyword_id for keyword_id, in cursor.execute("SELECT keyword_id FROM keywords").fetchall()), dtype=np.int64),
+    }
+    stored_ranks = dict(cursor.execute("SELECT page_id, score FROM page_ranks").fetchall())
+    arrays["page_ranks"] = np.array([stored_ranks.get(page_id, 0) for page_id in arrays["page_ids"].tolist()], dtype=np.float64)
+    positions = np.argsort(stored_pages)
+    arrays["page_positions"] = positions[np.searchsorted(page_ids, arrays["page_ids"])]
+    for field, inverted_table, forward_table, norm_column in FIELDS:
+        lists = posting_lists(cursor, arrays["page_ids"], arrays["keyword_ids"], inverted_table, forward_table, norm_column, len(page_ids), shard, shards, VECTOR_TERMS if field == "body" else 0)
+        arrays.update({f"{field}_{name}": array for name, array in lists.items()})
+    arrays.update(neighbor_lists(cursor, arrays["page_ids"]))
+    return arrays
+
+
+def neighbor_lists(cursor, page_ids: np.ndarray) -> dict[str, np.ndarray]:
+    """Loads the similar pages the indexer stored for each page, from the most similar, as arrays split by page row."""
+    rows = cursor.execute("SELECT page_id, neighbor_id, score FROM page_neighbors").fetchall()
+    pages, neighbors = (np.array(column, dtype=np.int64).reshape(-1) for column in list(zip(*rows))[:2] or ([], []))
+    scores = np.array([score for _, _, score in rows], dtype=np.float64)
+    known = np.isin(pages, page_ids)
+    columns = np.searchsorted(page_ids, pages[known])
+    neighbors, scores = neighbors[known], scores[known]
+    order = np.lexsort((neighbors, -scores, columns))
+    offsets = np.zeros(len(page_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(columns, minlength=len(page_ids)), out=offsets[1:])
+    return {"neighbor_offsets": offsets, "neighbor_pages": neighbors[order], "neighbor_scores": scores[order]}
+
+
+def read_header(file) -> dict:
+    """Reads the header of a snapshot file, raising a ValueError if it is not a snapshot of the current version."""
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError("The file is not an index snapshot.")
+    header = json.loads(file.read(int.from_bytes(file.read(8), "little")))
+    if header["version"] != SNAPSHOT_VERSION:
+        raise ValueError(f"The index snapshot has version {header['version']} instead of {SNAPSHOT_VERSION}.")
+    return header
+
+
+def snapshot_generation(path: str = SNAPSHOT_PATH) -> int:
+    """Returns the generation of the snapshot, or 0 if there is no readable snapshot."""
+    try:
+        with open(path, "rb") as file:
+            return read_header(file)["generation"]
+    except (OSError, ValueError):
+        return 0
+
+
+def next_generation(path: str = SNAPSHOT_PATH) -> int:
+    """Returns the generation of a new snapshot replacing the one at the path.
+    Generations are timestamps in microseconds, so they keep increasing when the old snapshot was deleted or has an older version,
+    and a search engine never loads a different index under a generation it already had.
+    """
+    return max(snapshot_generation(path) + 1, time.time_ns() // 1000)
+
+
+def write_snapshot(arrays: dict[str, np.ndarray], path: str = SNAPSHOT_PATH, generation: int = None) -> int:
+    """Writes the arrays to a new snapshot file and returns its generation.
+    The file is written next to the old snapshot and renamed over it, so readers never see a partial snapshot.
+    The generation defaults to next_generation.
+    """
+    generation = next_generation(path) if generation is None else generation
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    entries, offset = {}, 0
+    for name, array in arrays.items():
+        entries[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({"version": SNAPSHOT_VERSION, "generation": generation, "arrays": entries}).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(MAGIC + len(header).to_bytes(8, "little") + header)
+        for name, array in arrays.items():
+            file.seek(data_start + entries[name]["offset"])
+            array.tofile(file)
+        file.truncate(data_start + offset)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+    return generation
+
+
+def load_snapshot(path: str = SNAPSHOT_PATH) -> tuple[int, dict[str, np.ndarray]]:
+    """Memory-maps the arrays of a snapshot file without reading them.
+    Pages of the file are read from disk when they are first accessed, and are shared by all processes mapping the file.
+
+    Returns:
+        generation (int): The generation of the snapshot.
+        arrays (dict[str, np.ndarray]): The read-only arrays of the snapshot.
+    """
+    with open(path, "rb") as file:
+        header = read_header(file)
+        data_start = -(-file.tell() // ALIGNMENT) * ALIGNMENT
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        dtype, shape = np.dtype(entry["dtype"]), tuple(entry["shape"])
+        # Empty arrays cannot be memory-mapped
+        if np.prod(shape) == 0:
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=data_start + entry["offset"], shape=shape)
+    return header["generation"], arrays
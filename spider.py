@@ -1,30 +1,238 @@
-from bs4 import BeautifulSoup as bsoup
+from lxml import etree
 import requests
+from requests.adapters import HTTPAdapter
 from email.utils import parsedate_to_datetime
 from datetime import datetime
 from urllib.parse import urljoin, urlparse
-from utils import encode_string
+from utils import encode_string, BloomFilter
+from fingerprint import FingerprintIndex, content_hash, simhash
+from storage import BatchWriter, BATCH_SIZE, bulk_load, create_indexes
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from collections import deque, namedtuple
+import argparse
+import multiprocessing
+import threading
 import sqlite3
+import time
+import os
 import re
 
+# Number of pages fetched concurrently
+MAX_WORKERS = 8
+# Politeness limits applied to every host
+HOST_CONCURRENCY = 2 # Maximum in-flight requests per host
+HOST_DELAY = 0.25 # Minimum seconds between two requests to the same host
+# Number of processes extracting the fetched pages, 0 to extract them in the fetching threads
+PARSE_PROCESSES = os.cpu_count() or 1
+# Maximum number of characters of text kept per page
+MAX_TEXT_LENGTH = 1000000
+# Number of characters fed to the HTML parser at a time
+FEED_SIZE = 65536
+# Tags whose text is not part of the page text, as in BeautifulSoup's get_text
+HIDDEN_TAGS = frozenset(("script", "style", "template", "rt", "rp"))
+# Runs of characters other than letters, hyphens and spaces, which are replaced by a space when cleaning text
+NON_WORD_CHARACTERS = re.compile("[^a-zA-Z -]+")
 
-def parse_html(url: str) -> tuple:
-    """Returns the BeautifulSoup object, last modification date, and size of the page.
-    Returns empty content if an error is encountered.
+# Title, cleaned title, cleaned text, normalized child links and fingerprints of a page, see fingerprint.py
+ExtractedPage = namedtuple("ExtractedPage", ["title", "clean_title", "clean_body", "links", "content_hash", "simhash"])
+
+_thread_local = threading.local()
+
+
+def get_session() -> requests.Session:
+    """Returns the HTTP session of the current thread, creating it on first use.
+    Sessions keep connections alive so consecutive fetches to a host reuse the same socket.
+    """
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        # A thread has a single request in flight, so one pooled connection per host is enough
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=1)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _thread_local.session = session
+    return session
+
+
+class HostLimiter:
+    """Limits the number of in-flight requests and the request rate for each host."""
+
+    def __init__(self, max_concurrency: int = HOST_CONCURRENCY, min_interval: float = HOST_DELAY):
+        self.max_concurrency = max_concurrency
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._semaphores = {} # {host: semaphore}
+        self._next_slot = {} # {host: earliest time the next request may start}
+
+    @contextmanager
+    def limit(self, url: str):
+        """Blocks until a request to the host of the URL is allowed, and holds a slot while it runs."""
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_concurrency)
+            semaphore = self._semaphores[host]
+        with semaphore:
+            with self._lock:
+                now = time.monotonic()
+                slot = max(now, self._next_slot.get(host, now))
+                self._next_slot[host] = slot + self.min_interval
+            if slot > now:
+                time.sleep(slot - now)
+            yield
+
+
+def page_timestamp(headers) -> int:
+    """Returns the last modification date announced by the response headers as a timestamp."""
+    return int(datetime.timestamp(parsedate_to_datetime(headers.get("last-modified", headers["Date"]))))
+
+
+def is_unmodified(headers, validators: tuple) -> bool:
+    """Checks whether the response headers describe the same version of the page as the previous crawl.
+
+    Args:
+        headers: The response headers.
+        validators (tuple): The ETag, Last-Modified header and last modification date stored by the previous crawl.
+    """
+    etag, _, last_modification_date = validators
+    if etag and headers.get("etag"):
+        return headers["etag"] == etag
+    return last_modification_date >= page_timestamp(headers)
+
+
+def clean_text(text: str) -> str:
+    """Lowercases the text and replaces every run of characters other than letters and hyphens in each word by a space.
+    The words are separated by single spaces, so the result is the same as cleaning every whitespace-separated word on its own.
+    """
+    return NON_WORD_CHARACTERS.sub(" ", " ".join(text.split())).lower()
+
+
+class PageExtractor:
+    """Parser target that collects the title, text and normalized links of a page in a single pass over the parser events.
+    No document tree is built. The text is the text of get_text(separator="\n") of a BeautifulSoup tree parsed with lxml:
+    the strings of all elements except scripts, style sheets, templates and ruby annotations, split at every tag and comment.
+    """
+
+    def __init__(self, url: str, max_text_length: int = MAX_TEXT_LENGTH):
+        self.url = url
+        self.max_text_length = max_text_length
+        self.text = []
+        self.text_length = 0
+        self.hidden = 0 # Number of open tags whose text is hidden
+        self.title = None # Strings of the first title, None until a title is found
+        self.in_title = False
+        self.links = []
+        self.resolved = {} # {href: normalized link}, since pages tend to repeat their links
+
+    def start(self, tag, attrib):
+        self.text.append("\n")
+        if tag in HIDDEN_TAGS:
+            self.hidden += 1
+        elif tag == "title" and self.title is None:
+            self.title, self.in_title = [], True
+        elif tag == "a" and "href" in attrib:
+            href = attrib["href"]
+            link = self.resolved.get(href)
+            if link is None:
+                link = self.resolved[href] = normalize_url(urljoin(self.url, href)).rstrip("/")
+            self.links.append(link)
+
+    def end(self, tag):
+        self.text.append("\n")
+        if tag in HIDDEN_TAGS:
+            self.hidden = max(0, self.hidden - 1)
+        elif tag == "title":
+            self.in_title = False
+
+    def data(self, data):
+        if self.in_title:
+            self.title.append(data)
+        if not self.hidden and self.text_length < self.max_text_length:
+            data = data[:self.max_text_length - self.text_length]
+            self.text.append(data)
+            self.text_length += len(data)
+
+    def comment(self, text):
+        self.text.append("\n")
+
+    def pi(self, target, data=None):
+        self.text.append("\n")
+
+    def doctype(self, *args):
+        self.text.append("\n")
+
+    def close(self) -> ExtractedPage:
+        title = "".join(self.title) if self.title else "No Title"
+        clean_title, clean_body = clean_text(title), clean_text("".join(self.text))
+        return ExtractedPage(title, clean_title, clean_body, self.links, content_hash(clean_title, clean_body), simhash(clean_body))
+
+
+def extract_page(url: str, html: str, max_text_length: int = MAX_TEXT_LENGTH) -> ExtractedPage:
+    """Extracts the title, text and child links of a page, feeding the HTML to lxml's parser in chunks.
+
+    Args:
+        url (str): The URL of the page, against which relative links are resolved.
+        html (str): The HTML of the page.
+        max_text_length (int, optional): The maximum number of characters of text kept. Defaults to MAX_TEXT_LENGTH.
+    """
+    parser = etree.HTMLParser(target=PageExtractor(url, max_text_length), recover=True)
+    for start in range(0, len(html), FEED_SIZE):
+        parser.feed(html[start:start + FEED_SIZE])
+    return parser.close()
+
+
+def parse_html(url: str, limiter: HostLimiter = None, validators: tuple = None, head_first: bool = False, extractors: ProcessPoolExecutor = None) -> tuple:
+    """Returns the extracted page, last modification date, size and cache validators of the page.
+    If the validators of a previous crawl are given, the page is requested conditionally and the page is None when
+    the page has not been modified, in which case the body is neither downloaded nor parsed.
+    Returns None if the page no longer exists, and empty content if an error is encountered.
+
+    Args:
+        url (str): The URL of the page.
+        limiter (HostLimiter, optional): Per-host politeness limits to respect. Defaults to None.
+        validators (tuple, optional): The ETag, Last-Modified header and last modification date stored by the previous crawl. Defaults to None.
+        head_first (bool, optional): Whether to send a HEAD request first, for servers that ignore conditional headers. Defaults to False.
+        extractors (ProcessPoolExecutor, optional): The processes the page is extracted in. Defaults to extracting it in the calling thread.
 
     Returns:
-        soup (BeautifulSoup): The parsed HTML content of the page.
+        page (ExtractedPage): The title, text and child links of the page, or None if the page has not been modified.
         last_modification_date (int): The last modification date of the page as a timestamp.
         size (int): The size of the page in bytes.
+        etag (str): The ETag header of the page.
+        last_modified (str): The Last-Modified header of the page.
     """
     if not url.startswith(('https://', 'http://')):
         url = 'https://' + url
+    headers = {}
+    if validators:
+        if validators[0]:
+            headers["If-None-Match"] = validators[0]
+        if validators[1]:
+            headers["If-Modified-Since"] = validators[1]
     try:
-        request = requests.get(url, verify=False, timeout=30)
-        soup = bsoup(request.text, "lxml")
-        last_modification_date = int(datetime.timestamp(parsedate_to_datetime(request.headers.get("last-modified", request.headers["Date"]))))
-        size = int(request.headers.get("content-length", len(request.content)))
-        return soup, last_modification_date, size
+        with limiter.limit(url) if limiter else nullcontext():
+            session = get_session()
+            if validators and head_first:
+                head = session.head(url, headers=headers, verify=False, timeout=30, allow_redirects=True)
+                if head.status_code in (404, 410):
+                    return None
+                if head.status_code == 304 or (head.ok and is_unmodified(head.headers, validators)):
+                    return None, validators[2], None, validators[0], validators[1]
+            # Stream the response so that the body is only downloaded when the page has been modified
+            with session.get(url, headers=headers, verify=False, timeout=30, stream=True) as request:
+                if request.status_code in (404, 410):
+                    return None
+                if request.status_code == 304 or (validators and is_unmodified(request.headers, validators)):
+                    return None, validators[2], None, validators[0], validators[1]
+                content = request.content
+                text = request.text
+                response_headers = request.headers
+        # The fetching thread waits without holding the GIL while another process parses the page
+        page = extractors.submit(extract_page, url, text).result() if extractors else extract_page(url, text)
+        last_modification_date = page_timestamp(response_headers)
+        size = int(response_headers.get("content-length", len(content)))
+        return page, last_modification_date, size, response_headers.get("etag"), response_headers.get("last-modified")
     except Exception as e:
         print(f"Error: {str(e)}")
         return tuple()
@@ -32,18 +240,19 @@ def parse_html(url: str) -> tuple:
 
 def normalize_url(url: str) -> str:
     """Normalizes the URL."""
-    return f"{urlparse(url).scheme}://{urlparse(url).netloc}{urlparse(url).path}"
+    parts = urlparse(url)
+    return f"{parts.scheme}://{parts.netloc}{parts.path}"
 
 
-def get_child_links(url: str, soup: bsoup) -> list[str]:
+def get_child_links(page: ExtractedPage) -> list[str]:
     """Returns a list of normalized links present on a page."""
-    if not soup:
+    if not page:
         return []
-    return [f"{urlparse(urljoin(url, anchor['href'])).scheme}://{urlparse(urljoin(url, anchor['href'])).netloc}{urlparse(urljoin(url, anchor['href'])).path}".rstrip("/") for anchor in soup.findAll("a", href=True)]
+    return page.links
 
 
-def get_information(current_url: str, soup: bsoup):
-    """Extracts information from a page and returns the terms.
+def get_information(current_url: str, page: ExtractedPage):
+    """Returns the information of an extracted page.
 
     Returns:
         current_page_id (int): The ID of the current page computed with CRC32.
@@ -52,15 +261,12 @@ def get_information(current_url: str, soup: bsoup):
         clean_title (str): The cleaned title of the page.
         normalized_url (str): The normalized URL of the page.
     """
-    if not soup:
+    if not page:
         return None, None, None, None
 
-    title = soup.title.string if soup.title else "No Title"
     normalized_url = normalize_url(current_url)
     current_page_id = encode_string(normalized_url)
-    clean_title = ' '.join([re.sub("[^a-zA-Z-]+", " ", word).lower() for word in title.split() if word])
-    clean_body = ' '.join([re.sub("[^a-zA-Z-]+", " ", word).lower() for word in soup.get_text(separator="\n").split() if word])
-    return current_page_id, title, clean_body, clean_title, normalized_url
+    return current_page_id, page.title, page.clean_body, page.clean_title, normalized_url
 
 
 def init_db() -> None:
@@ -79,9 +285,16 @@ def init_db() -> None:
             title TEXT NOT NULL,
             url TEXT NOT NULL,
             clean_body TEXT NOT NULL,
-            clean_title TEXT NOT NULL
+            clean_title TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT
         );
     """)
+    # Add the cache validator columns to databases created before they existed
+    columns = [column[1] for column in cursor.execute("PRAGMA table_info(pages)").fetchall()]
+    for column in ("etag", "last_modified"):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE pages ADD COLUMN {column} TEXT")
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS forward_index (
             keyword_id INTEGER NOT NULL,
@@ -94,6 +307,7 @@ def init_db() -> None:
             page_id INTEGER NOT NULL,
             keyword_id INTEGER NOT NULL,
             keyword_count INTEGER NOT NULL,
+            positions BLOB,
             FOREIGN KEY (page_id) REFERENCES pages (page_id) ON DELETE CASCADE,
             FOREIGN KEY (keyword_id) REFERENCES keywords (keyword_id) ON DELETE CASCADE
         );
@@ -110,10 +324,16 @@ def init_db() -> None:
             page_id INTEGER NOT NULL,
             keyword_id INTEGER NOT NULL,
             keyword_count INTEGER NOT NULL,
+            positions BLOB,
             FOREIGN KEY (page_id) REFERENCES pages (page_id) ON DELETE CASCADE,
             FOREIGN KEY (keyword_id) REFERENCES keywords (keyword_id) ON DELETE CASCADE
         );
     """)
+    # Add the word position columns to databases created before they existed, the pages need a full re-index to fill them
+    for table in ("inverted_index", "title_inverted_index"):
+        columns = [column[1] for column in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+        if "positions" not in columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN positions BLOB")
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS parent_child (
             parent_id INTEGER NOT NULL,
@@ -122,6 +342,39 @@ def init_db() -> None:
             FOREIGN KEY (child_id) REFERENCES pages (page_id) ON DELETE CASCADE
         );
     """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS page_changes (
+            page_id INTEGER PRIMARY KEY,
+            change TEXT NOT NULL
+        );
+    """)
+    # Exact and near-duplicate pages are stored as aliases of a canonical page, which is the only one indexed
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS page_aliases (
+            page_id INTEGER PRIMARY KEY,
+            canonical_id INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            last_modification_date INTEGER NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            FOREIGN KEY (canonical_id) REFERENCES pages (page_id) ON DELETE CASCADE
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS page_fingerprints (
+            page_id INTEGER PRIMARY KEY,
+            content_hash INTEGER NOT NULL,
+            simhash INTEGER,
+            FOREIGN KEY (page_id) REFERENCES pages (page_id) ON DELETE CASCADE
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS frontier (
+            position INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT NOT NULL UNIQUE,
+            done INTEGER NOT NULL DEFAULT 0
+        );
+    """)
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS page_ranks (
             page_id INTEGER PRIMARY KEY,
@@ -129,61 +382,266 @@ def init_db() -> None:
             FOREIGN KEY (page_id) REFERENCES pages (page_id) ON DELETE CASCADE           
         );
     """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS page_keywords (
+            page_id INTEGER NOT NULL,
+            keyword TEXT NOT NULL,
+            keyword_count INTEGER NOT NULL,
+            FOREIGN KEY (page_id) REFERENCES pages (page_id) ON DELETE CASCADE
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS document_norms (
+            page_id INTEGER PRIMARY KEY,
+            title_norm REAL NOT NULL,
+            body_norm REAL NOT NULL,
+            FOREIGN KEY (page_id) REFERENCES pages (page_id) ON DELETE CASCADE
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS page_neighbors (
+            page_id INTEGER NOT NULL,
+            neighbor_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            FOREIGN KEY (page_id) REFERENCES pages (page_id) ON DELETE CASCADE
+        );
+    """)
     connection.commit()
+    create_indexes(connection)
+
 
+def load_fingerprints(writer: BatchWriter) -> FingerprintIndex:
+    """Loads the fingerprints of the canonical pages. Pages crawled before fingerprints were stored get their fingerprints computed from their stored text."""
+    missing = cursor.execute('''
+        SELECT pages.page_id, pages.clean_title, pages.clean_body FROM pages
+        LEFT JOIN page_fingerprints ON page_fingerprints.page_id = pages.page_id
+        WHERE page_fingerprints.page_id IS NULL;
+    ''').fetchall()
+    computed = [(page_id, content_hash(clean_title, clean_body), simhash(clean_body)) for page_id, clean_title, clean_body in missing]
+    writer.executemany('INSERT INTO page_fingerprints (page_id, content_hash, simhash) VALUES (?, ?, ?)', computed)
+    return FingerprintIndex(cursor.execute('SELECT page_id, content_hash, simhash FROM page_fingerprints').fetchall() + computed)
 
-def recursively_crawl(url: str) -> None:
-    """Recursively crawls the requested page and all its child pages in a breadth-first search manner."""
-    queue = [url]
-    visited = set()
-    parent_child = [] # Stores the parent-child relations that will be inserted into the database
 
-    while len(queue) > 0:
-        current_url = queue.pop(0)
-        soup, last_modification_date, size = parse_html(current_url)
-        if cursor.execute(f'SELECT COUNT(*) FROM pages WHERE url = "{current_url}"').fetchone()[0] > 0:
-            cursor.execute(f'SELECT last_modification_date FROM pages WHERE url = "{current_url}"')
-            # Skip if the page has not been modified since the last crawl
-            if cursor.fetchone()[0] >= last_modification_date:
+def reset_aliases(writer: BatchWriter, page_id: int, new_canonicals: set) -> None:
+    """Clears the cache validators of the aliases of a page, so they are downloaded and fingerprinted again by the next crawl.
+    The aliases are kept rather than deleted, since unmodified parent pages only queue the children that are stored as a page or an alias.
+
+    Args:
+        new_canonicals (set): The canonical pages of the aliases stored since the batch was last written, cleared once it is written.
+    """
+    # The writer may run the update before the insertion of a new alias of the page buffered in the same batch, which would keep the alias unchanged
+    if page_id in new_canonicals:
+        writer.flush()
+        new_canonicals.clear()
+    writer.execute('UPDATE page_aliases SET last_modification_date = 0, etag = NULL, last_modified = NULL WHERE canonical_id = ?', (page_id,))
+
+
+def retire_canonical(writer: BatchWriter, page_id: int, new_canonicals: set) -> None:
+    """Removes a page that is no longer a canonical page from the pages and marks it as deleted for the indexer.
+    Its aliases are reset, so they are downloaded and fingerprinted again by the next crawl.
+    """
+    writer.execute('DELETE FROM pages WHERE page_id = ?', (page_id,))
+    writer.execute('DELETE FROM page_fingerprints WHERE page_id = ?', (page_id,))
+    reset_aliases(writer, page_id, new_canonicals)
+    writer.execute('INSERT OR REPLACE INTO page_changes (page_id, change) VALUES (?, ?)', (page_id, 'deleted'))
+
+
+def stored_child_links(url: str) -> list[str]:
+    """Returns the URLs of the child pages and aliases of the page stored by the previous crawl."""
+    return [child_url for child_url, in cursor.execute('''
+        SELECT pages.url FROM parent_child JOIN pages ON pages.page_id = parent_child.child_id WHERE parent_child.parent_id = ?1
+        UNION ALL
+        SELECT page_aliases.url FROM parent_child JOIN page_aliases ON page_aliases.page_id = parent_child.child_id WHERE parent_child.parent_id = ?1;
+    ''', (encode_string(normalize_url(url)),)).fetchall()]
+
+
+class Frontier:
+    """Breadth-first crawl frontier checkpointed in the database so that an interrupted crawl can be resumed.
+    Queued URLs are kept in a deque and every URL ever queued in a set, or in a Bloom filter for very large crawls,
+    so pushing, popping and membership checks take constant time.
+    """
+
+    def __init__(self, writer: BatchWriter, resume: bool = False, bloom_capacity: int = None):
+        """
+        Args:
+            writer (BatchWriter): The writer through which the checkpoint is stored.
+            resume (bool, optional): Whether to continue the frontier of the previous crawl. Defaults to False.
+            bloom_capacity (int, optional): The expected number of URLs if a Bloom filter should track the seen URLs. Defaults to None.
+        """
+        self.writer = writer
+        self.queue = deque()
+        self.seen = BloomFilter(bloom_capacity) if bloom_capacity else set()
+        if resume:
+            for url, done in cursor.execute('SELECT url, done FROM frontier ORDER BY position').fetchall():
+                self.seen.add(url)
+                if not done:
+                    self.queue.append(url)
+        else:
+            cursor.execute('DELETE FROM frontier')
+            connection.commit()
+
+    def __len__(self) -> int:
+        return len(self.queue)
+
+    def push(self, url: str) -> bool:
+        """Queues the URL unless it has been queued before. Returns whether the URL was queued."""
+        if url in self.seen:
+            return False
+        self.seen.add(url)
+        self.queue.append(url)
+        self.writer.execute('INSERT OR IGNORE INTO frontier (url) VALUES (?)', (url,))
+        return True
+
+    def pop(self) -> str:
+        """Returns the next URL to crawl. The URL stays queued in the checkpoint until it is marked as done."""
+        return self.queue.popleft()
+
+    def mark_done(self, url: str) -> None:
+        """Marks the URL as crawled in the checkpoint."""
+        # Upsert, since the row may be queued in the same batch after this statement
+        self.writer.execute('INSERT INTO frontier (url, done) VALUES (?, 1) ON CONFLICT (url) DO UPDATE SET done = 1', (url,))
+
+
+def recursively_crawl(url: str, max_workers: int = MAX_WORKERS, limiter: HostLimiter = None, head_first: bool = False, resume: bool = False, bloom_capacity: int = None, batch_size: int = BATCH_SIZE, parse_processes: int = PARSE_PROCESSES) -> None:
+    """Recursively crawls the requested page and all its child pages in a breadth-first search manner.
+    Up to max_workers pages are fetched concurrently, but the pages are processed in queue order so the
+    crawl order is the same as a sequential breadth-first search.
+    Pages crawled before are requested conditionally. Unmodified pages are neither downloaded nor parsed,
+    and the crawl continues with the child links stored for them. New, changed and deleted pages are recorded
+    in page_changes so that the indexer only has to update their postings.
+    Pages, links and the frontier are written in batches of one transaction each, so the crawl can be resumed after a crash.
+    Pages with the same content or a similar SimHash as a canonical page are stored as its aliases instead of as pages, so they
+    are not indexed. Their links are kept, and the indexer counts links from and to an alias as links of its canonical page.
+    Fetched pages are extracted in a pool of processes, so parsing uses other cores while the fetching threads keep downloading.
+
+    Args:
+        url (str): The URL to start crawling from.
+        max_workers (int, optional): The maximum number of in-flight fetches. Defaults to MAX_WORKERS.
+        limiter (HostLimiter, optional): Per-host politeness limits. Defaults to a new HostLimiter.
+        head_first (bool, optional): Whether to check pages with a HEAD request before downloading them. Defaults to False.
+        resume (bool, optional): Whether to continue the frontier of an interrupted crawl. Defaults to False.
+        bloom_capacity (int, optional): The expected number of URLs if a Bloom filter should track the seen URLs. Defaults to None.
+        batch_size (int, optional): The number of rows written per transaction. Defaults to BATCH_SIZE.
+        parse_processes (int, optional): The number of processes extracting the pages, 0 to extract them in the fetching threads. Defaults to PARSE_PROCESSES.
+    """
+    limiter = limiter or HostLimiter()
+    writer = BatchWriter(connection, batch_size)
+    frontier = Frontier(writer, resume, bloom_capacity)
+    frontier.push(url)
+    fingerprints = load_fingerprints(writer)
+    in_flight = deque() # (url, validators, whether the page was an alias, future) tuples in queue order
+    new_canonicals = set() # Canonical pages of the aliases stored since the batch was last written by reset_aliases
+    crawled = 0
+    unmodified = 0
+    deleted = 0
+    aliased = 0
+    start_time = time.perf_counter()
+
+    # Workers are spawned rather than forked, since the fetching threads may hold locks at the time of the fork
+    extractors = ProcessPoolExecutor(parse_processes, mp_context=multiprocessing.get_context("spawn")) if parse_processes > 0 else None
+    with extractors or nullcontext(), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(frontier) > 0 or len(in_flight) > 0:
+            # Keep the pool busy with the next pages of the queue
+            while len(frontier) > 0 and len(in_flight) < max_workers:
+                next_url = frontier.pop()
+                row = cursor.execute('''
+                    SELECT etag, last_modified, last_modification_date, 0 FROM pages WHERE url = ?1
+                    UNION ALL SELECT etag, last_modified, last_modification_date, 1 FROM page_aliases WHERE url = ?1;
+                ''', (next_url,)).fetchone()
+                validators, was_alias = (row[:3], row[3]) if row else (None, False)
+                in_flight.append((next_url, validators, was_alias, executor.submit(parse_html, next_url, limiter, validators, head_first, extractors)))
+
+            current_url, validators, was_alias, future = in_flight.popleft()
+            page = future.result()
+            frontier.mark_done(current_url)
+            if page is None and validators:
+                # Remove the page since it no longer exists
+                deleted += 1
+                deleted_page_id = encode_string(normalize_url(current_url))
+                writer.execute('DELETE FROM parent_child WHERE parent_id = ?', (deleted_page_id,))
+                if was_alias:
+                    writer.execute('DELETE FROM page_aliases WHERE page_id = ?', (deleted_page_id,))
+                else:
+                    fingerprints.remove(deleted_page_id)
+                    retire_canonical(writer, deleted_page_id, new_canonicals)
                 continue
+            if not page:
+                # The page could not be fetched or extracted, keep crawling the children stored by the previous crawl
+                if validators:
+                    for child_link in stored_child_links(current_url):
+                        frontier.push(child_link)
+                continue
+            extracted, last_modification_date, size, etag, last_modified = page
+
+            if extracted is None:
+                # Skip the page since it has not been modified since the last crawl, but keep crawling its children
+                unmodified += 1
+                child_links = stored_child_links(current_url)
             else:
-                cursor.execute(f'DELETE FROM pages WHERE url = "{current_url}"')
-                connection.commit()
-        
-        visited.add(current_url)
-        child_links = get_child_links(current_url, soup)
-        current_page_id, title, clean_body, clean_title, normalized_url = get_information(current_url, soup)
-
-        cursor.execute(f'''
-            INSERT INTO pages (page_id, size, last_modification_date, title, url, clean_body, clean_title)
-            VALUES ({current_page_id}, {size}, {last_modification_date}, "{title}", "{normalized_url}", "{clean_body}", "{clean_title}");
-        ''')
-        connection.commit()
-
-        for child_link in child_links:
-            child_page_id = encode_string(normalize_url(child_link))
-            parent_child.append({
-                "parent_id": current_page_id,
-                "child_id": child_page_id
-            })
-            if child_link not in visited and child_link not in queue:
-                queue.append(child_link)
-
-    for relation in parent_child:
-        parent_id = relation["parent_id"]
-        child_id = relation["child_id"]
-        cursor.execute(f"""
-            INSERT INTO parent_child (parent_id, child_id)
-            VALUES ({parent_id}, {child_id});
-        """)
-    connection.commit()
+                crawled += 1
+                child_links = get_child_links(extracted)
+                current_page_id, title, clean_body, clean_title, normalized_url = get_information(current_url, extracted)
+
+                # The page must not be found as a duplicate of its own previous version
+                previous_fingerprints = fingerprints.fingerprints.get(current_page_id)
+                fingerprints.remove(current_page_id)
+                canonical_id = fingerprints.find(extracted.content_hash, extracted.simhash)
+
+                writer.execute('DELETE FROM parent_child WHERE parent_id = ?', (current_page_id,))
+                if canonical_id is not None:
+                    aliased += 1
+                    if validators and not was_alias:
+                        retire_canonical(writer, current_page_id, new_canonicals)
+                    writer.execute('''
+                        INSERT OR REPLACE INTO page_aliases (page_id, canonical_id, url, last_modification_date, etag, last_modified)
+                        VALUES (?, ?, ?, ?, ?, ?);
+                    ''', (current_page_id, canonical_id, normalized_url, last_modification_date, etag, last_modified))
+                    new_canonicals.add(canonical_id)
+                else:
+                    if was_alias:
+                        writer.execute('DELETE FROM page_aliases WHERE page_id = ?', (current_page_id,))
+                    elif previous_fingerprints is not None and previous_fingerprints[0] != extracted.content_hash:
+                        # The aliases of the page copied its previous content
+                        reset_aliases(writer, current_page_id, new_canonicals)
+                    fingerprints.add(current_page_id, extracted.content_hash, extracted.simhash)
+                    writer.execute('''
+                        INSERT OR REPLACE INTO pages (page_id, size, last_modification_date, title, url, clean_body, clean_title, etag, last_modified)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+                    ''', (current_page_id, size, last_modification_date, title, normalized_url, clean_body, clean_title, etag, last_modified))
+                    writer.execute('INSERT OR REPLACE INTO page_fingerprints (page_id, content_hash, simhash) VALUES (?, ?, ?)', (current_page_id, extracted.content_hash, extracted.simhash))
+                    writer.execute('INSERT OR REPLACE INTO page_changes (page_id, change) VALUES (?, ?)', (current_page_id, 'changed' if validators and not was_alias else 'new'))
+                # The links of aliases are kept for PageRank
+                writer.executemany('''
+                    INSERT INTO parent_child (parent_id, child_id)
+                    VALUES (?, ?);
+                ''', [(current_page_id, encode_string(normalize_url(child_link))) for child_link in child_links])
+
+            for child_link in child_links:
+                frontier.push(child_link)
+    # Checkpoint the remaining pages, links and frontier
+    writer.flush()
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Crawled {crawled} pages in {elapsed:.2f}s ({crawled / elapsed if elapsed else 0:.2f} pages/sec), {aliased} pages stored as duplicates, {unmodified} pages unmodified, {deleted} pages deleted")
 
 
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Crawls pages into the database.")
+    arg_parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Number of pages fetched concurrently.")
+    arg_parser.add_argument("--host-concurrency", type=int, default=HOST_CONCURRENCY, help="Maximum in-flight requests per host.")
+    arg_parser.add_argument("--host-delay", type=float, default=HOST_DELAY, help="Minimum seconds between requests to the same host.")
+    arg_parser.add_argument("--head-first", action="store_true", help="Check pages with a HEAD request before downloading them.")
+    arg_parser.add_argument("--resume", action="store_true", help="Continue the frontier of an interrupted crawl.")
+    arg_parser.add_argument("--bloom-capacity", type=int, default=None, help="Track seen URLs with a Bloom filter sized for this many URLs.")
+    arg_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Number of rows written per transaction.")
+    arg_parser.add_argument("--parse-processes", type=int, default=PARSE_PROCESSES, help="Number of processes extracting the fetched pages, 0 to extract them in the fetching threads.")
+    args = arg_parser.parse_args()
+
     DATABASE_PATH = 'database.db'
     START_URL = 'https://www.cse.ust.hk/~kwtleung/COMP4321/testpage.htm'
     connection = sqlite3.connect(DATABASE_PATH)
     cursor = connection.cursor()
     init_db()
-    recursively_crawl(START_URL)
+    with bulk_load(connection, defer_indexes=False):
+        recursively_crawl(START_URL, args.workers, HostLimiter(args.host_concurrency, args.host_delay), args.head_first, args.resume, args.bloom_capacity, args.batch_size, args.parse_processes)
     connection.close()
\ No newline at end of file
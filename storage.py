@@ -0,0 +1,170 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+import metrics
+
+# Number of buffered rows after which the statements are written in one transaction
+BATCH_SIZE = 5000
+# Page cache used while bulk loading, in KiB
+BULK_CACHE_SIZE = 256000
+# Maximum number of parameters bound to one "IN (...)" clause
+CHUNK_SIZE = 500
+# Default database file
+DATABASE_PATH = 'database.db'
+# Seconds a reader waits for a lock held by a writer before failing
+READ_TIMEOUT = 30.0
+
+# Statements executed through ReadConnections, counted for the /metrics endpoint of the app
+sql_statements = metrics.Counter("sql_statements_total", "SQL statements executed by the read-only connections.")
+
+# Secondary indexes, built after bulk loads
+INDEXES = {
+    "pages_url": "pages (url)",
+    "inverted_index_page": "inverted_index (page_id)",
+    "inverted_index_keyword": "inverted_index (keyword_id)",
+    "title_inverted_index_page": "title_inverted_index (page_id)",
+    "title_inverted_index_keyword": "title_inverted_index (keyword_id)",
+    "forward_index_keyword": "forward_index (keyword_id)",
+    "title_forward_index_keyword": "title_forward_index (keyword_id)",
+    "parent_child_parent": "parent_child (parent_id)",
+    "parent_child_child": "parent_child (child_id)",
+    "page_keywords_page": "page_keywords (page_id)",
+    "page_aliases_url": "page_aliases (url)",
+    "page_aliases_canonical": "page_aliases (canonical_id)",
+    "page_neighbors_page": "page_neighbors (page_id)",
+    "page_neighbors_neighbor": "page_neighbors (neighbor_id)",
+}
+
+
+class BatchWriter:
+    """Buffers parameterized statements and writes them with executemany in large transactions.
+    Statements are executed in the order they were first used, so the rows of a statement must not depend on
+    the rows of a statement used after it within the same batch.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, batch_size: int = BATCH_SIZE):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.buffers = {} # {statement: [parameters]}
+        self.pending = 0
+
+    def execute(self, statement: str, parameters: tuple = ()) -> None:
+        """Buffers one execution of the statement."""
+        self.buffers.setdefault(statement, []).append(parameters)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def executemany(self, statement: str, rows) -> None:
+        """Buffers one execution of the statement per row."""
+        buffer = self.buffers.setdefault(statement, [])
+        for parameters in rows:
+            buffer.append(parameters)
+            self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes all buffered statements and commits them as one transaction."""
+        cursor = self.connection.cursor()
+        try:
+            for statement, rows in self.buffers.items():
+                if rows:
+                    cursor.executemany(statement, rows)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+            self.buffers = {}
+            self.pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.buffers = {}
+            self.pending = 0
+
+
+class ReadConnections:
+    """Read-only connections to a database, one per thread and process.
+    Connections are never shared, so concurrent requests do not race on a connection or a cursor, and a process
+    forked by a multi-process server opens its own connections instead of using the ones of its parent.
+    """
+
+    def __init__(self, path: str = DATABASE_PATH, timeout: float = READ_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        """Returns the connection of the calling thread, opening it on first use."""
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=self.timeout)
+            # Readers do not block the writers of a database in WAL mode, see bulk_load
+            connection.execute("PRAGMA query_only = ON")
+            # Called in the thread executing the statement, so the statements also count towards its trace
+            connection.set_trace_callback(lambda statement: sql_statements.inc())
+            self.local.connection, self.local.pid = connection, os.getpid()
+        return connection
+
+    @contextmanager
+    def cursor(self):
+        """Yields a new cursor of the connection of the calling thread, and closes it afterwards."""
+        cursor = self.get().cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+
+def chunked(items: list, size: int = CHUNK_SIZE):
+    """Yields consecutive slices of at most size items."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def create_indexes(connection: sqlite3.Connection) -> None:
+    """Creates the secondary indexes."""
+    for name, columns in INDEXES.items():
+        connection.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {columns}")
+    connection.commit()
+
+
+def drop_indexes(connection: sqlite3.Connection) -> None:
+    """Drops the secondary indexes."""
+    for name in INDEXES:
+        connection.execute(f"DROP INDEX IF EXISTS {name}")
+    connection.commit()
+
+
+@contextmanager
+def bulk_load(connection: sqlite3.Connection, defer_indexes: bool = True):
+    """Tunes SQLite for loading large amounts of data.
+    The database is switched to WAL mode with a large page cache. With synchronous = NORMAL, commits do not wait for the disk,
+    and a crash or power loss may lose the last commits but cannot corrupt the database.
+
+    Args:
+        connection (sqlite3.Connection): The database connection.
+        defer_indexes (bool, optional): Whether to drop the secondary indexes and build them after loading. Defaults to True.
+    """
+    connection.commit()
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.execute(f"PRAGMA cache_size = {-BULK_CACHE_SIZE}")
+    connection.execute("PRAGMA temp_store = MEMORY")
+    if defer_indexes:
+        drop_indexes(connection)
+    try:
+        yield connection
+    finally:
+        connection.commit()
+        if defer_indexes:
+            create_indexes(connection)
@@ -0,0 +1,78 @@
+import math
+import re
+from collections import Counter
+from analyzer import stem, stopwords, stem_words, remove_stop_words
+from utils import encode_string
+
+# Maximum number of search results
+MAX_RESULTS = 50
+
+
+class BaselineEngine:
+    """The ranking of the original search engine, which scored every page with plain dictionaries read from the database.
+    It is kept to check that the optimized retrieval ranks plain and related document queries the same way.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.document_count = connection.execute("SELECT COUNT(page_id) FROM pages").fetchone()[0]
+        self.documents = [page_id for page_id, in connection.execute("SELECT page_id FROM pages").fetchall()]
+        self.words = {word: word_id for word_id, word in connection.execute("SELECT keyword_id, keyword FROM keywords").fetchall()}
+        self.title_vectors = {page_id: self.document_vector(page_id, True) for page_id in self.documents}
+        self.text_vectors = {page_id: self.document_vector(page_id) for page_id in self.documents}
+        self.page_ranks = dict(connection.execute("SELECT page_id, score FROM page_ranks").fetchall())
+
+    def document_vector(self, page_id: int, from_title: bool = False) -> dict[int, float]:
+        table, forward_table = ("title_inverted_index", "title_forward_index") if from_title else ("inverted_index", "forward_index")
+        words = self.connection.execute(f"SELECT keyword_id, keyword_count FROM {table} WHERE page_id = ?", (page_id,)).fetchall()
+        if not words:
+            return {}
+        max_count = max(count for _, count in words)
+        counts = dict(self.connection.execute(f"SELECT keyword_id, keyword_count FROM {forward_table} WHERE keyword_id IN ({','.join('?' for _ in words)})", [word for word, _ in words]).fetchall())
+        return {word: count * math.log2(self.document_count / counts[word]) / max_count for word, count in words}
+
+    def parse(self, query: str) -> list[int]:
+        keywords = [self.words[stem(re.sub("[^a-zA-Z-]+", "", word.lower()))] for word in query.split() if word.lower() not in stopwords and stem(re.sub("[^a-zA-Z-]+", "", word.lower())) in self.words]
+        keywords += [encode_string(' '.join(stem_words(remove_stop_words(phrase.split())))) for phrase in re.findall('"([^"]*)"', query) if phrase]
+        return keywords
+
+    @staticmethod
+    def cosine_similarity(vector1: dict[int, float], vector2: dict[int, float]) -> float:
+        common_words = set(vector1) & set(vector2)
+        if not common_words:
+            return 0.0
+        magnitude1 = math.sqrt(sum(value ** 2 for value in vector1.values())) or 1
+        magnitude2 = math.sqrt(sum(value ** 2 for value in vector2.values())) or 1
+        return sum(vector1[word] / magnitude1 * vector2[word] / magnitude2 for word in common_words) * 50
+
+    @staticmethod
+    def normalize_scores(scores: dict[int, float]) -> dict[int, float]:
+        max_score = max(scores.values(), default=1)
+        return {key: (value / max_score) * 50 for key, value in scores.items()} if max_score != 0 else scores
+
+    def search(self, query: str, related_doc: int = -1) -> dict[int, float]:
+        """Returns the search results of a query without phrases, optionally improved by a related document."""
+        if not query:
+            return {}
+        keywords = self.parse(query)
+        vector1 = Counter(keywords)
+        if related_doc != -1:
+            if related_doc not in self.text_vectors:
+                return {}
+            document_vector = {word: score / 2 for word, score in self.text_vectors[related_doc].items()}
+            vector1 = {word: score + document_vector.get(word, 0) for word, score in vector1.items()}
+        if not keywords:
+            return {}
+        title_scores, text_scores = {}, {}
+        for document in self.documents:
+            title_vector, text_vector = self.title_vectors[document], self.text_vectors[document]
+            if not any(word in title_vector or word in text_vector for word in keywords):
+                continue
+            title_scores[document] = self.cosine_similarity(vector1, title_vector)
+            text_scores[document] = self.cosine_similarity(vector1, text_vector)
+        title_scores = dict(sorted(self.normalize_scores(title_scores).items(), key=lambda item: item[1], reverse=True)[:MAX_RESULTS])
+        text_scores = dict(sorted(self.normalize_scores(text_scores).items(), key=lambda item: item[1], reverse=True)[:MAX_RESULTS])
+        combined_scores = {key: 0.3 * title_scores.get(key, 0) + 0.7 * text_scores.get(key, 0) for key in set(title_scores) | set(text_scores)}
+        combined_scores = {page_id: score * self.page_ranks.get(page_id, 0) for page_id, score in combined_scores.items()}
+        scores = self.normalize_scores(combined_scores)
+        return dict(sorted(scores.items(), key=lambda item: item[1], reverse=True)[:MAX_RESULTS])
@@ -0,0 +1,53 @@
+import os
+import sys
+import shutil
+import sqlite3
+import pytest
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+
+# Synthetic corpus of the search tests, small enough for the original dictionary-based ranking
+PAGES = 300
+VOCABULARY = 800
+WORDS_PER_PAGE = 120
+LINKS_PER_PAGE = 6
+SEED = 4321
+# Number of shard snapshots written next to the snapshot of all pages
+SHARDS = 3
+
+
+def build_database(path: str, corpus: list[dict]) -> None:
+    """Stores the synthetic pages like the spider does, with the links between them, and indexes them from scratch."""
+    import spider
+    import indexer
+    from utils import encode_string
+    connection = sqlite3.connect(path)
+    spider.connection, spider.cursor = connection, connection.cursor()
+    spider.init_db()
+    urls = [f"http://localhost/{number}.htm" for number in range(len(corpus))]
+    for url, page in zip(urls, corpus):
+        title, body = " ".join(page["title"]), " ".join(page["body"])
+        connection.execute('INSERT INTO pages (page_id, size, last_modification_date, title, url, clean_body, clean_title) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (encode_string(url), len(body), 0, title, url, body, title))
+        connection.executemany('INSERT INTO parent_child (parent_id, child_id) VALUES (?, ?)', [(encode_string(url), encode_string(urls[link])) for link in page["links"]])
+    connection.commit()
+    indexer.index_pages(connection.cursor(), full=True, snapshot_path="index.snapshot", shards=SHARDS)
+    connection.close()
+
+
+@pytest.fixture(scope="session")
+def engine(tmp_path_factory):
+    """Changes into a directory holding an indexed synthetic corpus, where retrieval finds database.db and index.snapshot.
+    Yields the vocabulary and the pages of the corpus.
+    """
+    pytest.importorskip("spacy")
+    import benchmark
+    path = tmp_path_factory.mktemp("engine")
+    shutil.copy(os.path.join(REPOSITORY, "stopwords.txt"), path)
+    previous = os.getcwd()
+    os.chdir(path)
+    words, corpus = benchmark.generate_corpus(PAGES, VOCABULARY, WORDS_PER_PAGE, LINKS_PER_PAGE, SEED)
+    build_database("database.db", corpus)
+    yield words, corpus
+    os.chdir(previous)
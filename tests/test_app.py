@@ -0,0 +1,59 @@
+import pytest
+
+
+@pytest.fixture(scope="module")
+def client(engine):
+    import app
+    app.result_cache.clear()
+    return app.app.test_client()
+
+
+def test_search_cursor_round_trip(engine):
+    from app import encode_search_cursor, decode_search_cursor, query_digest
+    key = ((1, 2), ())
+    assert decode_search_cursor(encode_search_cursor(7, 20, key)) == (7, 20, query_digest(key))
+
+
+@pytest.mark.parametrize("cursor", ["zzz", "W10=", "WzEsIC0xLCAiYSJd", "WyJhIiwgMSwgImEiXQ=="])
+def test_malformed_search_cursors_are_rejected(engine, cursor):
+    from app import decode_search_cursor
+    with pytest.raises(ValueError):
+        decode_search_cursor(cursor)
+
+
+def test_pages_hold_every_result_with_a_nonzero_score(engine, client):
+    import retrieval
+    words, _ = engine
+    # Most results of this query have a negative score
+    query = " ".join(words[8:10])
+    expected = [page_id for page_id, score in retrieval.rankedResults(query, -1, None, retrieval.MAX_RANKED_RESULTS) if score != 0]
+    pages, cursor = [], None
+    while True:
+        response = client.post("/search", json={"searchbar": query, "page_size": 7, **({"cursor": cursor} if cursor else {})}).get_json()
+        assert response["total"] == len(expected)
+        pages += [result["id"] for result in response["results"]]
+        cursor = response["next_cursor"]
+        if cursor is None:
+            break
+    assert pages == expected
+
+
+def test_first_page_holds_the_ranked_results(engine, client):
+    import retrieval
+    words, _ = engine
+    query = " ".join(words[2:5])
+    response = client.post("/search", json={"searchbar": query}).get_json()
+    assert [result["id"] for result in response["results"]] == [page_id for page_id, score in retrieval.search_engine(query).items() if score != 0]
+    assert client.post("/search", json={"searchbar": query}).get_json()["cached"]
+
+
+def test_cursors_of_other_queries_are_rejected(engine, client):
+    words, _ = engine
+    cursor = client.post("/search", json={"searchbar": words[0], "page_size": 1}).get_json()["next_cursor"]
+    assert client.post("/search", json={"searchbar": words[1], "page_size": 1, "cursor": cursor}).status_code == 400
+
+
+def test_profiler_is_only_available_locally(client):
+    assert client.get("/metrics/profile").status_code == 200
+    assert client.get("/metrics/profile", environ_base={"REMOTE_ADDR": "192.0.2.1"}).status_code == 403
+    assert client.post("/metrics/profile", json={"running": True}, environ_base={"REMOTE_ADDR": "192.0.2.1"}).status_code == 403
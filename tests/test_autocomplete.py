@@ -0,0 +1,47 @@
+import random
+import pytest
+from autocomplete import KeywordIndex, encode_cursor, decode_cursor
+
+
+@pytest.fixture(scope="module")
+def keywords():
+    generator = random.Random(0)
+    words = sorted({"".join(generator.choice("abc") for _ in range(generator.randint(1, 6))) for _ in range(400)})
+    return {word: generator.randint(1, 5) for word in words}
+
+
+def ranked(keywords: dict[str, int], prefix: str) -> list[tuple[str, int]]:
+    return sorted(((word, frequency) for word, frequency in keywords.items() if word.startswith(prefix)), key=lambda item: (-item[1], item[0]))
+
+
+@pytest.mark.parametrize("prefix", ["", "a", "ab", "cba", "d"])
+def test_search_ranks_by_frequency_then_alphabetically(keywords, prefix):
+    index = KeywordIndex(list(keywords), list(keywords.values()))
+    matches, total, has_more = index.search(prefix, 10)
+    expected = ranked(keywords, prefix)
+    assert (matches, total, has_more) == (expected[:10], len(expected), len(expected) > 10)
+    assert list(index.iterate(prefix)) == expected
+
+
+@pytest.mark.parametrize("prefix", ["", "b"])
+def test_cursors_page_through_every_match(keywords, prefix):
+    index = KeywordIndex(list(keywords), list(keywords.values()))
+    pages, after = [], None
+    while True:
+        matches, _, has_more = index.search(prefix, 7, after)
+        pages += matches
+        if not has_more:
+            break
+        after = decode_cursor(encode_cursor(*matches[-1]))
+    assert pages == ranked(keywords, prefix)
+    assert list(index.iterate(prefix, decode_cursor(encode_cursor(*pages[4])))) == pages[5:]
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor("keyword", 12)) == (12, "keyword")
+
+
+@pytest.mark.parametrize("cursor", ["zzz", "W10=", "WyJhIiwgImIiXQ=="])
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
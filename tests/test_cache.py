@@ -0,0 +1,53 @@
+import pytest
+import cache
+from cache import QueryCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces the clock of the cache with one that only moves when the test advances it."""
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_entries_expire_after_the_ttl(clock):
+    results = QueryCache(ttl=10)
+    results.put("query", [1, 2], 1)
+    clock[0] += 9.5
+    assert results.get("query", 1) == [1, 2]
+    clock[0] += 1
+    assert results.get("query", 1) is None
+    assert results.stats()["expirations"] == 1
+    assert results.stats()["size"] == 0
+
+
+def test_other_generations_invalidate_all_entries(clock):
+    results = QueryCache()
+    results.put("first", 1, 1)
+    results.put("second", 2, 1)
+    assert results.get("first", 2) is None
+    assert results.get("second", 1) is None
+    assert results.stats()["invalidations"] == 1
+    results.put("first", 3, 2)
+    assert results.get("first", 2) == 3
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    results = QueryCache(max_entries=2)
+    results.put("first", 1, 1)
+    results.put("second", 2, 1)
+    results.get("first", 1)
+    results.put("third", 3, 1)
+    assert results.get("second", 1, "missing") == "missing"
+    assert (results.get("first", 1), results.get("third", 1)) == (1, 3)
+    assert results.stats()["evictions"] == 1
+
+
+def test_stats_count_hits_and_misses(clock):
+    results = QueryCache()
+    results.put("query", 1, 1)
+    results.get("query", 1)
+    results.get("other", 1)
+    stats = results.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
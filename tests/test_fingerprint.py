@@ -0,0 +1,65 @@
+import random
+from fingerprint import MAX_DISTANCE, MIN_WORDS, FingerprintIndex, content_hash, simhash, distance
+
+
+def body(seed: int, length: int = 300) -> list[str]:
+    generator = random.Random(seed)
+    return [f"word{generator.randrange(2000)}" for _ in range(length)]
+
+
+def flip_bits(value: int, bits: list[int]) -> int:
+    """Flips the given bits of a signed 64-bit value."""
+    flipped = (value & 0xFFFFFFFFFFFFFFFF) ^ sum(1 << bit for bit in bits)
+    return flipped - (1 << 64) if flipped >= 1 << 63 else flipped
+
+
+def test_short_bodies_have_no_simhash():
+    assert simhash(" ".join(body(0, MIN_WORDS - 1))) is None
+    assert simhash(" ".join(body(0, MIN_WORDS))) is not None
+
+
+def test_similar_bodies_have_close_simhashes():
+    words = body(1)
+    edited = words[:150] + ["changed"] + words[151:]
+    assert simhash(" ".join(words)) == simhash(" ".join(words))
+    assert distance(simhash(" ".join(words)), simhash(" ".join(edited))) <= MAX_DISTANCE
+    assert distance(simhash(" ".join(words)), simhash(" ".join(body(2)))) > 3 * MAX_DISTANCE
+
+
+def test_simhash_depends_on_the_word_order():
+    words = body(3)
+    assert simhash(" ".join(words)) != simhash(" ".join(reversed(words)))
+
+
+def test_exact_duplicates_are_found_by_content_hash():
+    index = FingerprintIndex([(1, content_hash("title", "body"), None)])
+    assert index.find(content_hash("title", "body"), None) == 1
+    assert index.find(content_hash("title", "other body"), None) is None
+
+
+def test_near_duplicates_are_found_in_every_band():
+    generator = random.Random(4)
+    page_simhash = simhash(" ".join(body(5)))
+    index = FingerprintIndex([(1, 10, page_simhash)])
+    for _ in range(200):
+        bits = generator.sample(range(64), generator.randint(0, MAX_DISTANCE))
+        assert index.find(11, flip_bits(page_simhash, bits)) == 1
+    assert index.find(11, flip_bits(page_simhash, list(range(0, 64, 8)))) is None
+
+
+def test_closest_near_duplicate_is_returned():
+    page_simhash = simhash(" ".join(body(6)))
+    index = FingerprintIndex([(1, 10, flip_bits(page_simhash, [0, 1, 2])), (2, 20, flip_bits(page_simhash, [40]))])
+    assert index.find(30, page_simhash) == 2
+
+
+def test_removed_and_replaced_pages_are_not_found():
+    first, second = simhash(" ".join(body(7))), simhash(" ".join(body(8)))
+    index = FingerprintIndex([(1, 10, first)])
+    index.add(1, 20, second)
+    assert len(index) == 1
+    assert index.find(10, first) is None
+    assert index.find(30, second) == 1
+    index.remove(1)
+    assert index.find(20, second) is None
+    assert not any(index.bands)
@@ -0,0 +1,120 @@
+import sys
+import random
+import subprocess
+import sqlite3
+import pytest
+from conftest import SHARDS
+
+# Number of random queries compared in each test
+QUERIES = 200
+
+
+@pytest.fixture(scope="module")
+def queries(engine):
+    """Random queries of one to four words, mostly common ones so that many pages match."""
+    words, _ = engine
+    generator = random.Random(1)
+    return [" ".join(generator.sample(words if number % 3 == 0 else words[:400], generator.randint(1, 4))) for number in range(QUERIES)]
+
+
+@pytest.fixture(scope="module")
+def original(engine):
+    from baseline import BaselineEngine
+    connection = sqlite3.connect("database.db")
+    yield BaselineEngine(connection)
+    connection.close()
+
+
+@pytest.fixture(scope="module")
+def shard_indexes(engine):
+    """The index of each shard, loaded from the shard snapshots like a shard worker does."""
+    import retrieval
+    previous = retrieval.shard
+    try:
+        indexes = []
+        for number in range(SHARDS):
+            retrieval.shard = (number, SHARDS)
+            indexes.append(retrieval.loadIndex())
+        return indexes
+    finally:
+        retrieval.shard = previous
+
+
+class InProcessShards:
+    """Stands in for shards.ShardClients, ranking every shard in this process."""
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def partial_scores(self, generation, *arguments):
+        import retrieval
+        return [retrieval.partialScores(index, *arguments) for index in self.indexes]
+
+
+def nonzero(results: dict[int, float]) -> dict[int, float]:
+    """The results the app shows, those with a nonzero score."""
+    return {page_id: score for page_id, score in results.items() if score != 0}
+
+
+def test_rankings_match_the_original_ranking(original, queries):
+    import retrieval
+    retrieval.resultCache.clear()
+    for query in queries:
+        assert nonzero(retrieval.search_engine(query)) == pytest.approx(nonzero(original.search(query)), rel=1e-9), query
+
+
+def test_related_rankings_match_the_original_ranking(original, queries):
+    """Related documents whose truncated vector holds all of their query words are expanded exactly like the original ranking does."""
+    import retrieval
+    from retrieval import currentIndex, documentRow, queryToVec, parser
+    index = currentIndex()
+    generator = random.Random(2)
+    compared = 0
+    for query in queries:
+        page_id = generator.choice(original.documents)
+        row = documentRow(index, page_id)
+        truncated = set(index.vectors.keywords[index.vectors.offsets[row]:index.vectors.offsets[row + 1]].tolist())
+        if any(word in original.text_vectors[page_id] and word not in truncated for word in queryToVec(parser(query, index)[0])):
+            continue
+        compared += 1
+        assert nonzero(retrieval.search_engine(query, page_id)) == pytest.approx(nonzero(original.search(query, page_id)), rel=1e-9), (query, page_id)
+    assert compared >= QUERIES // 2
+
+
+def test_sharded_rankings_match_unsharded_rankings(engine, queries, shard_indexes, monkeypatch):
+    import retrieval
+    index = retrieval.currentIndex()
+    words, _ = engine
+    # Phrases are filtered in each shard, and fields whose best score is negative are normalized across shards
+    parsed = [retrieval.parser(query, index) for query in queries + [f'"{words[number]} {words[number + 1]}" {words[number + 2]}' for number in range(0, 60, 3)]]
+    expected = [list(retrieval.rankDocuments(index, query, -1, limit).items()) for query in parsed for limit in (retrieval.MAX_RESULTS, 5)]
+    monkeypatch.setattr(retrieval, "shardClients", InProcessShards(shard_indexes))
+    assert [list(retrieval.rankDocuments(index, query, -1, limit).items()) for query in parsed for limit in (retrieval.MAX_RESULTS, 5)] == expected
+
+
+def test_shard_workers_rank_like_one_process(queries):
+    import retrieval
+    import shards
+    expected = [retrieval.search_engine(query) for query in queries[:20]]
+    retrieval.resultCache.clear()
+    clients = shards.start_local(SHARDS)
+    try:
+        assert [retrieval.search_engine(query) for query in queries[:20]] == expected
+    finally:
+        clients.close()
+        retrieval.shardClients = None
+        retrieval.resultCache.clear()
+
+
+def test_processes_load_only_the_index_they_use(engine):
+    """Importing retrieval loads no index, so a worker process only loads the shard it sets."""
+    from conftest import REPOSITORY
+    script = f"""
+import sys
+sys.path.insert(0, {REPOSITORY!r})
+import retrieval
+assert retrieval.globalIndex is None
+retrieval.useShard(1, {SHARDS}, "index.snapshot")
+assert len(retrieval.currentIndex().docIds) and (retrieval.currentIndex().docIds % {SHARDS} == 1).all()
+"""
+    subprocess.run([sys.executable, "-c", script], check=True)
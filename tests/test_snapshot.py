@@ -0,0 +1,39 @@
+import json
+import numpy as np
+import pytest
+import snapshot
+from snapshot import MAGIC, write_snapshot, load_snapshot, snapshot_generation, next_generation
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "index.snapshot")
+    arrays = {"page_ids": np.array([3, 7, 9], dtype=np.int64), "scores": np.linspace(0, 1, 5), "empty": np.empty(0, dtype=np.uint8)}
+    generation = write_snapshot(arrays, path, 42)
+    assert generation == snapshot_generation(path) == 42
+    loaded_generation, loaded = load_snapshot(path)
+    assert loaded_generation == 42
+    assert loaded.keys() == arrays.keys()
+    for name, array in arrays.items():
+        assert loaded[name].dtype == array.dtype
+        assert np.array_equal(loaded[name], array)
+
+
+def test_snapshots_of_other_versions_are_not_loaded(tmp_path):
+    path = tmp_path / "index.snapshot"
+    header = json.dumps({"version": snapshot.SNAPSHOT_VERSION - 1, "generation": 5, "arrays": {}}).encode()
+    path.write_bytes(MAGIC + len(header).to_bytes(8, "little") + header)
+    with pytest.raises(ValueError):
+        load_snapshot(str(path))
+    assert snapshot_generation(str(path)) == 0
+
+
+def test_generations_keep_increasing(tmp_path):
+    path = str(tmp_path / "index.snapshot")
+    first = write_snapshot({"page_ids": np.arange(3)}, path)
+    second = write_snapshot({"page_ids": np.arange(3)}, path)
+    assert second > first
+    # A future generation is still exceeded, and a deleted snapshot does not reset the generations
+    write_snapshot({"page_ids": np.arange(3)}, path, second + 10 ** 12)
+    assert next_generation(path) == second + 10 ** 12 + 1
+    (tmp_path / "index.snapshot").unlink()
+    assert next_generation(path) > second
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from utils import BloomFilter, varint_lengths, encode_varints, decode_varints, encode_positions, decode_positions, expand_ranges
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000)
+    urls = [f"http://localhost/{number}.htm" for number in range(1000)]
+    for url in urls:
+        bloom.add(url)
+    assert all(url in bloom for url in urls)
+
+
+def test_bloom_filter_keeps_its_error_rate():
+    bloom = BloomFilter(5000, 0.01)
+    for number in range(5000):
+        bloom.add(f"http://localhost/{number}.htm")
+    false_positives = sum(f"http://localhost/other/{number}.htm" in bloom for number in range(20000))
+    assert false_positives / 20000 < 0.02
+
+
+def test_empty_bloom_filter_contains_nothing():
+    assert "http://localhost/" not in BloomFilter(10)
+
+
+@pytest.mark.parametrize("values", [[], [0], [127, 128, 16383, 16384], [2 ** 62, 1, 2 ** 35 + 7]])
+def test_varints_round_trip(values):
+    encoded = encode_varints(np.array(values, dtype=np.int64))
+    assert len(encoded) == varint_lengths(np.array(values, dtype=np.int64)).sum()
+    assert decode_varints(encoded).tolist() == values
+
+
+def test_varints_of_random_values_round_trip():
+    values = np.random.default_rng(0).integers(0, 2 ** 40, 10000) >> np.random.default_rng(1).integers(0, 40, 10000)
+    assert np.array_equal(decode_varints(encode_varints(values)), values)
+
+
+def test_varints_use_seven_bits_per_byte():
+    assert encode_varints(np.array([1, 300])).tolist() == [1, 0xAC, 0x02]
+    assert varint_lengths(np.array([0, 127, 128, 2 ** 14, 2 ** 63 - 1])).tolist() == [1, 1, 2, 3, 9]
+
+
+def test_positions_round_trip():
+    positions = [0, 3, 4, 200, 70000]
+    assert decode_positions(encode_positions(positions)) == positions
+    assert decode_positions(None) == []
+
+
+def test_expand_ranges():
+    assert expand_ranges(np.array([3, 9]), np.array([2, 1])).tolist() == [3, 4, 9]
@@ -1,5 +1,134 @@
 from zlib import crc32
+from hashlib import blake2b
+import numpy as np
+import math
 
 def encode_string(s: str) -> int:
     """Encodes a string using CRC32 and returns the checksum as an integer."""
-    return crc32(str.encode(s))
\ No newline at end of file
+    return crc32(str.encode(s))
+
+
+class BloomFilter:
+    """Set of strings stored in a fixed amount of memory.
+    Membership checks can return false positives at the configured error rate, but never false negatives.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2)) # Number of bits
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = blake2b(str.encode(item), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+def tfidf_weights(cursor, inverted_table: str, forward_table: str, document_count: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Loads all postings of an inverted index in one query and computes their TF-IDF weights.
+    The term frequency is normalized by the maximum term frequency of the page.
+
+    Returns:
+        page_ids (np.ndarray): The page of each posting.
+        keyword_ids (np.ndarray): The keyword of each posting.
+        weights (np.ndarray): The TF-IDF weight of each posting.
+    """
+    rows = cursor.execute(f'''
+        SELECT {inverted_table}.page_id, {inverted_table}.keyword_id, {inverted_table}.keyword_count, {forward_table}.keyword_count
+        FROM {inverted_table} JOIN {forward_table} ON {forward_table}.keyword_id = {inverted_table}.keyword_id;
+    ''').fetchall()
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+    page_ids, keyword_ids, term_counts, keyword_counts = (np.array(column) for column in zip(*rows))
+    pages, page_rows = np.unique(page_ids, return_inverse=True)
+    max_term_counts = np.zeros(len(pages))
+    np.maximum.at(max_term_counts, page_rows, term_counts)
+    weights = term_counts * np.log2(document_count / keyword_counts) / max_term_counts[page_rows]
+    return page_ids.astype(np.int64), keyword_ids.astype(np.int64), weights
+
+
+def top_per_group(groups: np.ndarray, values: np.ndarray, limit: int) -> np.ndarray:
+    """Returns the indices of the limit largest values of each group.
+    The indices are ordered by ascending group, and within a group from the largest value. Equal values keep their order in the arrays.
+    """
+    order = np.argsort(-values, kind="stable")
+    order = order[np.argsort(groups[order], kind="stable")]
+    sorted_groups = groups[order]
+    ranks = np.arange(len(order)) - np.searchsorted(sorted_groups, sorted_groups)
+    return order[ranks < limit]
+
+
+def expand_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Returns the concatenation of the ranges of the given starts and lengths, such as [3, 4, 9] for starts [3, 9] and lengths [2, 1]."""
+    total = lengths.sum()
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(total) - np.repeat(offsets - starts, lengths)
+
+
+def encode_positions(positions: list[int]) -> bytes:
+    """Encodes ascending word positions as the varint-encoded gaps between consecutive positions."""
+    encoded = bytearray()
+    previous = 0
+    for position in positions:
+        gap = position - previous
+        previous = position
+        while gap >= 0x80:
+            encoded.append(gap & 0x7F | 0x80)
+            gap >>= 7
+        encoded.append(gap)
+    return bytes(encoded)
+
+
+def decode_positions(encoded: bytes) -> list[int]:
+    """Decodes word positions encoded by encode_positions."""
+    positions = []
+    position = gap = shift = 0
+    for byte in encoded or b"":
+        gap |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            position += gap
+            positions.append(position)
+            gap = shift = 0
+    return positions
+
+
+def varint_lengths(values: np.ndarray) -> np.ndarray:
+    """Returns the number of bytes of the varint encoding of each non-negative value."""
+    values = np.asarray(values, dtype=np.int64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 63, 7):
+        lengths += values >= (1 << shift)
+    return lengths
+
+
+def encode_varints(values: np.ndarray) -> np.ndarray:
+    """Encodes non-negative values as consecutive varints, 7 bits per byte with the high bit set on all but the last byte."""
+    values = np.asarray(values, dtype=np.int64)
+    lengths = varint_lengths(values)
+    starts = np.cumsum(lengths) - lengths
+    encoded = np.empty(lengths.sum(), dtype=np.uint8)
+    for byte in range(lengths.max(initial=0)):
+        has_byte = lengths > byte
+        encoded[starts[has_byte] + byte] = (values[has_byte] >> (7 * byte)) & 0x7F | np.where(lengths[has_byte] > byte + 1, 0x80, 0)
+    return encoded
+
+
+def decode_varints(encoded: np.ndarray) -> np.ndarray:
+    """Decodes consecutive varints encoded by encode_varints."""
+    encoded = np.asarray(encoded, dtype=np.uint8)
+    if len(encoded) == 0:
+        return np.empty(0, dtype=np.int64)
+    last_bytes = encoded < 0x80
+    starts = np.flatnonzero(np.concatenate(([True], last_bytes[:-1])))
+    value_indices = np.cumsum(np.concatenate(([0], last_bytes[:-1])))
+    shifts = 7 * (np.arange(len(encoded)) - starts[value_indices])
+    # The 7-bit groups of a value do not overlap, so adding them assembles the value
+    return np.add.reduceat((encoded & 0x7F).astype(np.int64) << shifts, starts)